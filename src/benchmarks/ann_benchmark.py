@@ -0,0 +1,174 @@
+"""Offline recall/latency benchmark for the index types in embedding_index.py.
+
+For every index type and search parameter setting, this reports recall@k
+against the exact index, p50/p99 single-query search latency and the size
+of the serialized index file, which for the compressed index types is the
+memory their first pass holds in place of the float32 matrix. Compressed
+types are run with each number of candidates re-ranked exactly, along with
+the float32 rows that reads from the mapped matrix per query. Indexes are
+read from (or built into) the same files VectorSearch uses, so the numbers
+reflect the production artifacts.
+
+The settings of an index are timed together, each query being run with
+every setting in random order, after WARMUP_QUERIES untimed queries that
+read the pages of the mapped index and matrix in. With `--repeat N` the queries
+are timed N times and the percentiles are taken over all of them.
+
+Without a query log, queries are sampled from the corpus embeddings and
+perturbed with Gaussian noise; pass `--queries` with an .npy matrix of real
+query embeddings to benchmark against actual traffic instead.
+
+Run from the root directory:
+`python3 src/benchmarks/ann_benchmark.py [--index-type flat ivf hnsw ivfpq sq8]`
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import embedding_index  # pylint: disable=wrong-import-position
+
+NPROBES = [1, 4, 16, 64]
+EF_SEARCHES = [16, 32, 64, 128]
+RERANKS = [0, 50, 100, 200]
+WARMUP_QUERIES = 20
+
+
+def sample_queries(embeddings, num_queries, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeddings), size=num_queries, replace=False)
+    queries = np.asarray(embeddings[np.sort(rows)], dtype=np.float32)
+    queries += rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def load_or_build(embeddings, index_type, pca_dim):
+    factory = embedding_index.factory_string(index_type, pca_dim=pca_dim)
+    index_path = embedding_index.index_path_for(factory)
+    if not os.path.exists(index_path):
+        start = time.perf_counter()
+        embedding_index.write_index(
+            embedding_index.build_index(embeddings, index_type, pca_dim=pca_dim),
+            index_path,
+        )
+        print(f"built {factory} in {time.perf_counter() - start:.1f}s")
+    return embedding_index.read_index(index_path), os.path.getsize(index_path)
+
+
+def search(index, setting, query, k, embeddings):
+    """Runs one query with a (name, value) setting of `index`. The search
+    parameters are made for each query, since for HNSW they are set on the
+    index itself (see embedding_index.search_parameters)."""
+    name, value = setting
+    params = embedding_index.search_parameters(index, nprobe=value, ef_search=value)
+    start = time.perf_counter()
+    if name == "rerank" and value:
+        _, results = index.search(query[None, :], max(k, value), params=params)
+        _, results = embedding_index.exact_rerank(
+            embeddings, query[None, :], results, k
+        )
+    else:
+        _, results = index.search(query[None, :], k, params=params)
+    return results, time.perf_counter() - start
+
+
+def run(index, settings, queries, ground_truth, k, embeddings, repeat=1):
+    """Returns the recall and latency of each setting. Every query is run
+    with each setting, so that changes in the machine's speed over the run
+    affect the settings alike."""
+    for query in queries[:WARMUP_QUERIES]:
+        for setting in settings:
+            search(index, setting, query, k, embeddings)
+    rng = np.random.default_rng(0)
+    latencies = np.zeros((len(settings), repeat * len(queries)))
+    hits = np.zeros(len(settings))
+    for i in range(repeat):
+        for j, (query, expected) in enumerate(zip(queries, ground_truth)):
+            # In random order, since a search is slower right after one that
+            # evicted the CPU caches, such as a search with a high nprobe.
+            for s in rng.permutation(len(settings)):
+                results, seconds = search(index, settings[s], query, k, embeddings)
+                latencies[s, i * len(queries) + j] = seconds * 1000
+                if i == 0:
+                    hits[s] += len(np.intersect1d(results[0], expected))
+    return [
+        {
+            "recall": hits[s] / ground_truth.size,
+            "p50_ms": float(np.percentile(latencies[s], 50)),
+            "p99_ms": float(np.percentile(latencies[s], 99)),
+        }
+        for s in range(len(settings))
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--index-type",
+        nargs="+",
+        default=list(embedding_index.INDEX_FACTORIES),
+        choices=list(embedding_index.INDEX_FACTORIES),
+    )
+    parser.add_argument("--queries", help="optional .npy matrix of query embeddings")
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument("--noise", type=float, default=0.01)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1, help="timed passes")
+    parser.add_argument("--pca-dim", type=int, default=embedding_index.DEFAULT_PCA_DIM)
+    parser.add_argument("--json", help="optional path to write results to")
+    args = parser.parse_args()
+
+    embeddings = embedding_index.load_embeddings()
+    if args.queries:
+        queries = np.load(args.queries).astype(np.float32)
+    else:
+        queries = sample_queries(embeddings, args.num_queries, args.noise)
+    _, ground_truth = embedding_index.search(embeddings, queries, args.k)
+
+    results = []
+    print(
+        f"{'index':<16}{'param':<14}{'recall@' + str(args.k):>10}"
+        + f"{'p50 (ms)':>10}{'p99 (ms)':>10}{'size (MB)':>11}{'reads (KB)':>12}"
+    )
+    row_kb = embeddings.shape[1] * embeddings.itemsize / 1024
+    for index_type in args.index_type:
+        index, size = load_or_build(embeddings, index_type, args.pca_dim)
+        size_mb = size / 2**20
+        if index_type.startswith("ivf"):
+            settings = [("nprobe", value) for value in NPROBES]
+        elif index_type == "hnsw":
+            settings = [("efSearch", value) for value in EF_SEARCHES]
+        elif index_type in embedding_index.COMPRESSED_INDEX_TYPES:
+            settings = [("rerank", value) for value in RERANKS]
+        else:
+            settings = [("-", None)]
+        setting_results = run(
+            index, settings, queries, ground_truth, args.k, embeddings, args.repeat
+        )
+        for (name, value), result in zip(settings, setting_results):
+            rerank = value if name == "rerank" else 0
+            result.update(
+                index=embedding_index.factory_string(index_type, pca_dim=args.pca_dim),
+                param=name,
+                value=value,
+                size_mb=size_mb,
+                reads_kb=max(args.k, rerank) * row_kb if rerank else 0.0,
+            )
+            results.append(result)
+            param = name if value is None else f"{name}={value}"
+            print(
+                f"{result['index']:<16}{param:<14}{result['recall']:>10.3f}"
+                + f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+                + f"{size_mb:>11.1f}{result['reads_kb']:>12.0f}"
+            )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
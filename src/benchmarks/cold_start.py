@@ -0,0 +1,82 @@
+"""Benchmark comparing VectorSearch cold start with and without the on-disk index.
+
+The legacy path loads the dataset and adds a FAISS index over its embedding
+column, as VectorSearch did before embedding_index.py existed. The mmap path
+loads the dataset and memory-maps the prebuilt embedding matrix. Each path
+runs in a fresh interpreter so that neither one reuses the other's imports.
+
+Run from the root directory after the index files have been built:
+`python3 src/benchmarks/cold_start.py [--data-set DATA_SET] [--runs N]`
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+
+EMBEDDING_DATA_SET = "pvd-dot/public-domain-poetry-with-embeddings"
+
+
+def load_data(data_set):
+    import datasets  # pylint: disable=import-outside-toplevel
+
+    if os.path.isdir(data_set):
+        return datasets.load_from_disk(data_set)
+    return datasets.load_dataset(data_set, split="train")
+
+
+def legacy_start(data_set):
+    start = time.perf_counter()
+    data = load_data(data_set)
+    data.add_faiss_index(column="embedding")
+    ready = time.perf_counter() - start
+    query = np.array(data[0]["embedding"], dtype=np.float32)
+    start = time.perf_counter()
+    data.search("embedding", query, k=10)
+    return ready, time.perf_counter() - start, peak_rss_mb()
+
+
+def mmap_start(data_set):
+    import embedding_index  # pylint: disable=import-outside-toplevel
+
+    start = time.perf_counter()
+    load_data(data_set)
+    embeddings = embedding_index.load_embeddings()
+    ready = time.perf_counter() - start
+    query = embeddings[0]
+    start = time.perf_counter()
+    embedding_index.search(embeddings, query, 10)
+    return ready, time.perf_counter() - start, peak_rss_mb()
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(fn, data_set, runs):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for _ in range(runs):
+        with context.Pool(1) as pool:
+            results.append(pool.apply(fn, (data_set,)))
+    return [sorted(column)[len(column) // 2] for column in zip(*results)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-set", default=EMBEDDING_DATA_SET)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'path':<8}{'ready (s)':>12}{'query (ms)':>12}{'peak RSS (MB)':>16}")
+    for name, fn in [("legacy", legacy_start), ("mmap", mmap_start)]:
+        ready, query, rss = measure(fn, args.data_set, args.runs)
+        print(f"{name:<8}{ready:>12.2f}{query * 1000:>12.1f}{rss:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
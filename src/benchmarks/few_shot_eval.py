@@ -0,0 +1,170 @@
+"""Offline comparison of per-request few-shot examples with the static prompt.
+
+For each query, the candidates are retrieved and the response prompt is
+built once, then the LLM is asked to select a poem twice: with all of
+prompts.INITIAL_PROMPT as the system message, and with the examples the
+example bank selects for the query (see few_shot.py). This reports how
+often both select the same poem, how often each response fails to parse,
+and the system message and total prompt tokens of each, as counted by the
+tokenizer and as reported by the API.
+
+Agreement is only meaningful against the real chat model; against the
+local stand-in in mock_openai.py, which always picks the first candidate,
+this only checks the pipeline and the token counts.
+
+Build the example bank first (see build_index.py), then run from the root
+directory:
+`python3 src/benchmarks/few_shot_eval.py [--queries queries.txt] [--json results.json]`
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import chatgpt  # pylint: disable=wrong-import-position
+import few_shot  # pylint: disable=wrong-import-position
+import prompts  # pylint: disable=wrong-import-position
+import recommender  # pylint: disable=wrong-import-position
+import telemetry  # pylint: disable=wrong-import-position
+import tokenizer  # pylint: disable=wrong-import-position
+import vector_searcher  # pylint: disable=wrong-import-position
+
+DEFAULT_CONCURRENCY = 4
+QUERIES = [
+    "Recommend me an uplifting poem about winter.",
+    "Recommend me a poem about longing for the past.",
+    "A short poem about the sea at night",
+    "Something to read at a friend's funeral",
+    "A funny poem about cats",
+    "A love poem that doesn't rhyme",
+    "A poem about the first day of spring",
+    "Poems about war and what it costs the soldiers",
+    "Something hopeful for a hard week at work",
+    "A poem about growing old with someone",
+    "A poem a child would enjoy about animals",
+    "A dark, gothic poem about death",
+    "Something about the city at dawn",
+    "A poem about faith and doubt",
+    "A sonnet about unrequited love",
+    "A poem to celebrate a wedding",
+    "Something about mountains and solitude",
+    "A poem about the harvest and autumn fields",
+    "A poem about a mother's love",
+    "A poem about freedom",
+    "Something melancholy about rain",
+    "A poem about the stars and the night sky",
+    "A poem about friendship",
+    "A patriotic poem about America",
+]
+
+
+def select(chat, messages, tracer, name):
+    """Returns the poem id the LLM selects, or None if its response cannot
+    be parsed, and the prompt tokens reported by the API."""
+    with tracer.trace(name) as trace:
+        response = chat.complete(messages, trace)
+    try:
+        _, id_ = prompts.extract_response(response)
+        id_ = int(id_)
+    except ValueError:
+        id_ = None
+    return id_, trace.attributes.get("prompt_tokens")
+
+
+def compare(recs, query, tracer):
+    query_embeddings = recs.vector_searcher.embed_queries([query])
+    poem_results, _ = recs.find_candidates(query_embeddings)
+    prompt = recs.build_prompt(query, poem_results)
+    static = chatgpt.Message("system", prompts.INITIAL_PROMPT)
+    dynamic = recs.build_system_message(query_embeddings[0])
+    result = {"query": query}
+    for name, system_message in [("static", static), ("dynamic", dynamic)]:
+        messages = recs.build_messages(query, prompt, system_message)
+        id_, prompt_tokens = select(recs.chat, messages, tracer, name)
+        result[name] = {
+            "poem_id": id_,
+            "system_tokens": tokenizer.num_tokens(system_message.content),
+            "prompt_tokens": prompt_tokens,
+        }
+    return result
+
+
+def summarize(results):
+    def mean(name, key):
+        values = [r[name][key] for r in results if r[name][key] is not None]
+        return float(np.mean(values)) if values else None
+
+    agreed = sum(
+        r["static"]["poem_id"] is not None
+        and r["static"]["poem_id"] == r["dynamic"]["poem_id"]
+        for r in results
+    )
+    summary = {"queries": len(results), "agreement": agreed / len(results)}
+    for name in ["static", "dynamic"]:
+        summary[name] = {
+            "parse_failures": sum(r[name]["poem_id"] is None for r in results),
+            "system_tokens": mean(name, "system_tokens"),
+            "prompt_tokens": mean(name, "prompt_tokens"),
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-set", help="dataset name or directory")
+    parser.add_argument("--queries", help="file with one query per line")
+    parser.add_argument("--limit", type=int, default=few_shot.DEFAULT_LIMIT)
+    parser.add_argument(
+        "--token-budget", type=int, default=few_shot.DEFAULT_TOKEN_BUDGET
+    )
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--json", help="optional path to write results to")
+    args = parser.parse_args()
+
+    if not few_shot.exists():
+        sys.exit("The example bank has not been built; see build_index.py.")
+    queries = QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    recs = recommender.Recommender(
+        vector_searcher.VectorSearch(data_set=args.data_set),
+        chatgpt.ChatGPT(),
+        example_bank=few_shot.ExampleBank(),
+        example_limit=args.limit,
+        example_token_budget=args.token_budget,
+    )
+    tracer = telemetry.Telemetry()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(lambda q: compare(recs, q, tracer), queries))
+    summary = summarize(results)
+
+    print(
+        f"{summary['queries']} queries; {len(recs.example_bank)} examples in the "
+        + f"bank, up to {args.limit} per request within {args.token_budget} tokens"
+    )
+    print(f"{'prompt':<10}{'system tokens':>15}{'prompt tokens':>15}{'failures':>10}")
+    for name in ["static", "dynamic"]:
+        row = summary[name]
+        prompt_tokens = row["prompt_tokens"]
+        print(
+            f"{name:<10}{row['system_tokens']:>15.0f}"
+            + f"{'-' if prompt_tokens is None else f'{prompt_tokens:.0f}':>15}"
+            + f"{row['parse_failures']:>10}"
+        )
+    reduction = (
+        1 - summary["dynamic"]["system_tokens"] / summary["static"]["system_tokens"]
+    )
+    print(f"system message tokens cut by {reduction:.0%}")
+    print(f"selection agreement: {summary['agreement']:.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
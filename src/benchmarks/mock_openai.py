@@ -0,0 +1,228 @@
+"""Local stand-in for the OpenAI embeddings and chat completions endpoints.
+
+Benchmarks that exercise the full recommendation pipeline should not depend
+on the network, on API keys or on OpenAI's latency on the day, so this
+server answers the endpoints the recommender calls with deterministic
+outputs after configurable delays:
+
+- /v1/embeddings returns a unit vector seeded from the md5 of each input,
+  so the same text always embeds to the same vector.
+- /v1/models/{model} describes any model, for connection warm-up.
+- /v1/chat/completions selects the first candidate listed in the prompt and
+  returns it in the <explanation>/<id> format the recommender expects,
+  either whole or as server-sent events when `stream` is set.
+
+Point the OpenAI clients at it with OPENAI_BASE_URL=http://HOST:PORT/v1
+(see MockOpenAI.environ), either by starting it on a thread with
+MockOpenAI, or as a separate process from the root directory:
+`python3 src/benchmarks/mock_openai.py [--port 8765] [--chat-ttft-ms 300]`
+"""
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import re
+import threading
+import time
+import numpy as np
+
+EMBEDDING_DIMENSIONS = 1536
+DEFAULT_PORT = 8765
+DEFAULT_EMBEDDING_LATENCY_MS = 50.0
+DEFAULT_CHAT_TTFT_MS = 300.0
+DEFAULT_CHUNK_DELAY_MS = 5.0
+CHUNK_CHARS = 8
+EXPLANATION = (
+    "This poem answers the request '{query}' with imagery and a tone that "
+    + "match what was asked for, and its form suits a reader looking for it."
+)
+
+
+def embed(text, dimensions=EMBEDDING_DIMENSIONS):
+    seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+    embedding = np.random.default_rng(seed).standard_normal(dimensions)
+    return (embedding / np.linalg.norm(embedding)).astype(np.float32)
+
+
+def chat_reply(messages):
+    """Returns the reply selecting the first candidate in `messages`."""
+    user_messages = [m["content"] for m in messages if m["role"] == "user"]
+    candidates = [m["content"] for m in messages if m["role"] == "assistant"]
+    ids = re.findall(r"^id: (\d+)$", "\n".join(candidates), re.MULTILINE)
+    query = user_messages[-1] if user_messages else ""
+    explanation = EXPLANATION.format(query=query)
+    return f"<explanation>{explanation}</explanation>\n<id>{ids[0] if ids else 0}</id>"
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Request handler; the delays are read from the server."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        # Model lookups, which clients use to warm their connections.
+        if "/models/" in self.path:
+            model = self.path.rsplit("/", 1)[-1]
+            self.send_json(
+                {"id": model, "object": "model", "created": 0, "owned_by": "mock"}
+            )
+        else:
+            self.send_json({"error": {"message": f"unknown path {self.path}"}}, 404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.endswith("/embeddings"):
+            self.handle_embeddings(body)
+        elif self.path.endswith("/chat/completions"):
+            self.handle_chat(body)
+        else:
+            self.send_json({"error": {"message": f"unknown path {self.path}"}}, 404)
+
+    def handle_embeddings(self, body):
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        time.sleep(self.server.embedding_latency)
+        data = []
+        for i, text in enumerate(inputs):
+            embedding = embed(text)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(embedding.tobytes()).decode("ascii")
+            else:
+                embedding = embedding.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(text.split()) for text in inputs)
+        self.send_json(
+            {
+                "object": "list",
+                "data": data,
+                "model": body.get("model", ""),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        )
+
+    def handle_chat(self, body):
+        reply = chat_reply(body["messages"])
+        created = int(time.time())
+        time.sleep(self.server.chat_ttft)
+        if not body.get("stream"):
+            time.sleep(self.server.chunk_delay * ((len(reply) - 1) // CHUNK_CHARS + 1))
+            self.send_json(
+                {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": body.get("model", ""),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": reply},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                }
+            )
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for start in range(0, len(reply), CHUNK_CHARS):
+            if start:
+                time.sleep(self.server.chunk_delay)
+            chunk = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body.get("model", ""),
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": reply[start : start + CHUNK_CHARS]},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True  # pylint: disable=attribute-defined-outside-init
+
+    def send_json(self, payload, status=200):
+        content = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MockOpenAI:
+    """The stand-in server, served from a daemon thread while in a `with`
+    block. Latencies are in milliseconds: `embedding_latency_ms` per
+    embeddings request, `chat_ttft_ms` before the first chunk of a chat
+    completion and `chunk_delay_ms` between its chunks."""
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        embedding_latency_ms=DEFAULT_EMBEDDING_LATENCY_MS,
+        chat_ttft_ms=DEFAULT_CHAT_TTFT_MS,
+        chunk_delay_ms=DEFAULT_CHUNK_DELAY_MS,
+    ):
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.embedding_latency = embedding_latency_ms / 1000
+        self.server.chat_ttft = chat_ttft_ms / 1000
+        self.server.chunk_delay = chunk_delay_ms / 1000
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def environ(self):
+        """The environment variables that point OpenAI clients here."""
+        return {"OPENAI_BASE_URL": self.base_url, "OPENAI_API_KEY": "mock"}
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--embedding-latency-ms", type=float, default=DEFAULT_EMBEDDING_LATENCY_MS
+    )
+    parser.add_argument("--chat-ttft-ms", type=float, default=DEFAULT_CHAT_TTFT_MS)
+    parser.add_argument("--chunk-delay-ms", type=float, default=DEFAULT_CHUNK_DELAY_MS)
+    args = parser.parse_args()
+
+    mock = MockOpenAI(
+        args.host,
+        args.port,
+        args.embedding_latency_ms,
+        args.chat_ttft_ms,
+        args.chunk_delay_ms,
+    )
+    print(f"Serving on {mock.base_url}")
+    mock.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
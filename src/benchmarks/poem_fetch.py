@@ -0,0 +1,115 @@
+"""Micro-benchmark of fetching the poems for a search result.
+
+Times the per-request Python work of turning the ids of a search result into
+poems, for random sets of CANDIDATE_LIMIT ids:
+
+- per id: the previous implementation, one `data[id]` row read per result
+  id (decoding the embedding column) and one more for the selected poem.
+- one take: a single read of the full rows of all ids.
+- get_poems: VectorSearch.get_poems, a single read of only the metadata
+  columns, with the selected poem reused from the candidates.
+
+The searcher and recommender are built as in production, with their OpenAI
+clients pointed at mock_openai.py; no API calls are made.
+
+Run from the root directory:
+`python3 src/benchmarks/poem_fetch.py [--data-set DATA_SET] [--requests N]`
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import chatgpt  # pylint: disable=wrong-import-position
+import mock_openai  # pylint: disable=wrong-import-position
+import recommender  # pylint: disable=wrong-import-position
+import vector_searcher  # pylint: disable=wrong-import-position
+
+NUM_REQUESTS = 1000
+
+ReferencePoem = collections.namedtuple(
+    "Poem", ["id", "title", "author", "text", "views", "about", "birth_and_death_dates"]
+)
+
+
+def reference_convert_to_poem(data, id_):
+    row = data[int(id_)]
+    return ReferencePoem(
+        id=row["id"],
+        title=row["Title"],
+        author=row["Author"],
+        text=row["Poem Text"],
+        views=row["Views"],
+        about=row["About"],
+        birth_and_death_dates=row["Birth and Death Dates"],
+    )
+
+
+def per_id(data, ids):
+    poems = [reference_convert_to_poem(data, id_) for id_ in ids]
+    selected = reference_convert_to_poem(data, ids[0])
+    return poems, selected
+
+
+def one_take(data, ids):
+    poems = vector_searcher.rows_to_poems(data[[int(id_) for id_ in ids]])
+    selected = vector_searcher.rows_to_poems(data[[int(ids[0])]])[0]
+    return poems, selected
+
+
+def time_requests(fn, requests):
+    start = time.perf_counter()
+    for ids in requests:
+        fn(ids)
+    return (time.perf_counter() - start) / len(requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-set", default=vector_searcher.EMBEDDING_DATA_SET)
+    parser.add_argument("--requests", type=int, default=NUM_REQUESTS)
+    args = parser.parse_args()
+
+    with mock_openai.MockOpenAI() as mock:
+        os.environ.update(mock.environ())
+        run(args)
+
+
+def run(args):
+    searcher = vector_searcher.VectorSearch(data_set=args.data_set)
+    recs = recommender.Recommender(searcher, chatgpt.ChatGPT())
+
+    def get_poems(ids):
+        poems = searcher.get_poems(ids)
+        return poems, recs.build_recommendation_result(ids[0], "", poems)
+
+    rng = np.random.default_rng(0)
+    requests = [
+        rng.choice(len(searcher.data), recommender.CANDIDATE_LIMIT, replace=False)
+        for _ in range(args.requests)
+    ]
+    print(
+        f"{args.requests} requests of {recommender.CANDIDATE_LIMIT} ids "
+        + f"from {len(searcher.data)} poems"
+    )
+    timings = [
+        (name, time_requests(fn, requests))
+        for name, fn in [
+            ("per id", lambda ids: per_id(searcher.data, ids)),
+            ("one take", lambda ids: one_take(searcher.data, ids)),
+            ("get_poems", get_poems),
+        ]
+    ]
+    for name, seconds in timings:
+        print(
+            f"{name}: {seconds * 1000:.2f} ms/request "
+            + f"({timings[0][1] / seconds:.1f}x)"
+        )
+    recs.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Offline evaluation of candidate re-ranking and token-budgeted packing.
+
+For each ranker setting and candidate token budget, this reports the mean
+number of candidates and prompt tokens that would be sent to the LLM, the
+selection recall (how often the poem the LLM selected is still among the
+candidates) and the time spent on search, re-ranking and packing.
+
+Selections are read from the response cache (see response_cache.py), which
+records the poem the LLM selected from the top CANDIDATE_LIMIT candidates
+for each cached request. Without one, queries are sampled from the corpus
+embeddings with Gaussian noise, and the poem each query was sampled from
+counts as the selection.
+
+The searcher and recommenders are built as in production, with their
+OpenAI clients pointed at mock_openai.py; no API calls are made.
+
+Run from the root directory:
+`python3 src/benchmarks/ranker_eval.py [--responses data/responses.sqlite]`
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import chatgpt  # pylint: disable=wrong-import-position
+import mock_openai  # pylint: disable=wrong-import-position
+import prompt_blocks  # pylint: disable=wrong-import-position
+import prompts  # pylint: disable=wrong-import-position
+import ranker  # pylint: disable=wrong-import-position
+import recommender  # pylint: disable=wrong-import-position
+import tokenizer  # pylint: disable=wrong-import-position
+import vector_searcher  # pylint: disable=wrong-import-position
+
+TOKEN_BUDGETS = [None, 6000, 4000, 2000]
+RANKERS = {
+    "top-10": None,
+    "views": ranker.Ranker(diversity=0.0),
+    "mmr": ranker.Ranker(),
+}
+
+
+def load_responses(path):
+    db = sqlite3.connect(path)
+    rows = db.execute("SELECT embedding, poem_id FROM responses").fetchall()
+    db.close()
+    queries = np.stack([np.frombuffer(row[0], dtype=np.float32) for row in rows])
+    return queries, np.array([row[1] for row in rows])
+
+
+def sample_queries(embeddings, num_queries, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeddings), size=num_queries, replace=False)
+    queries = np.asarray(embeddings[rows], dtype=np.float32)
+    queries += rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True), rows
+
+
+def evaluate(recs, queries, selections, poem_blocks):
+    num_candidates, num_tokens, hits, latencies = [], [], 0, []
+    for query, selection in zip(queries, selections):
+        start = time.perf_counter()
+        poems, _ = recs.find_candidates(query[np.newaxis])
+        poems, blocks, tokens = prompts.pack_candidates(
+            poems, poem_blocks, recs.prompt_token_budget
+        )
+        latencies.append(time.perf_counter() - start)
+        if poem_blocks is None and recs.prompt_token_budget is None:
+            tokens = sum(tokenizer.num_tokens(block) for block in blocks)
+        num_candidates.append(len(poems))
+        num_tokens.append(tokens)
+        hits += any(poem.id == selection for poem in poems)
+    return {
+        "candidates": float(np.mean(num_candidates)),
+        "candidate_tokens": float(np.mean(num_tokens)),
+        "selection_recall": hits / len(queries),
+        "p50_ms": float(np.percentile(np.array(latencies) * 1000, 50)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-set", default=vector_searcher.EMBEDDING_DATA_SET)
+    parser.add_argument("--responses", help="response cache to read selections from")
+    parser.add_argument("--num-queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.02)
+    parser.add_argument("--json", help="optional path to write results to")
+    args = parser.parse_args()
+
+    with mock_openai.MockOpenAI() as mock:
+        os.environ.update(mock.environ())
+        results = run(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+def run(args):
+    searcher = vector_searcher.VectorSearch(data_set=args.data_set)
+    if args.responses:
+        queries, selections = load_responses(args.responses)
+    else:
+        queries, selections = sample_queries(
+            searcher.index.embeddings, args.num_queries, args.noise
+        )
+    poem_blocks = prompt_blocks.PromptBlocks() if prompt_blocks.exists() else None
+    fixed_tokens = tokenizer.num_tokens(prompts.INITIAL_PROMPT) + tokenizer.num_tokens(
+        prompts.RESPONSE_PROMPT
+    )
+    print(
+        f"{len(queries)} queries; the system prompt and response template add "
+        + f"{fixed_tokens} tokens to every prompt"
+    )
+
+    results = []
+    print(
+        f"{'ranker':<10}{'budget':>8}{'candidates':>12}{'tokens':>10}"
+        + f"{'recall':>9}{'p50 (ms)':>10}"
+    )
+    for name, rank in RANKERS.items():
+        for budget in TOKEN_BUDGETS:
+            recs = recommender.Recommender(
+                searcher,
+                chatgpt.ChatGPT(),
+                poem_blocks=poem_blocks,
+                prompt_token_budget=budget,
+                ranker=rank,
+            )
+            result = evaluate(recs, queries, selections, poem_blocks)
+            recs.close()
+            result.update(ranker=name, budget=budget)
+            results.append(result)
+            print(
+                f"{name:<10}{str(budget or '-'):>8}{result['candidates']:>12.1f}"
+                + f"{result['candidate_tokens']:>10.0f}"
+                + f"{result['selection_recall']:>9.3f}{result['p50_ms']:>10.2f}"
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Cold-start budgets for the recommender's entry points.
+
+For the CLI (main.py), the Streamlit demo and the Discord bot, this
+measures in a fresh interpreter how long it takes until:
+
+- interactive: the entry module is imported and the background build has
+  started (see startup.py), so the prompt can be shown, the page rendered
+  or the Discord connection opened
+- ready: the recommender has been built and warmed
+- first response: the first request after that has been answered
+
+and checks them against BUDGETS, exiting nonzero if any is over budget.
+The OpenAI API is replaced by the local stand-in in mock_openai.py and, by
+default, the dataset by the full-size synthetic corpus, with its serving
+artifacts prebuilt, so the numbers measure a restart of a deployment.
+
+Run from the root directory:
+`python3 src/benchmarks/startup_budget.py [--data-set DIR] [--runs 3]`
+"""
+import argparse
+import importlib
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import mock_openai  # pylint: disable=wrong-import-position
+import suite  # pylint: disable=wrong-import-position
+import synthetic_corpus  # pylint: disable=wrong-import-position
+
+DEFAULT_CORPUS_SIZE = 38521
+# Budgets in seconds for each entry point: (interactive, ready, first response).
+BUDGETS = {
+    "main": (0.25, 10.0, 1.0),
+    "streamlit_demo": (1.5, 10.0, 1.0),
+    "discord_bot": (1.0, 10.0, 1.0),
+}
+MEASUREMENTS = ["interactive", "ready", "first_response"]
+
+
+def measure(entry_point):
+    start = time.perf_counter()
+    module = importlib.import_module(entry_point)
+    import startup  # pylint: disable=import-outside-toplevel
+
+    starter = startup.BackgroundRecommender(module.build_recommender)
+    interactive = time.perf_counter() - start
+    recs = starter.wait()
+    ready = time.perf_counter() - start
+    begin = time.perf_counter()
+    recs.ask("a short poem about the sea at night")
+    return interactive, ready, time.perf_counter() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-set", help="dataset directory or Hub name")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--entry-points", nargs="+", choices=list(BUDGETS), default=list(BUDGETS)
+    )
+    args = parser.parse_args()
+
+    data_set = args.data_set
+    if data_set is None:
+        data_set = synthetic_corpus.generate(DEFAULT_CORPUS_SIZE)
+    if os.path.isdir(data_set):
+        data_set = os.path.abspath(data_set)
+    workdir = os.path.dirname(data_set) if os.path.isdir(data_set) else os.getcwd()
+    suite.in_subprocess(suite.prepare, workdir, data_set)
+
+    over_budget = []
+    print(
+        f"{'entry point':<16}{'interactive (s)':>17}{'ready (s)':>11}"
+        + f"{'first response (s)':>20}"
+    )
+    with mock_openai.MockOpenAI() as mock:
+        os.environ.update(mock.environ())
+        os.environ["POEM_DATA_SET"] = data_set
+        for entry_point in args.entry_points:
+            # The entry points read their artifacts from data/ under the
+            # working directory, which the children inherit.
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                runs = [
+                    suite.in_subprocess(measure, entry_point) for _ in range(args.runs)
+                ]
+            finally:
+                os.chdir(cwd)
+            medians = [sorted(column)[len(column) // 2] for column in zip(*runs)]
+            print(
+                f"{entry_point:<16}{medians[0]:>17.2f}{medians[1]:>11.2f}"
+                + f"{medians[2]:>20.2f}"
+            )
+            for name, value, budget in zip(MEASUREMENTS, medians, BUDGETS[entry_point]):
+                if value > budget:
+                    over_budget.append(
+                        f"{entry_point} {name}: {value:.2f}s > {budget:.2f}s"
+                    )
+
+    for line in over_budget:
+        print(f"Over budget: {line}")
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
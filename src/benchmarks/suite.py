@@ -0,0 +1,315 @@
+"""Offline end-to-end benchmark suite for the recommendation pipeline.
+
+For each synthetic corpus size (see synthetic_corpus.py), this measures in
+a fresh interpreter:
+
+- startup: importing the recommender and constructing VectorSearch,
+  ChatGPT and Recommender from prebuilt artifacts
+- p50/p95/p99 latency of each stage of a request (query embedding,
+  candidate search, prompt building, chat completion, response parsing)
+  and of Recommender.ask as a whole
+- throughput of Recommender.ask_many at the given concurrency
+- build_response_prompt with and without precomputed prompt blocks, and
+  splitting a recommendation into Discord messages
+- peak RSS
+
+The OpenAI API is replaced by the local stand-in in mock_openai.py, with
+fixed latencies, so results depend only on the code and the machine.
+Every query is distinct and the query embedding cache is memory-only, so
+no request is served from a cache. Results are written as JSON tagged with
+the commit, and two result files can be compared to flag regressions.
+
+Run from the root directory:
+`python3 src/benchmarks/suite.py [--sizes 1000 10000] [--output results.json]`
+`python3 src/benchmarks/suite.py --compare old.json new.json [--threshold 0.1]`
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import mock_openai  # pylint: disable=wrong-import-position
+import synthetic_corpus  # pylint: disable=wrong-import-position
+
+DEFAULT_SIZES = [1000, 10000]
+DEFAULT_NUM_REQUESTS = 100
+DEFAULT_CONCURRENCY = 8
+DEFAULT_THRESHOLD = 0.1
+STAGES = ["embed", "search", "prompt", "llm", "parse"]
+PERCENTILES = [50, 95, 99]
+# Metrics where a larger value is an improvement; the rest are costs.
+HIGHER_IS_BETTER = {"throughput_rps"}
+
+
+def percentiles(seconds):
+    milliseconds = np.array(seconds) * 1000
+    summary = {f"p{p}_ms": float(np.percentile(milliseconds, p)) for p in PERCENTILES}
+    summary["mean_ms"] = float(milliseconds.mean())
+    return summary
+
+
+def make_queries(num_queries, offset=0):
+    """Returns distinct queries, so that none hits a cache."""
+    return [
+        f"a poem about {synthetic_corpus.WORDS[i % len(synthetic_corpus.WORDS)]} "
+        + f"for reader {i}"
+        for i in range(offset, offset + num_queries)
+    ]
+
+
+def prepare(workdir, corpus):
+    """Builds the serving artifacts of `corpus` under `workdir`/data."""
+    import embedding_index  # pylint: disable=import-outside-toplevel
+    import prompt_blocks  # pylint: disable=import-outside-toplevel
+    import vector_searcher  # pylint: disable=import-outside-toplevel
+
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    os.chdir(workdir)
+    data = vector_searcher.load_poems(corpus)
+    if not embedding_index.exists():
+        embedding_index.build(data)
+    if not prompt_blocks.exists():
+        prompt_blocks.build(data)
+
+
+def run(workdir, corpus, num_requests, concurrency):
+    """Runs the benchmarks against prepared artifacts; see the module
+    docstring. Must run in a fresh interpreter for startup to be cold."""
+    start = time.perf_counter()
+    # pylint: disable=import-outside-toplevel
+    import chatgpt
+    import discord_bot
+    import embedding_cache
+    import prompts
+    import recommender
+    import vector_searcher
+
+    # pylint: enable=import-outside-toplevel
+    os.chdir(workdir)
+    searcher = vector_searcher.VectorSearch(
+        query_cache=embedding_cache.EmbeddingCache(None), data_set=corpus
+    )
+    chat = chatgpt.ChatGPT()
+    recs = recommender.Recommender(
+        searcher, chat, max_workers=concurrency, max_pending=concurrency * 4
+    )
+    startup = time.perf_counter() - start
+
+    stages = {stage: [] for stage in STAGES + ["total"]}
+    candidates = []
+    for query in make_queries(num_requests):
+        times = [time.perf_counter()]
+        query_embeddings = searcher.embed_queries([query])
+        times.append(time.perf_counter())
+        poem_results, _ = recs.find_candidates(query_embeddings)
+        times.append(time.perf_counter())
+        prompt = recs.build_prompt(query, poem_results)
+        system_message = recs.build_system_message(query_embeddings[0])
+        times.append(time.perf_counter())
+        response = chat.complete(recs.build_messages(query, prompt, system_message))
+        times.append(time.perf_counter())
+        explanation, id_ = prompts.extract_response(response)
+        recs.build_recommendation_result(id_, explanation, poem_results)
+        times.append(time.perf_counter())
+        for stage, begin, end in zip(STAGES, times, times[1:]):
+            stages[stage].append(end - begin)
+        stages["total"].append(times[-1] - times[0])
+        candidates.append((query, poem_results))
+
+    ask = []
+    for query in make_queries(num_requests, offset=num_requests):
+        begin = time.perf_counter()
+        recs.ask(query)
+        ask.append(time.perf_counter() - begin)
+
+    queries = make_queries(num_requests, offset=2 * num_requests)
+    begin = time.perf_counter()
+    recs.ask_many(queries)
+    throughput = len(queries) / (time.perf_counter() - begin)
+
+    prompt_blocks, prompt_rendered = [], []
+    for query, poem_results in candidates:
+        begin = time.perf_counter()
+        prompts.build_response_prompt(query, poem_results, recs.poem_blocks)
+        prompt_blocks.append(time.perf_counter() - begin)
+        begin = time.perf_counter()
+        prompts.build_response_prompt(query, poem_results)
+        prompt_rendered.append(time.perf_counter() - begin)
+
+    split_messages = []
+    for query, poem_results in candidates:
+        explanation, poem_text = recs.build_recommendation_result(
+            poem_results[0].id, mock_openai.EXPLANATION.format(query=query)
+        )
+        begin = time.perf_counter()
+        discord_bot.split_messages(explanation, poem_text)
+        split_messages.append(time.perf_counter() - begin)
+    recs.close()
+
+    return {
+        "startup_seconds": startup,
+        "throughput_rps": throughput,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {stage: percentiles(times) for stage, times in stages.items()},
+        "ask": percentiles(ask),
+        "build_response_prompt": {
+            "blocks": percentiles(prompt_blocks),
+            "rendered": percentiles(prompt_rendered),
+        },
+        "split_messages": percentiles(split_messages),
+    }
+
+
+def in_subprocess(fn, *args):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def flatten(results, prefix=""):
+    """Flattens nested results into {"a.b.c": value}."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(old_path, new_path, threshold):
+    """Prints the relative change of every metric and returns the ones that
+    got worse by more than `threshold`."""
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}")
+    regressions = []
+    for size, new_results in new["corpora"].items():
+        if size not in old["corpora"]:
+            continue
+        old_flat = flatten(old["corpora"][size])
+        for metric, new_value in flatten(new_results).items():
+            old_value = old_flat.get(metric)
+            if not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            worse = -change if metric.split(".")[-1] in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions.append((size, metric, old_value, new_value))
+            print(
+                f"{size:>7} {metric:<40}{old_value:>12.2f}{new_value:>12.2f}"
+                + f"{change:>+9.1%}{flag}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--requests", type=int, default=DEFAULT_NUM_REQUESTS)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        "--embedding-latency-ms",
+        type=float,
+        default=mock_openai.DEFAULT_EMBEDDING_LATENCY_MS,
+    )
+    parser.add_argument(
+        "--chat-ttft-ms", type=float, default=mock_openai.DEFAULT_CHAT_TTFT_MS
+    )
+    parser.add_argument(
+        "--chunk-delay-ms", type=float, default=mock_openai.DEFAULT_CHUNK_DELAY_MS
+    )
+    parser.add_argument("--output", help="path to write the JSON results to")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="compare two result files instead of running the benchmarks",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="relative change that --compare reports as a regression",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare, args.threshold)
+        print(f"{len(regressions)} regression(s) above {args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+
+    mock = mock_openai.MockOpenAI(
+        embedding_latency_ms=args.embedding_latency_ms,
+        chat_ttft_ms=args.chat_ttft_ms,
+        chunk_delay_ms=args.chunk_delay_ms,
+    )
+    results = {
+        "commit": commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "embedding_latency_ms": args.embedding_latency_ms,
+            "chat_ttft_ms": args.chat_ttft_ms,
+            "chunk_delay_ms": args.chunk_delay_ms,
+            "cpu_count": os.cpu_count(),
+        },
+        "corpora": {},
+    }
+    with mock:
+        # Spawned children inherit the environment, so their OpenAI
+        # clients are created against the stand-in.
+        os.environ.update(mock.environ())
+        for size in args.sizes:
+            corpus = os.path.abspath(synthetic_corpus.generate(size))
+            workdir = os.path.dirname(corpus)
+            in_subprocess(prepare, workdir, corpus)
+            result = in_subprocess(
+                run, workdir, corpus, args.requests, args.concurrency
+            )
+            results["corpora"][str(size)] = result
+            stages = result["stages"]
+            print(
+                f"{size} poems: startup {result['startup_seconds']:.2f}s, "
+                + f"{result['throughput_rps']:.1f} requests/s, "
+                + f"peak RSS {result['peak_rss_mb']:.0f} MB"
+            )
+            for stage in STAGES + ["total"]:
+                print(
+                    f"  {stage:<8}"
+                    + "".join(
+                        f"{stages[stage][f'p{p}_ms']:>10.2f}" for p in PERCENTILES
+                    )
+                    + " ms (p50/p95/p99)"
+                )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Deterministic synthetic poem corpora for offline benchmarks.
+
+Each corpus has the columns of the Hugging Face dataset (see
+vector_searcher.POEM_COLUMNS, plus "embedding"), so VectorSearch can load it
+with `data_set` set to its directory. Embeddings are drawn around a few
+hundred random centroids rather than uniformly, so nearest neighbor search
+sees clusters as it does on real embeddings, and poem lengths are
+log-normal, as on poetrydb, so that prompt sizes and truncation vary.
+
+Run from the root directory:
+`python3 src/benchmarks/synthetic_corpus.py [--sizes 1000 10000 38521]`
+"""
+import argparse
+import os
+import numpy as np
+
+EMBEDDING_DIMENSIONS = 1536
+DEFAULT_SIZES = [1000, 10000, 38521]
+CORPUS_DIR = "data/benchmarks"
+NUM_CLUSTERS = 256
+CLUSTER_NOISE = 0.6
+NUM_AUTHORS = 500
+WRITE_BATCH_SIZE = 2000
+WORDS = (
+    "the a of and in to my thy sea autumn love night star heart rose river "
+    + "death light dream wind winter spring morning shadow silver golden "
+    + "grave song bird field snow fire silence memory sorrow joy stone"
+).split()
+
+
+def corpus_path(size, root=CORPUS_DIR):
+    return os.path.join(root, f"corpus-{size}", "dataset")
+
+
+def generate_rows(size, start, stop, seed=0):
+    """Returns the columns of rows [start, stop) of the corpus of `size`."""
+    centroids = np.random.default_rng(seed).standard_normal(
+        (NUM_CLUSTERS, EMBEDDING_DIMENSIONS), dtype=np.float32
+    )
+    rng = np.random.default_rng([seed, size, start])
+    num_rows = stop - start
+    embeddings = centroids[rng.integers(0, NUM_CLUSTERS, num_rows)]
+    embeddings += CLUSTER_NOISE * rng.standard_normal(
+        embeddings.shape, dtype=np.float32
+    )
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    num_lines = np.clip(rng.lognormal(2.8, 0.7, num_rows), 2, 2000).astype(int)
+    texts = []
+    for lines in num_lines:
+        words = rng.choice(WORDS, size=(lines, 7))
+        texts.append("\n".join(" ".join(line) for line in words))
+    ids = list(range(start, stop))
+    birth_years = rng.integers(1550, 1900, num_rows)
+    return {
+        "id": ids,
+        "Title": [f"Poem {id_}" for id_ in ids],
+        "Author": [f"Author {id_ % NUM_AUTHORS}" for id_ in ids],
+        "Poem Text": texts,
+        "Views": rng.zipf(1.5, num_rows).clip(0, 10**6).tolist(),
+        "About": [f"Author {id_ % NUM_AUTHORS} was a poet." for id_ in ids],
+        "Birth and Death Dates": [
+            f"{birth} - {birth + age}"
+            for birth, age in zip(birth_years, rng.integers(20, 90, num_rows))
+        ],
+        "embedding": list(embeddings),
+    }
+
+
+def generate(size, path=None, seed=0):
+    """Writes the corpus of `size` poems with Dataset.save_to_disk, unless
+    it already exists, and returns its path."""
+    import datasets  # pylint: disable=import-outside-toplevel
+
+    path = path or corpus_path(size)
+    if os.path.isdir(path):
+        return path
+    features = datasets.Features(
+        {
+            "id": datasets.Value("int64"),
+            "Title": datasets.Value("string"),
+            "Author": datasets.Value("string"),
+            "Poem Text": datasets.Value("string"),
+            "Views": datasets.Value("int64"),
+            "About": datasets.Value("string"),
+            "Birth and Death Dates": datasets.Value("string"),
+            "embedding": datasets.Sequence(datasets.Value("float32")),
+        }
+    )
+    batches = [
+        datasets.Dataset.from_dict(
+            generate_rows(size, start, min(start + WRITE_BATCH_SIZE, size), seed),
+            features=features,
+        )
+        for start in range(0, size, WRITE_BATCH_SIZE)
+    ]
+    datasets.concatenate_datasets(batches).save_to_disk(path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--root", default=CORPUS_DIR)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(generate(size, corpus_path(size, args.root)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Micro-benchmark of poem truncation for the response prompt.
+
+Times truncating every poem in the corpus to POEM_TOKEN_LIMIT tokens, in
+the format used by prompts.build_response_prompt, with tokenizer.py and
+with the previous implementation (a binary search over character offsets
+that re-fetched the encoding and re-encoded the prefix at every step). It
+also checks that every prefix fits in the limit, and counts the prefixes
+that differ from the previous implementation's, which can end inside a
+token where tokenizer.py ends at a token boundary.
+
+Run from the root directory:
+`python3 src/benchmarks/token_truncation.py [--data-set DATA_SET] [--limit N]`
+"""
+import argparse
+import os
+import sys
+import time
+import tiktoken
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import prompts  # pylint: disable=wrong-import-position
+import tokenizer  # pylint: disable=wrong-import-position
+
+EMBEDDING_DATA_SET = "pvd-dot/public-domain-poetry-with-embeddings"
+COLUMNS = [
+    "id",
+    "Title",
+    "Author",
+    "Birth and Death Dates",
+    "Views",
+    "Poem Text",
+    "About",
+]
+
+
+def reference_num_tokens_from_string(string, encoding_name):
+    encoding = tiktoken.get_encoding(encoding_name)
+    return len(encoding.encode(string))
+
+
+def reference_reduce_to_token_limit(text, limit):
+    tokens = reference_num_tokens_from_string(text, tokenizer.TOKENIZER)
+    if tokens <= limit:
+        return text
+    start = 0
+    end = len(text)
+    while start <= end:
+        mid = (start + end) // 2
+        if reference_num_tokens_from_string(text[:mid], tokenizer.TOKENIZER) <= limit:
+            start = mid + 1
+        else:
+            end = mid - 1
+    return text[:end]
+
+
+def load_poem_texts(data_set):
+    import datasets  # pylint: disable=import-outside-toplevel
+
+    if os.path.isdir(data_set):
+        data = datasets.load_from_disk(data_set)
+    else:
+        data = datasets.load_dataset(data_set, split="train")
+    data = data.select_columns(COLUMNS).to_dict()
+    return [
+        f"id: {id_}\n"
+        + f"Title: {title}\n"
+        + f"Author: {author}\n"
+        + f"Birth and Death Dates: {dates}\n"
+        + f"Views: {views}\n"
+        + f"Text: {text}\n"
+        + f"About: {about}"
+        for id_, title, author, dates, views, text, about in zip(
+            *[data[column] for column in COLUMNS]
+        )
+    ]
+
+
+def time_truncation(fn, texts, limit):
+    start = time.perf_counter()
+    results = [fn(text, limit) for text in texts]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-set", default=EMBEDDING_DATA_SET)
+    parser.add_argument("--limit", type=int, default=prompts.POEM_TOKEN_LIMIT)
+    args = parser.parse_args()
+
+    texts = load_poem_texts(args.data_set)
+    tokenizer.get_encoding()
+    over_limit = sum(tokenizer.num_tokens(text) > args.limit for text in texts)
+    print(f"{len(texts)} poems, {over_limit} over the {args.limit} token limit")
+
+    reference_seconds, expected = time_truncation(
+        reference_reduce_to_token_limit, texts, args.limit
+    )
+    seconds, results = time_truncation(
+        tokenizer.reduce_to_token_limit, texts, args.limit
+    )
+    differences = [
+        len(text) - len(result)
+        for result, text in zip(results, expected)
+        if result != text
+    ]
+    over = sum(tokenizer.num_tokens(result) > args.limit for result in results)
+    print(f"reference: {reference_seconds:.2f}s")
+    print(f"tokenizer: {seconds:.2f}s ({reference_seconds / seconds:.1f}x faster)")
+    print(f"prefixes over the limit: {over}")
+    print(
+        f"prefixes differing from the reference: {len(differences)}"
+        + (
+            f", by {min(differences)} to {max(differences)} characters"
+            if differences
+            else ""
+        )
+    )
+    if over:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
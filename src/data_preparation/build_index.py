@@ -0,0 +1,123 @@
+"""Module for building the serialized FAISS indexes loaded by the recommender.
+
+The exact index only needs the embedding matrix, which the recommender writes
+on first run. Approximate indexes (see embedding_index.py) are otherwise built
+lazily the first time a VectorSearch is configured to use them, which can take
+minutes for IVF-PQ, so production deployments should build them ahead of time:
+
+`python3 src/data_preparation/build_index.py --index-type ivf hnsw ivfpq`
+
+With `--prompt-blocks`, it also renders the per-poem prompt blocks stored
+alongside the index (see prompt_blocks.py), and with `--attributes` the poem
+attributes used for filtered search (see poem_filters.py), and with
+`--lexical` the BM25 keyword index (see lexical_index.py). With `--examples`,
+it builds the few-shot example bank (see few_shot.py) from the examples in
+prompts.INITIAL_PROMPT and any in `--example-file`, which embeds the
+examples' queries with the OpenAI API.
+"""
+import argparse
+import os
+import sys
+import time
+from datasets import load_dataset
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import embedding_index  # pylint: disable=wrong-import-position
+import few_shot  # pylint: disable=wrong-import-position
+import lexical_index  # pylint: disable=wrong-import-position
+import poem_filters  # pylint: disable=wrong-import-position
+import prompt_blocks  # pylint: disable=wrong-import-position
+import prompts  # pylint: disable=wrong-import-position
+
+EMBEDDING_DATA_SET = "pvd-dot/public-domain-poetry-with-embeddings"
+
+
+def build_examples(example_file, poem_token_limit):
+    import openai  # pylint: disable=import-outside-toplevel
+    import vector_searcher  # pylint: disable=import-outside-toplevel
+
+    client = openai.OpenAI()
+
+    def embed(texts):
+        response = client.embeddings.create(input=texts, model=vector_searcher.MODEL)
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+    examples = [
+        few_shot.Example(*example)
+        for example in prompts.parse_examples(prompts.INITIAL_PROMPT)
+    ]
+    if example_file:
+        examples += few_shot.load_examples(example_file)
+    start = time.perf_counter()
+    few_shot.build(embed, examples, poem_token_limit=poem_token_limit)
+    print(
+        f"built {len(examples)} few-shot examples in "
+        + f"{time.perf_counter() - start:.1f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--index-type",
+        nargs="+",
+        default=["flat"],
+        choices=list(embedding_index.INDEX_FACTORIES),
+    )
+    parser.add_argument("--nlist", type=int, default=embedding_index.DEFAULT_NLIST)
+    parser.add_argument("--hnsw-m", type=int, default=embedding_index.DEFAULT_HNSW_M)
+    parser.add_argument("--pq-m", type=int, default=embedding_index.DEFAULT_PQ_M)
+    parser.add_argument("--pca-dim", type=int, default=embedding_index.DEFAULT_PCA_DIM)
+    parser.add_argument("--prompt-blocks", action="store_true")
+    parser.add_argument("--attributes", action="store_true")
+    parser.add_argument("--lexical", action="store_true")
+    parser.add_argument("--examples", action="store_true")
+    parser.add_argument("--example-file", help="JSONL file of more examples")
+    parser.add_argument(
+        "--example-poem-tokens", type=int, default=few_shot.EXAMPLE_POEM_TOKEN_LIMIT
+    )
+    args = parser.parse_args()
+
+    if args.examples:
+        build_examples(args.example_file, args.example_poem_tokens)
+
+    if (
+        not embedding_index.exists()
+        or args.prompt_blocks
+        or args.attributes
+        or args.lexical
+    ):
+        data = load_dataset(EMBEDDING_DATA_SET, split="train")
+        if not embedding_index.exists():
+            embedding_index.build(data)
+        if args.prompt_blocks:
+            start = time.perf_counter()
+            prompt_blocks.build(data)
+            print(f"built prompt blocks in {time.perf_counter() - start:.1f}s")
+        if args.attributes:
+            start = time.perf_counter()
+            poem_filters.build(data)
+            print(f"built poem attributes in {time.perf_counter() - start:.1f}s")
+        if args.lexical:
+            start = time.perf_counter()
+            lexical_index.build(data)
+            print(f"built lexical index in {time.perf_counter() - start:.1f}s")
+    embeddings = embedding_index.load_embeddings()
+
+    for index_type in args.index_type:
+        factory_kwargs = {
+            "nlist": args.nlist,
+            "hnsw_m": args.hnsw_m,
+            "pq_m": args.pq_m,
+            "pca_dim": args.pca_dim,
+        }
+        factory = embedding_index.factory_string(index_type, **factory_kwargs)
+        start = time.perf_counter()
+        index = embedding_index.build_index(embeddings, index_type, **factory_kwargs)
+        index_path = embedding_index.index_path_for(factory)
+        embedding_index.write_index(index, index_path)
+        print(f"built {factory} in {time.perf_counter() - start:.1f}s -> {index_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,242 @@
 """Module for cleaning data set/adding embeddings/pushing modified dataset.
 
-Does not need to be run unless you intend on modifying the dataset and 
-pushing it to your own Hugging Face account."""
-from datasets import load_dataset
-import csv
-import json
+Does not need to be run unless you intend on modifying the dataset and
+pushing it to your own Hugging Face account. It also writes the memory-mapped
+embedding matrix, serialized FAISS index, precomputed prompt blocks, poem
+attributes and lexical index loaded by the recommender.
+
+The dataset is written as Parquet shards of `--shard-rows` poems each, in the
+layout of a Hugging Face dataset repository, to `--output`, and uploaded to
+the Hub only with `--push`. VectorSearch can load the output directory
+directly (e.g. with POEM_DATA_SET=data/data_with_embeddings). Each shard is
+built by one of `--workers` processes, which join the poems and embeddings
+by id one batch of `--batch-size` rows at a time: the poems are read as
+Arrow record batches from the memory-mapped source dataset, the embeddings
+from rows of the memory-mapped embedding matrix, and each batch is appended
+to the shard as a row group. Memory use therefore depends on the batch size
+and number of workers, not on the size of the corpus. Rows per second and
+peak RSS are reported at the end. Peak RSS also counts the pages of the
+memory-mapped inputs that were read, which the OS can drop at any time."""
+import argparse
+import os
+import resource
+import shutil
+import sys
+import time
+import multiprocessing
+import datasets
+import huggingface_hub
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import embedding_index  # pylint: disable=wrong-import-position
+import embedding_store  # pylint: disable=wrong-import-position
+import lexical_index  # pylint: disable=wrong-import-position
+import poem_filters  # pylint: disable=wrong-import-position
+import prompt_blocks  # pylint: disable=wrong-import-position
+import vector_searcher  # pylint: disable=wrong-import-position
 
 DATA_SET = "mkessle/public-domain-poetry"
 EMBEDDING_DATA_SET = "pvd-dot/public-domain-poetry-with-embeddings"
 DATA_SET_WITH_EMBEDDINGS_PATH = "data/data_with_embeddings"
 EMBEDDINGS_CSV_PATH = "data/embeddings.csv"
+EMBEDDINGS_NPY_PATH = "data/embeddings.npy"
 EMBEDDINGS_FAISS_PATH = "data/embeddings.faiss"
+SHARD_ROWS = 10000
+BATCH_SIZE = 1000
 
+# Set in each worker by init_worker.
+source = None
+embeddings = None
+features = None
 
-def main():
-    data = load_dataset(DATA_SET, split="train")
-
-    ids = list(range(len(data)))
-    data = data.add_column("id", ids)
-
-    embeddings_dct = {}
-    with open(EMBEDDINGS_CSV_PATH, "r", encoding="UTF-8") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            embeddings_dct[int(row["id"])] = json.loads(row["embedding"])
-
-    data_with_embeddings = data.map(
-        lambda row: {
-            "embedding": embeddings_dct[row["id"]],
-            "Poem Text": str(row["Poem Text"]).replace(
-                "�", "'"  # original dataset has some faulty encodings of "'"
+
+def output_features(source_features):
+    """The features of the output: the source's, then "id" and "embedding"."""
+    return datasets.Features(
+        {
+            **source_features,
+            "id": datasets.Value("int64"),
+            embedding_index.EMBEDDING_COLUMN: datasets.Sequence(
+                datasets.Value("float32")
             ),
-        },
+        }
+    )
+
+
+def init_worker(data_set, embeddings_path):
+    global source, embeddings, features  # pylint: disable=global-statement
+    source = vector_searcher.load_poems(data_set).with_format("arrow")
+    embeddings = embedding_index.load_embeddings(embeddings_path)
+    features = output_features(source.features)
+
+
+def build_batch(start, stop):
+    """Returns rows [start, stop) of the output as an Arrow table."""
+    table = source[start:stop]
+    text = table.column("Poem Text")
+    # original dataset has some faulty encodings of "'"
+    table = table.set_column(
+        table.schema.get_field_index("Poem Text"),
+        "Poem Text",
+        pc.replace_substring(text, "�", "'"),
     )
+    vectors = np.ascontiguousarray(embeddings[start:stop], dtype=np.float32)
+    dim = vectors.shape[1]
+    table = table.append_column(
+        "id", pa.array(np.arange(start, stop, dtype=np.int64))
+    ).append_column(
+        embedding_index.EMBEDDING_COLUMN,
+        pa.ListArray.from_arrays(
+            pa.array(np.arange(0, (stop - start + 1) * dim, dim, dtype=np.int32)),
+            pa.array(vectors.ravel()),
+        ),
+    )
+    return table.cast(features.arrow_schema)
+
+
+def write_shard(shard):
+    """Writes rows [start, stop) to `path`, one batch per row group, and
+    returns the number of rows and the worker's peak RSS in MB."""
+    path, start, stop, batch_size = shard
+    with pq.ParquetWriter(path + ".tmp", features.arrow_schema) as writer:
+        for batch_start in range(start, stop, batch_size):
+            writer.write_table(
+                build_batch(batch_start, min(stop, batch_start + batch_size))
+            )
+    os.replace(path + ".tmp", path)
+    return stop - start, peak_rss_mb()
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_shards(
+    data_set, embeddings_path, num_rows, output, workers, shard_rows, batch_size
+):
+    """Writes the dataset to `output` as Parquet shards, and returns the
+    largest peak RSS of the processes that wrote them."""
+    tmp_output = output + ".tmp"
+    shutil.rmtree(tmp_output, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_output, "data"))
+    num_shards = max(1, -(-num_rows // shard_rows))
+    shards = [
+        (
+            os.path.join(
+                tmp_output, "data", f"train-{i:05d}-of-{num_shards:05d}.parquet"
+            ),
+            i * shard_rows,
+            min(num_rows, (i + 1) * shard_rows),
+            batch_size,
+        )
+        for i in range(num_shards)
+    ]
+    start = time.perf_counter()
+    written = 0
+    peak = 0.0
 
-    data_with_embeddings.push_to_hub(EMBEDDING_DATA_SET)
+    def report(rows, worker_peak):
+        nonlocal written, peak
+        written += rows
+        peak = max(peak, worker_peak)
+        elapsed = time.perf_counter() - start
+        print(
+            f"wrote {written}/{num_rows} rows in {elapsed:.1f}s "
+            + f"({written / elapsed:.0f} rows/s)"
+        )
+
+    if workers == 1:
+        init_worker(data_set, embeddings_path)
+        for shard in shards:
+            report(*write_shard(shard))
+    else:
+        with multiprocessing.Pool(
+            workers, init_worker, (data_set, embeddings_path)
+        ) as pool:
+            for result in pool.imap_unordered(write_shard, shards):
+                report(*result)
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp_output, output)
+    return peak
+
+
+def push(output, repo_id):
+    """Uploads the shards to `repo_id`, replacing the previous ones."""
+    api = huggingface_hub.HfApi()
+    api.create_repo(repo_id, repo_type="dataset", exist_ok=True)
+    api.upload_folder(
+        folder_path=output,
+        repo_id=repo_id,
+        repo_type="dataset",
+        delete_patterns="data/*",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data-set", default=DATA_SET, help="source dataset")
+    parser.add_argument("--output", default=DATA_SET_WITH_EMBEDDINGS_PATH)
+    parser.add_argument(
+        "--embeddings",
+        help="existing embedding matrix (.npy) to use instead of the store",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--shard-rows", type=int, default=SHARD_ROWS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--push", action="store_true", help="upload the shards to --repo"
+    )
+    parser.add_argument("--repo", default=EMBEDDING_DATA_SET)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    num_rows = len(vector_searcher.load_poems(args.data_set))
+    embeddings_path = args.embeddings
+    if embeddings_path is None:
+        embeddings_path = EMBEDDINGS_NPY_PATH
+        store = embedding_store.EmbeddingStore()
+        if os.path.exists(EMBEDDINGS_CSV_PATH):
+            embedding_store.migrate_csv(EMBEDDINGS_CSV_PATH, store)
+        embedding_index.build_from_store(
+            store, num_rows, EMBEDDINGS_NPY_PATH, EMBEDDINGS_FAISS_PATH
+        )
+    elif len(embedding_index.load_embeddings(embeddings_path)) != num_rows:
+        sys.exit(
+            f"{embeddings_path} does not have one row for each of {num_rows} poems."
+        )
+
+    shards_start = time.perf_counter()
+    worker_peak = write_shards(
+        args.data_set,
+        embeddings_path,
+        num_rows,
+        args.output,
+        args.workers,
+        args.shard_rows,
+        args.batch_size,
+    )
+    shards_elapsed = time.perf_counter() - shards_start
+
+    data_with_embeddings = vector_searcher.load_poems(args.output)
+    prompt_blocks.build(data_with_embeddings)
+    poem_filters.build(data_with_embeddings)
+    lexical_index.build(data_with_embeddings)
+    if args.push:
+        push(args.output, args.repo)
+
+    print(
+        f"wrote {num_rows} rows to {args.output} in {shards_elapsed:.1f}s "
+        + f"({num_rows / shards_elapsed:.0f} rows/s) with {args.workers} workers, "
+        + f"{time.perf_counter() - start:.1f}s in total"
+    )
+    print(
+        f"peak RSS: {peak_rss_mb():.0f} MB main process, "
+        + f"{worker_peak:.0f} MB largest shard writer"
+    )
 
 
 if __name__ == "__main__":
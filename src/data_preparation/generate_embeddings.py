@@ -1,60 +1,57 @@
 """Module for generating embeddings for the poems in the data set.
 
-This module appends to a CSV file of poem embeddings. It will not 
-regenerate embeddings already present in the CSV. It runs workers on
-multiple threads to speed up the embedding generation process. If it is 
-interrupted or any errors are encountered, it can be re-run to generate 
+This module appends to the binary embedding store (see
+embedding_store.py), committing after every batch. It will not regenerate
+embeddings already committed to the store. A CSV of embeddings written by
+previous versions of this script is imported into the store until the
+import completes. Poems are packed into batches of up to BATCH_TOKEN_LIMIT
+tokens, each sent as one embeddings request, and batches are sent from
+multiple threads while staying within the requests-per-minute and
+tokens-per-minute limits of the account. If it
+is interrupted or any errors are encountered, it can be re-run to generate
 the remaining embeddings without re-doing work.
+
+The client honours the OPENAI_BASE_URL environment variable, so the whole
+pipeline can be exercised against a local stand-in embeddings server.
 """
+import argparse
 import os
-import tiktoken
+import random
+import sys
 import threading
+import time
 import concurrent.futures
 import dotenv
 from datasets import load_dataset
+import numpy as np
 import openai
-import csv
-import json
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import embedding_store  # pylint: disable=wrong-import-position
+import tokenizer  # pylint: disable=wrong-import-position
 
 DATA_SET = "mkessle/public-domain-poetry"
 EMBEDDINGS_CSV_PATH = "data/embeddings.csv"
 
-NUM_THREADS = 2
 MAX_EMBEDDINGS = 38521
 MODEL = "text-embedding-ada-002"
-TOKENIZER = "cl100k_base"
 TOKEN_LIMIT = 8192
+BATCH_TOKEN_LIMIT = 50000
+BATCH_SIZE_LIMIT = 512
+MAX_CONCURRENCY = 8
+REQUESTS_PER_MINUTE = 3000
+TOKENS_PER_MINUTE = 1000000
+MAX_RETRIES = 6
+BASE_BACKOFF_SECONDS = 1.0
+REPORT_INTERVAL_SECONDS = 10
 
 dotenv.load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-client = openai.OpenAI()
-data = load_dataset(DATA_SET, split=f"train[:{MAX_EMBEDDINGS}]")
 lock = threading.Lock()
 seen = set([])
 
 
-def num_tokens_from_string(string: str, encoding_name: str) -> int:
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
-
-
-def reduce_to_token_limit(text):
-    tokens = num_tokens_from_string(text, TOKENIZER)
-    if tokens <= TOKEN_LIMIT:
-        return text
-    start = 0
-    end = len(text)
-    while start <= end:
-        mid = (start + end) // 2
-        if num_tokens_from_string(text[:mid], TOKENIZER) <= TOKEN_LIMIT:
-            start = mid + 1
-        else:
-            end = mid - 1
-    return text[:end]
-
-
 def build_text(row):
     text = ""
     for col in row:
@@ -70,74 +67,216 @@ def build_text(row):
             val = val.strip()
         text += f"{col}: {val}\n"
 
-    return reduce_to_token_limit(text)
+    return tokenizer.reduce_to_token_limit(text, TOKEN_LIMIT)
 
 
-def generate_embedding(worker_id, writer):
-    count = 0
-    failures = 0
-    total = sum(
-        [1 for k in range(len(data)) if k % NUM_THREADS == worker_id and k not in seen]
-    )
-    print(f"worker {worker_id} has {total} remaining embeddings to generate.")
+def build_batches(data, skip=()):
+    """Packs the poems whose ids are not in `skip` into batches of (ids,
+    texts, tokens).
+
+    Each batch holds at most BATCH_SIZE_LIMIT poems and BATCH_TOKEN_LIMIT
+    tokens, so that one request never exceeds the per-request limits."""
+    batches = []
+    ids, texts, batch_tokens = [], [], 0
     for k in range(len(data)):
-        if k % NUM_THREADS == worker_id and k not in seen:
-            try:
-                embedding = (
-                    client.embeddings.create(input=[build_text(data[k])], model=MODEL)
-                    .data[0]
-                    .embedding
-                )
-                with lock:
-                    writer.writerow({"id": k, "embedding": json.dumps(embedding)})
-                    seen.add(k)
-                    count += 1
-            except Exception as exc:  # pylint: disable=broad-except
-                print(
-                    f"worker {worker_id} generated an exception"
-                    + f" for row {k} (poem: data[]): {exc}"
-                )
-                failures += 1
-            if count > 0 and count % 1000 == 0:
-                print(
-                    f"worker {worker_id} has generated {count} embeddings"
-                    + f" out of {total} with {failures} failures."
+        if k in skip:
+            continue
+        text = build_text(data[k])
+        num_tokens = tokenizer.num_tokens(text)
+        if ids and (
+            batch_tokens + num_tokens > BATCH_TOKEN_LIMIT
+            or len(ids) == BATCH_SIZE_LIMIT
+        ):
+            batches.append((ids, texts, batch_tokens))
+            ids, texts, batch_tokens = [], [], 0
+        ids.append(k)
+        texts.append(text)
+        batch_tokens += num_tokens
+    if ids:
+        batches.append((ids, texts, batch_tokens))
+    return batches
+
+
+class RateLimiter:
+    """Keeps requests within per-minute request/token limits and adapts
+    how many are in flight.
+
+    Requests and tokens are drawn from two token buckets that refill at the
+    per-minute limits. Concurrency is additive-increase/multiplicative-
+    decrease: it is halved whenever the API answers with a 429, and grows
+    back by one request for every `concurrency` successful requests."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency):
+        self.limits = (requests_per_minute, tokens_per_minute)
+        self.available = list(self.limits)
+        self.updated = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, num_tokens):
+        needed = (1, min(num_tokens, self.limits[1]))
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                for i, limit in enumerate(self.limits):
+                    self.available[i] = min(
+                        limit, self.available[i] + (now - self.updated) * limit / 60
+                    )
+                self.updated = now
+                waits = [
+                    (need - available) * 60 / limit
+                    for need, available, limit in zip(
+                        needed, self.available, self.limits
+                    )
+                ]
+                if self.in_flight < int(self.concurrency) and max(waits) <= 0:
+                    self.available[0] -= needed[0]
+                    self.available[1] -= needed[1]
+                    self.in_flight += 1
+                    return
+                self.condition.wait(timeout=max(*waits, 0.05))
+
+    def release(self, rate_limited=False):
+        with self.condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.concurrency = max(1.0, self.concurrency / 2)
+            else:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
                 )
+            self.condition.notify_all()
 
-    print(
-        f"worker {worker_id} has finished generating all {count} remaining embeddings."
-    )
 
+class Progress:
+    """Counts embedded poems and tokens, and reports throughput."""
+
+    def __init__(self, total):
+        self.total = total
+        self.embedded = 0
+        self.tokens = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def report(self, limiter, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report < REPORT_INTERVAL_SECONDS:
+            return
+        self.last_report = now
+        elapsed = max(now - self.start, 1e-9)
+        print(
+            f"embedded {self.embedded}/{self.total} poems in {elapsed:.0f}s "
+            + f"({self.embedded / elapsed:.1f} poems/s, "
+            + f"{self.tokens * 60 / elapsed:.0f} tokens/min, "
+            + f"{self.requests * 60 / elapsed:.0f} requests/min), "
+            + f"concurrency {int(limiter.concurrency)}, "
+            + f"{self.rate_limited} rate limited, {self.failures} failed"
+        )
 
-def generate_all_embeddings():
-    with open(EMBEDDINGS_CSV_PATH, "a+", encoding="UTF-8") as file:
-        newfile = os.path.getsize(EMBEDDINGS_CSV_PATH) == 0
-        if not newfile:
-            file.seek(0)
-            reader = csv.DictReader(file)
-            for row in reader:
-                seen.add(int(row["id"]))
 
-        writer = csv.DictWriter(file, fieldnames=["id", "embedding"])
-        if newfile:
-            writer.writeheader()
+def backoff_seconds(exc, attempt):
+    retry_after = exc.response.headers.get("retry-after")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return BASE_BACKOFF_SECONDS * 2**attempt * (1 + random.random())
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
-            future_to_worker = {
-                executor.submit(generate_embedding, worker_id, writer): worker_id
-                for worker_id in range(NUM_THREADS)
-            }
 
-            for future in concurrent.futures.as_completed(future_to_worker):
-                worker_id = future_to_worker[future]
-                try:
-                    future.result()
-                except Exception as exc:  # pylint: disable=broad-except
-                    print(f"worker {worker_id} generated an exception: {exc}")
+def request_embeddings(client, batch, limiter, progress):
+    """Embeds the texts of a batch, waiting for `limiter` before each
+    request and retrying with backoff when the API answers with a 429."""
+    _, texts, num_tokens = batch
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire(num_tokens)
+        try:
+            response = client.embeddings.create(input=texts, model=MODEL)
+        except openai.RateLimitError as exc:
+            limiter.release(rate_limited=True)
+            with lock:
+                progress.rate_limited += 1
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(backoff_seconds(exc, attempt))
+            continue
+        except Exception:
+            limiter.release()
+            raise
+        limiter.release()
+        with lock:
+            progress.embedded += len(texts)
+            progress.tokens += num_tokens
+            progress.requests += 1
+        embeddings = sorted(response.data, key=lambda d: d.index)
+        return np.array([d.embedding for d in embeddings], dtype=np.float32)
+
+
+def embed_batch(client, batch, store, limiter, progress):
+    ids = batch[0]
+    embeddings = request_embeddings(client, batch, limiter, progress)
+    with lock:
+        store.append(ids, embeddings)
+        store.commit()
+        seen.update(ids)
+
+
+def generate_all_embeddings(
+    data,
+    requests_per_minute=REQUESTS_PER_MINUTE,
+    tokens_per_minute=TOKENS_PER_MINUTE,
+    max_concurrency=MAX_CONCURRENCY,
+):
+    # Retries are handled by request_embeddings, which also adapts the concurrency.
+    client = openai.OpenAI(max_retries=0)
+    store = embedding_store.EmbeddingStore()
+    if os.path.exists(EMBEDDINGS_CSV_PATH):
+        imported = embedding_store.migrate_csv(EMBEDDINGS_CSV_PATH, store)
+        if imported:
+            print(f"Imported {imported} embeddings from {EMBEDDINGS_CSV_PATH}.")
+    seen.update(store.ids().tolist())
+
+    batches = build_batches(data, seen)
+    progress = Progress(sum(len(batch[0]) for batch in batches))
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute, max_concurrency)
+    print(
+        f"{progress.total} remaining embeddings to generate "
+        + f"in {len(batches)} batches."
+    )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [
+            executor.submit(embed_batch, client, batch, store, limiter, progress)
+            for batch in batches
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                print(f"batch generated an exception: {exc}")
+                with lock:
+                    progress.failures += 1
+            progress.report(limiter)
+    store.close()
+    progress.report(limiter, force=True)
 
 
 def main():
-    generate_all_embeddings()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests-per-minute", type=int, default=REQUESTS_PER_MINUTE)
+    parser.add_argument("--tokens-per-minute", type=int, default=TOKENS_PER_MINUTE)
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY)
+    args = parser.parse_args()
+
+    data = load_dataset(DATA_SET, split=f"train[:{MAX_EMBEDDINGS}]")
+    generate_all_embeddings(
+        data, args.requests_per_minute, args.tokens_per_minute, args.max_concurrency
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+"""Module for adding poems to the corpus without rebuilding the dataset.
+
+`add` embeds the poems in a JSONL file, one object per poem with the
+dataset's columns ("Title", "Author" and "Poem Text", and optionally
+"Views", "About" and "Birth and Death Dates"), the same way as
+generate_embeddings.py, and writes them as a new corpus segment (see
+corpus_segments.py). Running servers and bots start serving them within
+vector_searcher.SEGMENT_POLL_SECONDS, and new processes load them at
+startup:
+
+`python3 src/data_preparation/update_corpus.py add new_poems.jsonl`
+
+`compact` merges the segments into one. With `--every SECONDS` it keeps
+running and compacts on that interval, as a background job next to the
+servers:
+
+`python3 src/data_preparation/update_corpus.py compact --every 600`
+
+Segments follow the dataset they were added to. Folding them into the
+dataset itself takes a full run of generate_embeddings.py and
+generate_dataset.py, after which data/segments must be removed.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import datasets
+import numpy as np
+import openai
+
+import generate_embeddings
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "recommender"))
+import corpus_segments  # pylint: disable=wrong-import-position
+import vector_searcher  # pylint: disable=wrong-import-position
+
+# Features of the segment metadata, so that every segment can be merged.
+FEATURES = datasets.Features(
+    {
+        "Title": datasets.Value("string"),
+        "Author": datasets.Value("string"),
+        "Poem Text": datasets.Value("string"),
+        "Views": datasets.Value("int64"),
+        "About": datasets.Value("string"),
+        "Birth and Death Dates": datasets.Value("string"),
+    }
+)
+
+
+def load_poems(path):
+    """Reads the poems of a JSONL file into a Dataset with FEATURES."""
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records:
+        raise ValueError(f"{path} has no poems.")
+    for record in records:
+        for column in ["Title", "Author", "Poem Text"]:
+            if not record.get(column):
+                raise ValueError(f"A poem in {path} has no {column!r}: {record}")
+    return datasets.Dataset.from_dict(
+        {
+            column: [
+                record.get(column, 0 if column == "Views" else "") for record in records
+            ]
+            for column in FEATURES
+        },
+        features=FEATURES,
+    )
+
+
+def embed_poems(data):
+    """Embeds the poems with the text and model of generate_embeddings.py,
+    in its token-limited batches, sent concurrently within its rate limits
+    and retried when rate limited."""
+    # Retries are handled by request_embeddings, which also adapts the
+    # concurrency.
+    client = openai.OpenAI(max_retries=0)
+    batches = generate_embeddings.build_batches(data)
+    progress = generate_embeddings.Progress(len(data))
+    limiter = generate_embeddings.RateLimiter(
+        generate_embeddings.REQUESTS_PER_MINUTE,
+        generate_embeddings.TOKENS_PER_MINUTE,
+        generate_embeddings.MAX_CONCURRENCY,
+    )
+    embeddings = [None] * len(data)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=generate_embeddings.MAX_CONCURRENCY
+    ) as executor:
+        futures = {
+            executor.submit(
+                generate_embeddings.request_embeddings,
+                client,
+                batch,
+                limiter,
+                progress,
+            ): batch[0]
+            for batch in batches
+        }
+        for future in concurrent.futures.as_completed(futures):
+            for k, embedding in zip(futures[future], future.result()):
+                embeddings[k] = embedding
+            progress.report(limiter)
+    progress.report(limiter, force=True)
+    return np.stack(embeddings)
+
+
+def add(path, data_set):
+    start = time.perf_counter()
+    data = load_poems(path)
+    base_rows = len(vector_searcher.load_poems(data_set))
+    first_id = corpus_segments.add(data, embed_poems(data), base_rows)
+    print(
+        f"added {len(data)} poems with ids {first_id}-{first_id + len(data) - 1} "
+        + f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+def compact(min_segments, every):
+    while True:
+        start = time.perf_counter()
+        merged = corpus_segments.compact(min_segments=min_segments)
+        if merged:
+            print(f"merged {merged} segments in {time.perf_counter() - start:.1f}s")
+        if every is None:
+            return
+        time.sleep(every)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    add_parser = commands.add_parser("add", help="add the poems in a JSONL file")
+    add_parser.add_argument("poems", help="JSONL file of poems")
+    add_parser.add_argument("--data-set", help="dataset name or directory")
+    compact_parser = commands.add_parser("compact", help="merge the segments")
+    compact_parser.add_argument(
+        "--min-segments", type=int, default=corpus_segments.DEFAULT_MIN_SEGMENTS
+    )
+    compact_parser.add_argument(
+        "--every", type=float, help="keep compacting every this many seconds"
+    )
+    args = parser.parse_args()
+
+    if args.command == "add":
+        add(args.poems, args.data_set)
+    else:
+        compact(args.min_segments, args.every)
+
+
+if __name__ == "__main__":
+    main()
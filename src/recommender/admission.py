@@ -0,0 +1,192 @@
+"""Module for admission control in front of the async recommender.
+
+A burst of requests can come from one user flooding the bot, or from many
+users posting the same popular request at once, and every request that is
+run costs an embeddings call and a chat completion. Three mechanisms keep
+latency and spend predictable:
+
+- RateLimiter holds a token bucket per user and one shared by everyone. A
+  request is admitted only if both have a token left.
+- SingleFlight coalesces identical requests that are in flight at the same
+  time. Only the first runs the pipeline, and the others follow its stream
+  of updates.
+- WorkQueue bounds the number of pipelines running and waiting to run, and
+  rejects requests beyond that with QueueFull instead of queueing them
+  without bound.
+
+Everything here runs on one event loop, so no locks are needed."""
+import asyncio
+import collections
+import time
+
+DEFAULT_USER_RATE = 1 / 20
+DEFAULT_USER_BURST = 3
+DEFAULT_GLOBAL_RATE = 1.0
+DEFAULT_GLOBAL_BURST = 20
+DEFAULT_MAX_USERS = 10000
+DEFAULT_MAX_RUNNING = 8
+DEFAULT_MAX_WAITING = 16
+
+# Why a request was not admitted, and how many seconds until it would be.
+Rejection = collections.namedtuple("Rejection", ["scope", "retry_after"])
+
+
+class QueueFull(Exception):
+    """Raised when a WorkQueue has no room for another request."""
+
+
+class TokenBucket:
+    """Allows bursts of up to `capacity` requests, refilled at `rate`
+    requests per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self):
+        """Returns the seconds until a token is available, after refill."""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Per-user and global token buckets. Buckets of the least recently
+    seen users are dropped beyond `max_users`, which resets them to full."""
+
+    def __init__(
+        self,
+        user_rate=DEFAULT_USER_RATE,
+        user_burst=DEFAULT_USER_BURST,
+        global_rate=DEFAULT_GLOBAL_RATE,
+        global_burst=DEFAULT_GLOBAL_BURST,
+        max_users=DEFAULT_MAX_USERS,
+    ):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.users = collections.OrderedDict()
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+
+    def check(self, user_id):
+        """Takes a token for `user_id` and returns None if the request is
+        admitted, or a Rejection without taking any token otherwise."""
+        now = time.monotonic()
+        bucket = self.users.pop(user_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+        self.users[user_id] = bucket
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+        bucket.refill(now)
+        self.global_bucket.refill(now)
+        if bucket.tokens < 1:
+            return Rejection("user", bucket.retry_after())
+        if self.global_bucket.tokens < 1:
+            return Rejection("global", self.global_bucket.retry_after())
+        bucket.tokens -= 1
+        self.global_bucket.tokens -= 1
+        return None
+
+
+class _Flight:
+    """The latest update of one in-flight stream, and whether it is done."""
+
+    def __init__(self):
+        self.latest = None
+        self.version = 0
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Condition()
+        self.task = None
+
+
+class SingleFlight:
+    """Shares one run of a stream of updates between identical requests.
+
+    `stream(key, start)` runs `start()`, an async iterator of updates, if no
+    stream with `key` is in flight, and otherwise follows the one that is.
+    Updates are cumulative (each one replaces the one before), so a
+    follower that falls behind skips to the latest update, and a follower
+    that joins late starts from it. The stream runs in its own task, so it
+    completes even if the request that started it goes away."""
+
+    def __init__(self):
+        self.flights = {}
+        self.coalesced = 0
+
+    async def stream(self, key, start):
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self.flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, start))
+        else:
+            self.coalesced += 1
+        seen = 0
+        while True:
+            async with flight.changed:
+                await flight.changed.wait_for(
+                    lambda: flight.version > seen or flight.done
+                )
+                latest, version, done = flight.latest, flight.version, flight.done
+            if version > seen:
+                seen = version
+                yield latest
+            if done:
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+    async def _run(self, key, flight, start):
+        try:
+            async for update in start():
+                async with flight.changed:
+                    flight.latest = update
+                    flight.version += 1
+                    flight.changed.notify_all()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            flight.error = e
+        finally:
+            del self.flights[key]
+            async with flight.changed:
+                flight.done = True
+                flight.changed.notify_all()
+
+
+class WorkQueue:
+    """Runs at most `max_running` streams at once, with up to
+    `max_waiting` more waiting for a turn."""
+
+    def __init__(
+        self, max_running=DEFAULT_MAX_RUNNING, max_waiting=DEFAULT_MAX_WAITING
+    ):
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.semaphore = asyncio.Semaphore(max_running)
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    async def stream(self, start):
+        """Yields from `start()`, an async iterator, once it has a turn.
+        Raises QueueFull if the queue is full."""
+        if self.running + self.waiting >= self.max_running + self.max_waiting:
+            self.rejected += 1
+            raise QueueFull()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            async for update in start():
+                yield update
+        finally:
+            self.running -= 1
+            self.semaphore.release()
@@ -1,12 +1,16 @@
 """Module to interface with OpenAI's Chat API using the ChatGPT class."""
 import collections
 import datetime
-import io
 import os
 import openai
 import dotenv
 
+import telemetry
+
 MODEL = "gpt-3.5-turbo-1106"
+# Seconds to wait for the API when opening connections (see warm), without
+# retries, so that an unreachable API cannot hold up startup.
+WARM_TIMEOUT_SECONDS = 3.0
 
 dotenv.load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -20,31 +24,132 @@ class ChatGPT:
     This class provides methods to send messages to the GPT-3.5 model and
     receive responses, maintaining the state of a conversation. It supports
     debug logging, message history tracking, and system message configuration.
-    """
+
+    Debug logs are formatted and appended to the log file by a background
+    writer (see telemetry.AsyncWriter), so logging does not add file I/O or
+    string building to the request."""
 
     def __init__(self, debug: bool = False, system_message: Message = None):
         self.debug = debug
         self.client = openai.OpenAI(timeout=60)
+        self.async_client = openai.AsyncOpenAI(timeout=60)
         self.debug_log_filename = (
             "logs/chatgpt-"
             + f"{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
             + " -debug.log"
         )
+        self.debug_writer = None
+        if debug:
+            self.debug_writer = telemetry.AsyncWriter(
+                self.debug_log_filename, self._format_debug_log
+            )
         self.system_message = system_message
         self.messages = []
 
     def respond(self, message) -> str:
+        """Responds to `message` as the next turn of the stored conversation.
+
+        This mutates self.messages, so a ChatGPT instance used this way must
+        not be shared between concurrent requests; use complete instead."""
+        response_message = self.complete(self.build_messages(message, self.messages))
         self.add_user_message(message)
+        self.add_assistant_message(response_message)
+        return response_message
+
+    async def arespond(self, message, history=()) -> str:
+        """Async, stateless variant of respond.
+
+        The conversation for this call is built from the system message,
+        `history` and `message`, and is discarded afterwards."""
+        return await self.acomplete(self.build_messages(message, history))
+
+    def warm(self):
+        """Opens the connection to the chat API before the first request.
+        This is best effort, so failures are ignored."""
+        try:
+            self.client.with_options(
+                timeout=WARM_TIMEOUT_SECONDS, max_retries=0
+            ).models.retrieve(MODEL)
+        except openai.OpenAIError:
+            pass
+
+    async def awarm(self):
+        try:
+            await self.async_client.with_options(
+                timeout=WARM_TIMEOUT_SECONDS, max_retries=0
+            ).models.retrieve(MODEL)
+        except openai.OpenAIError:
+            pass
+
+    def complete(self, messages, trace=telemetry.NULL_TRACE) -> str:
+        """Returns the model's reply to `messages` without storing anything,
+        so one instance can serve concurrent requests from many threads.
+
+        The token usage reported by the API is recorded in `trace`."""
+        response = self.client.chat.completions.create(
+            model=MODEL,
+            messages=[m._asdict() for m in messages],
+        )
+        return self._handle_response(messages, response, trace)
+
+    async def acomplete(self, messages, trace=telemetry.NULL_TRACE) -> str:
+        response = await self.async_client.chat.completions.create(
+            model=MODEL,
+            messages=[m._asdict() for m in messages],
+        )
+        return self._handle_response(messages, response, trace)
+
+    def stream(self, messages):
+        """Like complete, but yields the reply in chunks as they arrive."""
         response = self.client.chat.completions.create(
             model=MODEL,
-            messages=self.get_messages(),
+            messages=[m._asdict() for m in messages],
+            stream=True,
+        )
+        chunks = []
+        for chunk in response:  # pylint: disable=not-an-iterable
+            content = chunk.choices[0].delta.content if chunk.choices else None
+            if content:
+                chunks.append(content)
+                yield content
+        self._log_response(messages, "".join(chunks))
+
+    async def astream(self, messages):
+        response = await self.async_client.chat.completions.create(
+            model=MODEL,
+            messages=[m._asdict() for m in messages],
+            stream=True,
         )
+        chunks = []
+        async for chunk in response:
+            content = chunk.choices[0].delta.content if chunk.choices else None
+            if content:
+                chunks.append(content)
+                yield content
+        self._log_response(messages, "".join(chunks))
+
+    def _handle_response(self, messages, response, trace=telemetry.NULL_TRACE):
         response_message = response.choices[0].message.content
-        self.add_assistant_message(response_message)
+        if getattr(response, "usage", None) is not None:
+            trace.set(
+                prompt_tokens=response.usage.prompt_tokens,
+                completion_tokens=response.usage.completion_tokens,
+            )
+        self._log_response(messages, response_message)
+        return response_message
+
+    def _log_response(self, messages, response_message):
         if self.debug:
-            self.debug_log(self.messages_to_string())
+            self.debug_log((*messages, Message("assistant", response_message)))
 
-        return response_message
+    def build_messages(self, message, history=(), system_message=None):
+        """Returns an immutable message tuple for a single request, with
+        `system_message` in place of the stored one if given."""
+        messages = (*history, Message("user", message))
+        system_message = system_message or self.system_message
+        if system_message is not None:
+            messages = (system_message, *messages)
+        return messages
 
     def get_messages(self):
         messages = self.messages
@@ -52,10 +157,11 @@ class ChatGPT:
             messages = [self.system_message] + messages
         return [m._asdict() for m in messages]
 
-    def messages_to_string(self):
-        messages = self.messages
-        if self.system_message is not None:
-            messages = [self.system_message] + messages
+    def messages_to_string(self, messages=None):
+        if messages is None:
+            messages = self.messages
+            if self.system_message is not None:
+                messages = [self.system_message] + messages
         return "\n".join([f"{m.role}: {m.content}" for m in messages])
 
     def add_message(self, role: str, content: str):
@@ -78,5 +184,14 @@ class ChatGPT:
             print(f"{message.role}: {message.content}")
 
     def debug_log(self, text):
-        with io.open(self.debug_log_filename, "a", encoding="utf-8") as f:
-            f.write(text + "\n")
+        """Queues `text`, or a sequence of Messages, for the debug log."""
+        if self.debug_writer is None:
+            self.debug_writer = telemetry.AsyncWriter(
+                self.debug_log_filename, self._format_debug_log
+            )
+        self.debug_writer.write(text)
+
+    def _format_debug_log(self, record):
+        if not isinstance(record, str):
+            record = self.messages_to_string(record)
+        return record + "\n"
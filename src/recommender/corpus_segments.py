@@ -0,0 +1,354 @@
+"""Module for append-only corpus segments searched alongside the dataset.
+
+Adding poems to the Hugging Face dataset means rewriting and re-pushing all
+of it, and rebuilding every artifact aligned to poem id. Instead, new poems
+are written as a segment: a directory holding their metadata (an Arrow
+dataset saved to disk), their embedding matrix, poem attributes and lexical
+index, built from those poems alone. Segments are never modified once
+written. The poems of a segment have consecutive ids after those of the
+dataset and of earlier segments, so ids stay stable, and row i of a segment
+is the poem with id `first_id + i`. The attributes and lexical index of a
+segment are indexed by row rather than id.
+
+The segments are listed in SEGMENTS_DIR/manifest.json, which is replaced
+atomically, with a version that is incremented on every change, so a
+process can pick up new segments by polling it (see SegmentSet.refresh).
+Writers hold an exclusive lock on SEGMENTS_DIR/manifest.lock while
+changing it, and compactions hold SEGMENTS_DIR/compact.lock throughout, so
+that only one runs at a time.
+
+Searching one small exact index per segment gets slower as segments
+accumulate, so compact merges them into one. The merged segments are
+retired rather than deleted, and only removed RETIRED_GRACE_SECONDS later,
+so that processes still reading the previous manifest can open them.
+Processes that have opened them keep reading them after removal, since
+their files are memory-mapped.
+
+Add poems and compact with `python3 src/data_preparation/update_corpus.py`.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import time
+from datasets import concatenate_datasets, load_from_disk
+import numpy as np
+
+import embedding_index
+import lexical_index
+import poem_filters
+
+SEGMENTS_DIR = "data/segments"
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = "manifest.lock"
+COMPACT_LOCK_NAME = "compact.lock"
+METADATA_NAME = "metadata"
+EMBEDDINGS_NAME = "embeddings.npy"
+ATTRIBUTES_NAME = "poem_attributes.npz"
+LEXICAL_INDEX_NAME = "lexical_index"
+DEFAULT_MIN_SEGMENTS = 2
+RETIRED_GRACE_SECONDS = 600
+
+
+def exists(path=SEGMENTS_DIR):
+    return os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def read_manifest(path=SEGMENTS_DIR):
+    """Returns the manifest, or None if no segment has been added."""
+    try:
+        with open(os.path.join(path, MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_manifest(path, manifest):
+    manifest["version"] += 1
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+@contextlib.contextmanager
+def _locked(path, lock_name=LOCK_NAME):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, lock_name), "a", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _segment_name(first_id, rows):
+    return f"segment-{first_id:09d}-{first_id + rows:09d}"
+
+
+def _write_segment(segment_path, data, embeddings):
+    """Writes a segment of the poems in `data` (a Dataset with poem ids) and
+    their embeddings, given as a list of matrices in row order, which are
+    copied one at a time into the segment's matrix."""
+    tmp_path = segment_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    matrix = np.lib.format.open_memmap(
+        os.path.join(tmp_path, EMBEDDINGS_NAME),
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(data), embeddings[0].shape[1]),
+    )
+    start = 0
+    for batch in embeddings:
+        matrix[start : start + len(batch)] = batch
+        start += len(batch)
+    if start != len(data):
+        raise ValueError(f"{len(data)} poems but {start} embeddings.")
+    matrix.flush()
+    del matrix
+    rows = data.remove_columns("id").add_column("id", list(range(len(data))))
+    poem_filters.build(rows, os.path.join(tmp_path, ATTRIBUTES_NAME))
+    lexical_index.build(rows, os.path.join(tmp_path, LEXICAL_INDEX_NAME))
+    data.save_to_disk(os.path.join(tmp_path, METADATA_NAME))
+    # Left over from a run interrupted before the manifest listed it.
+    shutil.rmtree(segment_path, ignore_errors=True)
+    os.replace(tmp_path, segment_path)
+
+
+def add(data, embeddings, base_rows, path=SEGMENTS_DIR):
+    """Writes the poems in `data` (a Dataset with the poem columns except
+    "id") and their `embeddings` as a new segment, and returns the id of
+    its first poem. `base_rows` is the number of poems in the dataset,
+    which must not change while there are segments."""
+    with _locked(path):
+        manifest = read_manifest(path) or {
+            "version": 0,
+            "base_rows": base_rows,
+            "next_id": base_rows,
+            "segments": [],
+            "retired": [],
+        }
+        if manifest["base_rows"] != base_rows:
+            raise ValueError(
+                f"The segments in {path} follow a dataset of "
+                + f"{manifest['base_rows']} poems, not {base_rows}."
+            )
+        first_id = manifest["next_id"]
+        name = _segment_name(first_id, len(data))
+        data = data.add_column("id", list(range(first_id, first_id + len(data))))
+        _write_segment(
+            os.path.join(path, name), data, [np.asarray(embeddings, np.float32)]
+        )
+        manifest["segments"].append(
+            {"name": name, "first_id": first_id, "rows": len(data)}
+        )
+        manifest["next_id"] += len(data)
+        _write_manifest(path, manifest)
+    return first_id
+
+
+def compact(
+    path=SEGMENTS_DIR,
+    min_segments=DEFAULT_MIN_SEGMENTS,
+    grace_seconds=RETIRED_GRACE_SECONDS,
+):
+    """Merges the segments into one if there are at least `min_segments`,
+    and removes segments retired more than `grace_seconds` ago. Returns the
+    number of segments merged.
+
+    The merged segment is written without holding the manifest lock, so
+    poems can be added meanwhile; those segments are left for the next
+    compaction. Compactions wait for each other, so a second one only sees
+    the manifest after the first has published its segment."""
+    if read_manifest(path) is None:
+        return 0
+    with _locked(path, COMPACT_LOCK_NAME):
+        return _compact(path, min_segments, grace_seconds)
+
+
+def _compact(path, min_segments, grace_seconds):
+    manifest = read_manifest(path)
+    _remove_retired(path, grace_seconds)
+    entries = manifest["segments"]
+    if len(entries) < min_segments or len(entries) < 2:
+        return 0
+    first_id = entries[0]["first_id"]
+    rows = sum(entry["rows"] for entry in entries)
+    name = _segment_name(first_id, rows)
+    segment_paths = [os.path.join(path, entry["name"]) for entry in entries]
+    _write_segment(
+        os.path.join(path, name),
+        concatenate_datasets(
+            [load_from_disk(os.path.join(p, METADATA_NAME)) for p in segment_paths]
+        ),
+        [
+            embedding_index.load_embeddings(os.path.join(p, EMBEDDINGS_NAME))
+            for p in segment_paths
+        ],
+    )
+    with _locked(path):
+        manifest = read_manifest(path)
+        names = [entry["name"] for entry in manifest["segments"]]
+        if names[: len(entries)] != [entry["name"] for entry in entries]:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+            return 0
+        manifest["segments"] = [
+            {"name": name, "first_id": first_id, "rows": rows}
+        ] + manifest["segments"][len(entries) :]
+        manifest["retired"] += [
+            {"name": entry["name"], "retired_at": time.time()} for entry in entries
+        ]
+        _write_manifest(path, manifest)
+    return len(entries)
+
+
+def _remove_retired(path, grace_seconds):
+    with _locked(path):
+        manifest = read_manifest(path)
+        cutoff = time.time() - grace_seconds
+        expired = [r for r in manifest["retired"] if r["retired_at"] <= cutoff]
+        if not expired:
+            return
+        for retired in expired:
+            shutil.rmtree(os.path.join(path, retired["name"]), ignore_errors=True)
+        manifest["retired"] = [r for r in manifest["retired"] if r not in expired]
+        _write_manifest(path, manifest)
+
+
+class Segment:
+    """One segment's metadata, embeddings, attributes and lexical index."""
+
+    def __init__(self, segment_path, first_id):
+        self.first_id = first_id
+        self.metadata = load_from_disk(os.path.join(segment_path, METADATA_NAME))
+        self.index = embedding_index.EmbeddingIndex(
+            "flat", embeddings_path=os.path.join(segment_path, EMBEDDINGS_NAME)
+        )
+        self.attributes = poem_filters.PoemAttributes(
+            os.path.join(segment_path, ATTRIBUTES_NAME)
+        )
+        self.lexical_index = lexical_index.LexicalIndex(
+            os.path.join(segment_path, LEXICAL_INDEX_NAME)
+        )
+
+    def __len__(self):
+        return len(self.metadata)
+
+
+class SegmentSet:
+    """The segments listed in one version of the manifest.
+
+    A SegmentSet is never modified, so a search that takes it once sees one
+    consistent set of segments even if a newer set replaces it meanwhile."""
+
+    def __init__(self, base_rows, path=SEGMENTS_DIR, manifest=None, previous=None):
+        self.base_rows = base_rows
+        self.path = path
+        if manifest is None:
+            manifest = read_manifest(path)
+        self.version = None
+        self.by_name = {}
+        self.segments = []
+        self.first_ids = np.zeros(0, dtype=np.int64)
+        if manifest is None:
+            return
+        if manifest["base_rows"] != base_rows:
+            raise ValueError(
+                f"The segments in {path} follow a dataset of "
+                + f"{manifest['base_rows']} poems, not {base_rows}."
+            )
+        self.version = manifest["version"]
+        opened = {} if previous is None else previous.by_name
+        self.by_name = {
+            entry["name"]: opened.get(entry["name"])
+            or Segment(os.path.join(path, entry["name"]), entry["first_id"])
+            for entry in manifest["segments"]
+        }
+        self.segments = list(self.by_name.values())
+        self.first_ids = np.array([s.first_id for s in self.segments], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def num_poems(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def refresh(self):
+        """Returns the SegmentSet of the current manifest, which is this one
+        if the manifest has not changed. Segments that are still listed are
+        reused rather than opened again."""
+        manifest = read_manifest(self.path)
+        if manifest is None or manifest["version"] == self.version:
+            return self
+        return SegmentSet(self.base_rows, self.path, manifest, previous=self)
+
+    def masks(self, poem_filter):
+        """Returns each segment's mask of poems matching `poem_filter`."""
+        return [segment.attributes.mask(poem_filter) for segment in self.segments]
+
+    def search(self, query_embeddings, k, masks=None):
+        """Returns the distances and ids of the `k` nearest poems across the
+        segments, among those where `masks` are True if given."""
+        results = []
+        for i, segment in enumerate(self.segments):
+            distances, ids = segment.index.search(
+                query_embeddings,
+                min(k, len(segment)),
+                None if masks is None else masks[i],
+            )
+            results.append((distances, np.where(ids >= 0, ids + segment.first_id, -1)))
+        return embedding_index.merge(results, k)
+
+    def lexical_search(self, query, k, masks=None, collection=None):
+        """Returns the BM25 scores and ids of the `k` best matching poems
+        across the segments, with the statistics of `collection` (see
+        lexical_index.LexicalIndex.top)."""
+        results = []
+        for i, segment in enumerate(self.segments):
+            scores, ids = segment.lexical_index.top(
+                query, k, None if masks is None else masks[i], collection
+            )
+            results.append((scores, ids + segment.first_id))
+        return lexical_index.merge(results, k)
+
+    def lexical_indexes(self):
+        return [segment.lexical_index for segment in self.segments]
+
+    def locate(self, ids):
+        """Returns the position in `segments` of the segment of each id."""
+        return np.searchsorted(self.first_ids, ids, side="right") - 1
+
+    def get_rows(self, ids):
+        """Returns the metadata of the poems with `ids` as a dict of
+        columns, in order, with one take per segment."""
+        ids = np.asarray(ids, dtype=np.int64)
+        which = self.locate(ids)
+        positions = []
+        columns = {}
+        for i in np.unique(which):
+            at = np.flatnonzero(which == i)
+            segment = self.segments[i]
+            rows = segment.metadata[(ids[at] - segment.first_id).tolist()]
+            for column, values in rows.items():
+                columns.setdefault(column, []).extend(values)
+            positions.append(at)
+        order = np.argsort(np.concatenate(positions)) if positions else []
+        return {
+            column: [values[j] for j in order] for column, values in columns.items()
+        }
+
+    def get_embeddings(self, ids):
+        """Returns the embeddings of the poems with `ids`, in order."""
+        ids = np.asarray(ids, dtype=np.int64)
+        which = self.locate(ids)
+        embeddings = None
+        for i in np.unique(which):
+            at = np.flatnonzero(which == i)
+            segment = self.segments[i]
+            rows = segment.index.embeddings[ids[at] - segment.first_id]
+            if embeddings is None:
+                embeddings = np.empty((len(ids), rows.shape[1]), dtype=np.float32)
+            embeddings[at] = rows
+        return embeddings
@@ -1,17 +1,44 @@
-"""Module for running the recommender as a Discord bot."""
+"""Module for running the recommender as a Discord bot.
+
+The bot connects to Discord while the recommender is built and warmed in
+the background (see startup.py); requests received before it is ready
+wait for it.
+
+Requests go through admission control (see admission.py): per-user and
+global rate limits, coalescing of identical requests in flight, and a
+bounded queue of running requests. Requests that are not admitted get a
+reply asking to try again later."""
+import asyncio
 import discord
+import math
 import os
+import time
 from discord.ext import commands
 import dotenv
 
-import vector_searcher
-import chatgpt
-import recommender
+import admission
+import embedding_cache
+import startup
+import telemetry
 
 dotenv.load_dotenv()
 bot_token = os.getenv("DISCORD_BOT_TOKEN")
+# Port to serve Prometheus metrics on, if set.
+metrics_port = os.getenv("METRICS_PORT")
 DISCORD_MESSAGE_LIMIT = 2000
 BACKTICKS_BUFFER = 8
+# Discord rate limits message edits, so streamed text is flushed at most
+# this often.
+EDIT_INTERVAL_SECONDS = 1.0
+USER_RATE_LIMITED_MESSAGE = (
+    "You're asking for poems faster than I can find them. "
+    + "Please try again in {seconds} seconds."
+)
+GLOBAL_RATE_LIMITED_MESSAGE = (
+    "I'm getting a lot of requests right now. "
+    + "Please try again in {seconds} seconds."
+)
+BUSY_MESSAGE = "I'm busy with a lot of requests right now. Please try again soon."
 
 description = (
     "A bot for recommending poems in the public domain. Type !recpoem"
@@ -22,47 +49,159 @@ intents = discord.Intents.default()
 intents.message_content = True
 
 bot = commands.Bot(command_prefix="!", description=description, intents=intents)
-vectorsearcher = vector_searcher.VectorSearch()
-chat = chatgpt.ChatGPT()
-recs = recommender.Recommender(vectorsearcher, chat)
+starter = None
+rate_limiter = admission.RateLimiter()
+flights = admission.SingleFlight()
+work_queue = admission.WorkQueue()
 
 
-@bot.command()
-async def recpoem(ctx, *, user_request: str):
-    explanation, poem_text = recs.ask(user_request)
-
-    def chunk_poem_text(text, lim):
-        if lim <= BACKTICKS_BUFFER:
-            return "", text
-        lim -= BACKTICKS_BUFFER
-        if "\n" not in text and len(text) > lim:
-            return f"```\n{text[:lim]}\n```", text[lim:]
-        chunk = ""
-        next_ = 0
-        while text and len(chunk + text[:next_]) <= lim:
-            chunk += text[:next_]
-            text = text[next_:]
-            try:
-                next_ = text.index("\n") + 1
-            except ValueError:
-                next_ = len(text)
-        if chunk:
-            return f"```\n{chunk}\n```", text
-        else:
-            return "", text
+def chunk_poem_text(text, lim):
+    """Splits the longest prefix of whole lines of `text` that fits in `lim`
+    characters as a code block off `text`, returning (block, rest)."""
+    if lim <= BACKTICKS_BUFFER:
+        return "", text
+    lim -= BACKTICKS_BUFFER
+    if "\n" not in text and len(text) > lim:
+        return f"```\n{text[:lim]}\n```", text[lim:]
+    chunk = ""
+    next_ = 0
+    while text and len(chunk + text[:next_]) <= lim:
+        chunk += text[:next_]
+        text = text[next_:]
+        try:
+            next_ = text.index("\n") + 1
+        except ValueError:
+            next_ = len(text)
+    if chunk:
+        return f"```\n{chunk}\n```", text
+    if len(text) > lim:
+        # The first line alone is too long, so it is split mid-line.
+        return f"```\n{text[:lim]}\n```", text[lim:]
+    return "", text
 
+
+def split_messages(explanation, poem_text):
+    """Splits a recommendation into messages within DISCORD_MESSAGE_LIMIT,
+    with the poem text in code blocks."""
+    messages = []
     while explanation and len(explanation) > DISCORD_MESSAGE_LIMIT:
-        await ctx.send(explanation[:DISCORD_MESSAGE_LIMIT])
+        messages.append(explanation[:DISCORD_MESSAGE_LIMIT])
         explanation = explanation[DISCORD_MESSAGE_LIMIT:]
 
     chunk, poem_text = chunk_poem_text(
         poem_text, DISCORD_MESSAGE_LIMIT - len(explanation)
     )
-    await ctx.send(f"{explanation}{chunk}")
+    messages.append(f"{explanation}{chunk}")
 
     while poem_text:
         chunk, poem_text = chunk_poem_text(poem_text, DISCORD_MESSAGE_LIMIT)
-        await ctx.send(chunk)
+        messages.append(chunk)
+    return messages
+
+
+async def get_recommender():
+    """Returns the recommender, waiting for it without blocking the loop."""
+    if starter.ready:
+        return starter.recommender
+    return await asyncio.get_running_loop().run_in_executor(None, starter.wait)
+
+
+@bot.event
+async def on_ready():
+    recs = await get_recommender()
+    await recs.awarm()
+    print(f"Recommender ready after {starter.timings['ready']:.2f}s")
+
+
+@bot.command()
+async def recpoem(ctx, *, user_request: str):
+    rejection = rate_limiter.check(ctx.author.id)
+    if rejection is not None:
+        if rejection.scope == "user":
+            reply = USER_RATE_LIMITED_MESSAGE
+        else:
+            reply = GLOBAL_RATE_LIMITED_MESSAGE
+        await ctx.send(reply.format(seconds=math.ceil(rejection.retry_after)))
+        count("discord_rejected_total", reason=rejection.scope)
+        return
+    recs = await get_recommender()
+    message = None
+    last_edit = 0
+    update = None  # aask_stream always yields a final update
+    # Identical requests in flight share one run of the pipeline, which
+    # waits for a turn in the work queue.
+    key = embedding_cache.normalize_query(user_request)
+    if key in flights.flights:
+        count("discord_coalesced_total")
+    updates = flights.stream(
+        key,
+        lambda: work_queue.stream(lambda: recs.aask_stream(user_request)),
+    )
+    try:
+        async for update in updates:
+            now = time.monotonic()
+            if (
+                update.total_seconds is None
+                and update.explanation
+                and now - last_edit >= EDIT_INTERVAL_SECONDS
+            ):
+                content = update.explanation[:DISCORD_MESSAGE_LIMIT]
+                if message is None:
+                    message = await ctx.send(content)
+                else:
+                    await message.edit(content=content)
+                last_edit = now
+    except admission.QueueFull:
+        await ctx.send(BUSY_MESSAGE)
+        count("discord_rejected_total", reason="queue")
+        return
+    print(
+        f"recpoem: first token after {update.first_token_seconds:.2f}s, "
+        + f"full response after {update.total_seconds:.2f}s"
+    )
+
+    messages = split_messages(update.explanation, update.poem_text)
+    # The first message replaces the one streamed so far, if any.
+    if message is None:
+        await ctx.send(messages[0])
+    else:
+        await message.edit(content=messages[0])
+    for content in messages[1:]:
+        await ctx.send(content)
+
+
+def count(name, **labels):
+    """Increments a counter in the recommender's metrics, once it is ready."""
+    if starter.ready and starter.recommender.tracer is not None:
+        starter.recommender.tracer.metrics.inc(name, **labels)
+
+
+def build_recommender():
+    # pylint: disable=import-outside-toplevel
+    import chatgpt
+    import recommender
+    import response_cache
+    import vector_searcher
+
+    # pylint: enable=import-outside-toplevel
+    tracer = telemetry.Telemetry(telemetry.TRACES_PATH)
+    if metrics_port:
+        tracer.serve(int(metrics_port))
+    searcher = vector_searcher.VectorSearch()
+    searcher.watch_segments()
+    return recommender.AsyncRecommender(
+        searcher,
+        chatgpt.ChatGPT(),
+        response_cache=response_cache.ResponseCache(),
+        tracer=tracer,
+    )
+
+
+def main():
+    global starter  # pylint: disable=global-statement
+    starter = startup.BackgroundRecommender(build_recommender)
+    bot.run(bot_token)
 
 
-bot.run(bot_token)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Module for caching query embeddings in front of the OpenAI embeddings API.
+
+Embedding the query is a network round trip on every search, even for
+requests the recommender has seen many times before. The EmbeddingCache
+keeps recently used query embeddings in an in-process LRU, backed by a
+SQLite file so that they survive restarts and are shared by processes on
+the same machine. Entries are keyed by model name and normalized query
+text, and stored as raw float32 bytes."""
+import collections
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+CACHE_PATH = "data/query_embeddings.sqlite"
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60
+
+
+def normalize_query(text):
+    return " ".join(text.casefold().split())
+
+
+class EmbeddingCache:
+    """Two-tier (memory, then disk) cache of float32 query embeddings.
+
+    The in-memory tier evicts the least recently used entry once it holds
+    `max_size` entries. Entries in either tier older than `ttl` seconds are
+    treated as misses. Pass `path=None` for a memory-only cache."""
+
+    def __init__(
+        self, path=CACHE_PATH, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL_SECONDS
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (model TEXT, query TEXT, "
+                + "embedding BLOB, created REAL, PRIMARY KEY (model, query))"
+            )
+            self.db.execute(
+                "DELETE FROM embeddings WHERE created < ?", (time.time() - ttl,)
+            )
+            self.db.commit()
+
+    def get(self, model, query_text):
+        key = (model, normalize_query(query_text))
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            row = None
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT embedding, created FROM embeddings "
+                    + "WHERE model = ? AND query = ?",
+                    key,
+                ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            embedding = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, embedding, row[1])
+            self.disk_hits += 1
+            return embedding
+
+    def put(self, model, query_text, embedding):
+        key = (model, normalize_query(query_text))
+        embedding = np.asarray(embedding, dtype=np.float32)
+        created = time.time()
+        with self.lock:
+            self._remember(key, embedding, created)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                    (*key, embedding.tobytes(), created),
+                )
+                self.db.commit()
+
+    def _remember(self, key, embedding, created):
+        self.entries[key] = (embedding, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "size": len(self.entries),
+            }
@@ -0,0 +1,346 @@
+"""Module for building and loading the on-disk poem embedding artifacts.
+
+Adding a FAISS index to the Hugging Face dataset decodes all 38.5k Arrow
+lists of 1536 floats into a freshly allocated index every time a process
+starts. Instead, the embeddings are written once as a contiguous float32
+matrix (.npy) alongside a serialized FAISS index. At load time the matrix is
+memory-mapped, so startup does not depend on the corpus size and the pages
+are shared between every process on the machine that loads the same file.
+
+Row i of the matrix holds the embedding of the poem with id i.
+
+The exact (flat) index scales linearly with the corpus, so approximate
+index types (IVF-Flat, HNSW, IVF-PQ) can be selected instead. These are
+built from the matrix, serialized next to it, and read back with
+IO_FLAG_MMAP so that their inverted lists also stay on disk.
+
+Compressed index types keep a smaller copy of every vector in memory for
+the first pass: reduced with PCA, quantized to int8 (SQ8) or binarized
+(one bit per dimension, compared by Hamming distance), or reduced and then
+quantized. The first pass returns `rerank` candidates, which are re-ranked
+by their exact distance to rows of the memory-mapped float32 matrix, so
+only those rows are read from it."""
+import os
+import faiss
+import numpy as np
+
+EMBEDDINGS_NPY_PATH = "data/embeddings.npy"
+EMBEDDINGS_FAISS_PATH = "data/embeddings.faiss"
+EMBEDDING_COLUMN = "embedding"
+BUILD_BATCH_SIZE = 4096
+FILTERED_SEARCH_CHUNK_ROWS = 8192
+# Filters matching at most this many poems are searched exactly even with an
+# approximate index, which costs no more than probing an IVF index and does
+# not miss matches outside the probed lists or graph neighbourhoods.
+FILTERED_EXACT_SEARCH_MAX_ROWS = 4096
+
+INDEX_FACTORIES = {
+    "flat": "Flat",
+    "ivf": "IVF{nlist},Flat",
+    "hnsw": "HNSW{hnsw_m}",
+    "ivfpq": "IVF{nlist},PQ{pq_m}",
+    "pca": "PCA{pca_dim},Flat",
+    "sq8": "SQ8",
+    "pca-sq8": "PCA{pca_dim},SQ8",
+    "binary": "LSHt",
+    # ITQ is PCA followed by a rotation trained to lose less to binarization.
+    "pca-binary": "ITQ{pca_dim},LSHt",
+}
+# Index types whose results are re-ranked with the exact vectors by default.
+COMPRESSED_INDEX_TYPES = ("pca", "sq8", "pca-sq8", "binary", "pca-binary")
+DEFAULT_NLIST = 256
+DEFAULT_HNSW_M = 32
+DEFAULT_PQ_M = 96
+DEFAULT_PCA_DIM = 256
+DEFAULT_RERANK = 100
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+TRAINING_POINTS_PER_CENTROID = 64
+
+
+def exists(embeddings_path=EMBEDDINGS_NPY_PATH, index_path=EMBEDDINGS_FAISS_PATH):
+    return os.path.exists(embeddings_path) and os.path.exists(index_path)
+
+
+def build(data, embeddings_path=EMBEDDINGS_NPY_PATH, index_path=EMBEDDINGS_FAISS_PATH):
+    """Writes the embedding column of `data` as a float32 matrix and index.
+
+    The matrix is filled in batches through a memory-mapped output file, so
+    the full column is never held in memory as Python lists. Both files are
+    written under temporary names and renamed into place once complete."""
+    data = data.with_format("numpy", columns=[EMBEDDING_COLUMN])
+    dim = len(data[0][EMBEDDING_COLUMN])
+
+    def fill(matrix):
+        for start in range(0, len(data), BUILD_BATCH_SIZE):
+            batch = np.stack(data[start : start + BUILD_BATCH_SIZE][EMBEDDING_COLUMN])
+            matrix[start : start + len(batch)] = batch
+
+    _write(fill, (len(data), dim), embeddings_path, index_path)
+
+
+def build_from_store(
+    store,
+    num_rows,
+    embeddings_path=EMBEDDINGS_NPY_PATH,
+    index_path=EMBEDDINGS_FAISS_PATH,
+):
+    """Like build, but scatters the rows of an embedding_store.EmbeddingStore
+    into place by id, reading its memory-mapped shards without parsing."""
+
+    def fill(matrix):
+        written = np.zeros(num_rows, dtype=bool)
+        for ids, embeddings in store.shards():
+            matrix[ids] = embeddings
+            written[ids] = True
+        if not written.all():
+            missing = np.flatnonzero(~written)
+            raise ValueError(
+                f"{len(missing)} poems have no embedding, e.g. {missing[:10].tolist()}."
+            )
+
+    _write(fill, (num_rows, store.dim), embeddings_path, index_path)
+
+
+def _write(fill, shape, embeddings_path, index_path):
+    tmp_embeddings_path = embeddings_path + ".tmp"
+    matrix = np.lib.format.open_memmap(
+        tmp_embeddings_path, mode="w+", dtype=np.float32, shape=shape
+    )
+    fill(matrix)
+    matrix.flush()
+    del matrix
+    os.replace(tmp_embeddings_path, embeddings_path)
+
+    write_index(build_index(load_embeddings(embeddings_path), "flat"), index_path)
+
+
+def load_embeddings(embeddings_path=EMBEDDINGS_NPY_PATH):
+    return np.load(embeddings_path, mmap_mode="r")
+
+
+def factory_string(
+    index_type,
+    nlist=DEFAULT_NLIST,
+    hnsw_m=DEFAULT_HNSW_M,
+    pq_m=DEFAULT_PQ_M,
+    pca_dim=DEFAULT_PCA_DIM,
+):
+    if index_type not in INDEX_FACTORIES:
+        raise ValueError(
+            f"Unknown index type {index_type!r}, expected one of "
+            + f"{', '.join(INDEX_FACTORIES)}."
+        )
+    return INDEX_FACTORIES[index_type].format(
+        nlist=nlist, hnsw_m=hnsw_m, pq_m=pq_m, pca_dim=pca_dim
+    )
+
+
+def index_path_for(factory, embeddings_path=EMBEDDINGS_NPY_PATH):
+    """Returns where the index built with `factory` is serialized.
+
+    The factory string is part of the file name, so that changing e.g. the
+    number of IVF lists builds a new index instead of loading a stale one."""
+    root, _ = os.path.splitext(embeddings_path)
+    if factory == INDEX_FACTORIES["flat"]:
+        return f"{root}.faiss"
+    return f"{root}.{factory.replace(',', '_')}.faiss"
+
+
+def build_index(embeddings, index_type, **factory_kwargs):
+    """Trains (if needed) and fills an index of `index_type` from the matrix."""
+    factory = factory_string(index_type, **factory_kwargs)
+    index = faiss.index_factory(embeddings.shape[1], factory, faiss.METRIC_L2)
+    if not index.is_trained:
+        nlist = factory_kwargs.get("nlist", DEFAULT_NLIST)
+        step = max(1, len(embeddings) // (nlist * TRAINING_POINTS_PER_CENTROID))
+        index.train(np.ascontiguousarray(embeddings[::step]))
+    for start in range(0, len(embeddings), BUILD_BATCH_SIZE):
+        index.add(np.ascontiguousarray(embeddings[start : start + BUILD_BATCH_SIZE]))
+    return index
+
+
+def write_index(index, index_path):
+    tmp_index_path = index_path + ".tmp"
+    faiss.write_index(index, tmp_index_path)
+    os.replace(tmp_index_path, index_path)
+
+
+def read_index(index_path):
+    return faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+def search_parameters(
+    index, nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH, sel=None
+):
+    """Returns per-call search parameters for `index`, or None if it has none.
+
+    Passing nprobe with each search instead of setting it on the index keeps
+    a loaded IVF index immutable, so one instance can be shared by threads
+    using different operating points. faiss 1.7.4 ignores the efSearch of
+    SearchParametersHNSW unless it also has a selector, so for HNSW it is set
+    on the index itself as well. `sel` is an optional faiss.IDSelector
+    restricting the ids searched."""
+    # The SWIG constructors accept these keywords, and also keep `sel`
+    # alive for as long as the parameters are.
+    # pylint: disable=unexpected-keyword-arg
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=nprobe, sel=sel)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+        if sel is not None:
+            return faiss.SearchParametersHNSW(sel=sel, efSearch=ef_search)
+    elif sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
+
+
+def supports_selector(index):
+    """Returns whether `index` can restrict its search with an ID selector,
+    which faiss 1.7.4's IndexLSH (the binary index types) cannot."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return not isinstance(index, faiss.IndexLSH)
+
+
+def search(embeddings, query_embeddings, k):
+    """Exact L2 nearest neighbour search directly over the mapped matrix.
+
+    This computes the same result as searching the serialized flat index,
+    without reading the vectors into a newly allocated faiss.IndexFlatL2."""
+    query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+    return faiss.knn(query_embeddings, embeddings, k)
+
+
+def filtered_search(embeddings, query_embeddings, k, mask):
+    """Exact search restricted to the rows where `mask` is True.
+
+    faiss.knn takes no ID selector, so the matching rows are gathered one
+    chunk of the matrix at a time and searched, and the per-chunk results
+    merged. This touches each row at most once, like an unfiltered search,
+    and copies at most one chunk of rows at a time. Like faiss, missing
+    results have id -1."""
+    query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+    results = []
+    for start in range(0, len(embeddings), FILTERED_SEARCH_CHUNK_ROWS):
+        rows = start + np.flatnonzero(mask[start : start + FILTERED_SEARCH_CHUNK_ROWS])
+        if len(rows) == 0:
+            continue
+        chunk_distances, chunk_ids = faiss.knn(
+            query_embeddings, embeddings[rows], min(k, len(rows))
+        )
+        results.append((chunk_distances, rows[chunk_ids]))
+    return merge(results, k, len(query_embeddings))
+
+
+def merge(results, k, num_queries=None):
+    """Merges the (distances, ids) results of searches over disjoint sets of
+    poems into the `k` nearest of each query, padded with id -1 and infinite
+    distance if there are fewer. `num_queries` is needed if `results` may be
+    empty."""
+    if num_queries is None:
+        num_queries = len(results[0][0])
+    distances = [np.full((num_queries, k), np.inf, dtype=np.float32)]
+    ids = [np.full((num_queries, k), -1, dtype=np.int64)]
+    for result_distances, result_ids in results:
+        distances.append(result_distances)
+        ids.append(result_ids)
+    distances = np.concatenate(distances, axis=1)
+    ids = np.concatenate(ids, axis=1)
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return (
+        np.take_along_axis(distances, order, axis=1),
+        np.take_along_axis(ids, order, axis=1),
+    )
+
+
+def exact_rerank(embeddings, query_embeddings, ids, k):
+    """Returns the `k` of each query's candidate `ids` (-1 for none) nearest
+    by exact L2 distance, with their distances.
+
+    Only the candidates' rows of the mapped matrix are read, in id order."""
+    distances = np.full(ids.shape, np.inf, dtype=np.float32)
+    for i, query in enumerate(query_embeddings):
+        valid = np.flatnonzero(ids[i] >= 0)
+        valid = valid[np.argsort(ids[i, valid])]
+        vectors = np.asarray(embeddings[ids[i, valid]], dtype=np.float32)
+        distances[i, valid] = np.square(vectors - query).sum(axis=1)
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    distances = np.take_along_axis(distances, order, axis=1)
+    ids = np.take_along_axis(ids, order, axis=1)
+    ids[np.isinf(distances)] = -1
+    return distances, ids
+
+
+class EmbeddingIndex:
+    """Nearest neighbour search over the memory-mapped poem embeddings.
+
+    With the default "flat" index type the mapped matrix is searched exactly.
+    Otherwise the approximate index for the configured factory string is read
+    from disk, building and serializing it from the matrix on first use.
+
+    If `rerank` is nonzero, that many candidates are taken from the index
+    and re-ranked exactly (see exact_rerank). It defaults to DEFAULT_RERANK
+    for the compressed index types and to 0 for the others."""
+
+    def __init__(
+        self,
+        index_type="flat",
+        nprobe=DEFAULT_NPROBE,
+        ef_search=DEFAULT_EF_SEARCH,
+        embeddings_path=EMBEDDINGS_NPY_PATH,
+        rerank=None,
+        **factory_kwargs,
+    ):
+        self.index_type = index_type
+        self.factory = factory_string(index_type, **factory_kwargs)
+        self.embeddings = load_embeddings(embeddings_path)
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        if rerank is None:
+            rerank = DEFAULT_RERANK if index_type in COMPRESSED_INDEX_TYPES else 0
+        self.rerank = rerank
+        self.index = None
+        self.params = None
+        self.selectable = True
+        if index_type != "flat":
+            index_path = index_path_for(self.factory, embeddings_path)
+            if not os.path.exists(index_path):
+                write_index(
+                    build_index(self.embeddings, index_type, **factory_kwargs),
+                    index_path,
+                )
+            self.index = read_index(index_path)
+            self.params = search_parameters(self.index, nprobe, ef_search)
+            self.selectable = supports_selector(self.index)
+
+    def search(self, query_embeddings, k, mask=None):
+        """Returns the distances and ids of the `k` nearest poems.
+
+        If `mask` (a boolean array indexed by poem id) is given, only poems
+        where it is True are searched. Approximate indexes are passed the
+        mask as a bitmap ID selector, so they skip other poems during the
+        search rather than filtering their results. Filters that match few
+        poems, or any filter with an index that takes no ID selector, are
+        searched exactly instead. Fewer than `k` results (with id -1) are
+        returned when fewer poems match or are reached."""
+        if mask is not None and (
+            self.index is None
+            or not self.selectable
+            or np.count_nonzero(mask) <= FILTERED_EXACT_SEARCH_MAX_ROWS
+        ):
+            return filtered_search(self.embeddings, query_embeddings, k, mask)
+        if self.index is None:
+            return search(self.embeddings, query_embeddings, k)
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        params = self.params
+        if mask is not None:
+            bitmap = np.packbits(mask, bitorder="little")
+            sel = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+            params = search_parameters(self.index, self.nprobe, self.ef_search, sel)
+        if not self.rerank:
+            return self.index.search(query_embeddings, k, params=params)
+        _, ids = self.index.search(query_embeddings, max(k, self.rerank), params=params)
+        return exact_rerank(self.embeddings, query_embeddings, ids, k)
@@ -0,0 +1,191 @@
+"""Module for the append-only binary store of poem embeddings.
+
+Embeddings are stored as shards of raw float32 rows, each next to a file of
+the int64 poem ids of its rows. A JSON manifest lists every shard with its
+number of committed rows. Appends only ever write past the end of the
+current shard, and commit fsyncs the shard before atomically replacing the
+manifest, so a crash at any point leaves the store readable with exactly
+the rows of the last commit. Readers memory-map the shards, so reading the
+store does not copy or parse the embeddings.
+
+The store has a single writer at a time; data_preparation scripts that
+generate embeddings hold it open while appending."""
+import csv
+import json
+import os
+import numpy as np
+
+EMBEDDINGS_STORE_PATH = "data/embeddings"
+MANIFEST_NAME = "manifest.json"
+MAX_SHARD_ROWS = 8192
+MIGRATION_BATCH_SIZE = 1024
+
+
+def exists(path=EMBEDDINGS_STORE_PATH):
+    return os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class EmbeddingStore:
+    """Sharded float32 embedding store with crash-safe commits."""
+
+    def __init__(self, path=EMBEDDINGS_STORE_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"dim": None, "shards": []}
+        self.shard = None
+
+    @property
+    def dim(self):
+        return self.manifest["dim"]
+
+    def __len__(self):
+        return sum(shard["rows"] for shard in self.manifest["shards"])
+
+    def shards(self):
+        """Yields (ids, embeddings) memory maps of every committed shard."""
+        for shard in self.manifest["shards"]:
+            if shard["rows"] == 0:
+                continue
+            prefix = os.path.join(self.path, shard["name"])
+            yield (
+                np.memmap(
+                    prefix + ".ids", dtype=np.int64, mode="r", shape=(shard["rows"],)
+                ),
+                np.memmap(
+                    prefix + ".f32",
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(shard["rows"], self.dim),
+                ),
+            )
+
+    def ids(self):
+        return np.concatenate(
+            [ids for ids, _ in self.shards()] or [np.empty(0, dtype=np.int64)]
+        )
+
+    def get_many(self, ids):
+        """Returns the embeddings of `ids` in order. Later writes of an id win."""
+        ids = np.asarray(ids, dtype=np.int64)
+        result = np.empty((len(ids), self.dim), dtype=np.float32)
+        found = np.zeros(len(ids), dtype=bool)
+        for shard_ids, shard_embeddings in self.shards():
+            order = np.argsort(shard_ids, kind="stable")
+            positions = np.searchsorted(shard_ids, ids, side="right", sorter=order) - 1
+            rows = order[np.maximum(positions, 0)]
+            match = (positions >= 0) & (shard_ids[rows] == ids)
+            result[match] = shard_embeddings[rows[match]]
+            found |= match
+        if not found.all():
+            raise KeyError(f"Missing embeddings for ids {ids[~found][:10].tolist()}")
+        return result
+
+    def append(self, ids, embeddings):
+        """Writes rows after the end of the current shard. They become
+        visible to readers (and survive a crash) once commit is called."""
+        ids = np.asarray(ids, dtype=np.int64)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.dim is None:
+            self.manifest["dim"] = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(
+                f"Expected embeddings of dimension {self.dim}, "
+                + f"got {embeddings.shape[1]}."
+            )
+        start = 0
+        while start < len(ids):
+            if self.shard is None or self.shard["rows"] == MAX_SHARD_ROWS:
+                self._open_shard()
+            end = start + min(MAX_SHARD_ROWS - self.shard["rows"], len(ids) - start)
+            self.shard["ids_file"].write(ids[start:end].tobytes())
+            self.shard["embeddings_file"].write(embeddings[start:end].tobytes())
+            self.shard["rows"] += end - start
+            start = end
+
+    def _open_shard(self):
+        self.commit()
+        if self.shard is not None:
+            self.shard["ids_file"].close()
+            self.shard["embeddings_file"].close()
+        # A new shard is started by every writer, so rows written but never
+        # committed before a crash are simply overwritten or left unlisted.
+        name = f"shard-{len(self.manifest['shards']):05d}"
+        prefix = os.path.join(self.path, name)
+        # pylint: disable=consider-using-with
+        self.shard = {
+            "name": name,
+            "rows": 0,
+            "ids_file": open(prefix + ".ids", "wb"),
+            "embeddings_file": open(prefix + ".f32", "wb"),
+        }
+
+    def commit(self):
+        if self.shard is not None:
+            for f in [self.shard["ids_file"], self.shard["embeddings_file"]]:
+                f.flush()
+                os.fsync(f.fileno())
+            shards = self.manifest["shards"]
+            entry = {"name": self.shard["name"], "rows": self.shard["rows"]}
+            if shards and shards[-1]["name"] == entry["name"]:
+                shards[-1] = entry
+            else:
+                shards.append(entry)
+
+        manifest_path = os.path.join(self.path, MANIFEST_NAME)
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest_path + ".tmp", manifest_path)
+        _fsync_path(self.path)
+
+    def close(self):
+        self.commit()
+        if self.shard is not None:
+            self.shard["ids_file"].close()
+            self.shard["embeddings_file"].close()
+            self.shard = None
+
+
+def migrate_csv(csv_path, store):
+    """Imports a CSV of (id, JSON list of floats) rows written by earlier
+    versions of generate_embeddings.py, and returns the number of rows
+    imported. Rows whose id is already in the store are skipped, so an
+    interrupted import resumes where it stopped and keeps any embeddings
+    generated since. A completed import is recorded in the manifest and
+    not read again."""
+    if store.manifest.get("migrated_csv"):
+        return 0
+    present = set(store.ids().tolist())
+    ids, embeddings = [], []
+    imported = 0
+    with open(csv_path, "r", encoding="UTF-8") as file:
+        for row in csv.DictReader(file):
+            if int(row["id"]) in present:
+                continue
+            ids.append(int(row["id"]))
+            embeddings.append(json.loads(row["embedding"]))
+            if len(ids) == MIGRATION_BATCH_SIZE:
+                store.append(ids, embeddings)
+                store.commit()
+                imported += len(ids)
+                ids, embeddings = [], []
+    if ids:
+        store.append(ids, embeddings)
+        imported += len(ids)
+    store.manifest["migrated_csv"] = True
+    store.commit()
+    return imported
@@ -0,0 +1,134 @@
+"""Module for the bank of few-shot examples selected per request.
+
+The examples in prompts.INITIAL_PROMPT show the LLM the query, candidates,
+explanation and id format it should answer in, and make up most of the
+system message's tokens, all of which are sent with every request. The
+example bank instead stores each example with its candidates' text
+truncated to EXAMPLE_POEM_TOKEN_LIMIT tokens, an embedding of its query and
+its token count, all computed once when the bank is built. Each request
+then includes only the `limit` examples whose queries are most similar to
+its own that fit within `token_budget`, after prompts.INSTRUCTIONS, which
+stay the same for every request. Selecting examples needs no tokenizer or
+API call, only a dot product with the query embedding the request already
+has.
+
+Examples are taken from INITIAL_PROMPT, and more can be added from a JSONL
+file of objects with the Example fields (see load_examples). Build the bank
+with `python3 src/data_preparation/build_index.py --examples`."""
+import collections
+import json
+import os
+import numpy as np
+
+import prompts
+import tokenizer
+
+EXAMPLES_PATH = "data/few_shot_examples.json"
+EXAMPLE_EMBEDDINGS_PATH = "data/few_shot_embeddings.npy"
+EXAMPLE_POEM_TOKEN_LIMIT = 150
+DEFAULT_LIMIT = 1
+DEFAULT_TOKEN_BUDGET = 1000
+
+# `options` holds the text inside each candidate's <poem> tags.
+Example = collections.namedtuple(
+    "Example", ["query", "options", "explanation", "poem_id"]
+)
+
+
+def exists(examples_path=EXAMPLES_PATH, embeddings_path=EXAMPLE_EMBEDDINGS_PATH):
+    return os.path.exists(examples_path) and os.path.exists(embeddings_path)
+
+
+def load_examples(path):
+    """Reads Examples from a JSONL file with one object per example."""
+    with open(path, encoding="utf-8") as f:
+        return [Example(**json.loads(line)) for line in f if line.strip()]
+
+
+def build(
+    embed,
+    examples=None,
+    examples_path=EXAMPLES_PATH,
+    embeddings_path=EXAMPLE_EMBEDDINGS_PATH,
+    poem_token_limit=EXAMPLE_POEM_TOKEN_LIMIT,
+):
+    """Builds the bank from `examples`, INITIAL_PROMPT's if None.
+
+    `embed` takes a list of texts and returns their embeddings, with the
+    model used for poems and queries (see vector_searcher.py)."""
+    if examples is None:
+        examples = [Example(*e) for e in prompts.parse_examples(prompts.INITIAL_PROMPT)]
+    examples = [
+        example._replace(
+            options=[
+                tokenizer.reduce_to_token_limit(option, poem_token_limit)
+                for option in example.options
+            ]
+        )
+        for example in examples
+    ]
+    embeddings = np.asarray(embed([e.query for e in examples]), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    records = [
+        {
+            **example._asdict(),
+            "tokens": tokenizer.num_tokens(prompts.render_example(example)),
+        }
+        for example in examples
+    ]
+    np.save(embeddings_path, embeddings)
+    with open(examples_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(records, f, indent=2)
+    os.replace(examples_path + ".tmp", examples_path)
+
+
+class ExampleBank:
+    """The examples, their rendered text, token counts and query embeddings."""
+
+    def __init__(
+        self, examples_path=EXAMPLES_PATH, embeddings_path=EXAMPLE_EMBEDDINGS_PATH
+    ):
+        with open(examples_path, encoding="utf-8") as f:
+            records = json.load(f)
+        self.examples = [
+            Example(*(record[field] for field in Example._fields)) for record in records
+        ]
+        self.rendered = [prompts.render_example(e) for e in self.examples]
+        self.tokens = np.array([record["tokens"] for record in records])
+        self.embeddings = np.load(embeddings_path)
+
+    def select(self, query_embedding, limit=DEFAULT_LIMIT, token_budget=None):
+        """Returns the indexes of the examples to include for a query, and
+        their total tokens.
+
+        Examples are taken from the most similar query down, skipping any
+        that would take the total over `token_budget`. The selection is
+        returned in bank order, so that the same examples always make the
+        same system message. Without a `query_embedding`, examples are taken
+        in bank order."""
+        scores = np.zeros(len(self.examples), dtype=np.float32)
+        if query_embedding is not None:
+            query_embedding = np.asarray(query_embedding, dtype=np.float32)
+            scores = self.embeddings @ (
+                query_embedding / np.linalg.norm(query_embedding)
+            )
+        selected = []
+        total_tokens = 0
+        for i in np.argsort(-scores, kind="stable"):
+            if len(selected) == limit:
+                break
+            if (
+                token_budget is not None
+                and total_tokens + self.tokens[i] > token_budget
+            ):
+                continue
+            selected.append(int(i))
+            total_tokens += int(self.tokens[i])
+        return sorted(selected), total_tokens
+
+    def system_prompt(self, selected):
+        """Returns the system prompt with the examples at `selected`."""
+        return prompts.build_system_prompt([self.rendered[i] for i in selected])
+
+    def __len__(self):
+        return len(self.examples)
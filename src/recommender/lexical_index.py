@@ -0,0 +1,220 @@
+"""Module for BM25 keyword search over poem titles, authors and text.
+
+Requests that name a title, author or phrase (e.g. "the poem with 'By
+rugged ways'") share words with the poem they want, but their embeddings
+need not be near its embedding. A lexical index finds them by those words,
+and its ranking is fused with the vector search's ranking by reciprocal
+rank fusion (see fuse). It needs no API call, so it can also serve requests
+on its own when the embeddings API is slow or down.
+
+The index is built once per dataset. Each poem is one document, in which
+words of the title and author count TITLE_WEIGHT and AUTHOR_WEIGHT times.
+Postings are stored as arrays rather than per-term lists: the terms in
+sorted order, an offsets array into the posting arrays for each term, and
+the poem ids and term frequencies of all postings, ordered by term and then
+poem id, along with each poem's length. The arrays are memory-mapped, so
+processes forked from one that loaded the index share its pages."""
+import array
+import collections
+import os
+import re
+import numpy as np
+
+LEXICAL_INDEX_DIR = "data/lexical_index"
+BUILD_BATCH_SIZE = 1000
+TITLE_WEIGHT = 3
+AUTHOR_WEIGHT = 3
+BM25_K1 = 1.2
+BM25_B = 0.75
+# The constant in reciprocal rank fusion, which keeps the top few ranks of
+# either ranking from outweighing agreement between the two.
+RRF_K = 60
+# Words of requests that say what is wanted rather than what it is about.
+QUERY_STOP_WORDS = frozenset(
+    [
+        "a",
+        "about",
+        "an",
+        "find",
+        "for",
+        "give",
+        "i",
+        "like",
+        "me",
+        "please",
+        "poem",
+        "poems",
+        "recommend",
+        "show",
+        "some",
+        "something",
+        "the",
+        "want",
+        "would",
+    ]
+)
+ARRAYS = ("offsets", "ids", "frequencies", "lengths")
+# Term frequencies are stored as uint16, and capped to fit.
+FREQUENCY_MAX = np.iinfo(np.uint16).max
+
+
+def exists(path=LEXICAL_INDEX_DIR):
+    return all(
+        os.path.exists(os.path.join(path, name))
+        for name in ["terms.txt", *(f"{name}.npy" for name in ARRAYS)]
+    )
+
+
+def tokenize(text):
+    return re.findall(r"[^\W_]+", str(text or "").casefold())
+
+
+def build(data, path=LEXICAL_INDEX_DIR):
+    """Builds the index of every poem in `data`.
+
+    Postings are collected in compact typed arrays as (term code, poem id,
+    frequency) triples, then sorted into place, so that no per-term Python
+    lists are built for the whole corpus."""
+    codes = {}
+    terms, ids, frequencies = array.array("q"), array.array("q"), array.array("q")
+    lengths = np.zeros(len(data), dtype=np.float32)
+    data = data.select_columns(["id", "Title", "Author", "Poem Text"])
+    for start in range(0, len(data), BUILD_BATCH_SIZE):
+        rows = data[start : start + BUILD_BATCH_SIZE]
+        for id_, title, author, text in zip(
+            rows["id"], rows["Title"], rows["Author"], rows["Poem Text"]
+        ):
+            counts = collections.Counter(tokenize(text))
+            for word in tokenize(title):
+                counts[word] += TITLE_WEIGHT
+            for word in tokenize(author):
+                counts[word] += AUTHOR_WEIGHT
+            lengths[id_] = sum(counts.values())
+            for word, count in counts.items():
+                terms.append(codes.setdefault(word, len(codes)))
+                ids.append(id_)
+                frequencies.append(count)
+
+    words = np.array(list(codes), dtype=object)
+    order = np.argsort(words)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    terms = rank[np.frombuffer(terms, dtype=np.int64)]
+    ids = np.frombuffer(ids, dtype=np.int64)
+    postings = np.lexsort((ids, terms))
+    arrays = {
+        "offsets": np.searchsorted(terms[postings], np.arange(len(order) + 1)),
+        "ids": ids[postings].astype(np.int32),
+        "frequencies": np.minimum(
+            np.frombuffer(frequencies, dtype=np.int64)[postings], FREQUENCY_MAX
+        ).astype(np.uint16),
+        "lengths": lengths,
+    }
+    tmp_path = path + ".tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    with open(os.path.join(tmp_path, "terms.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(words[order]))
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+    if os.path.exists(path):
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+    os.replace(tmp_path, path)
+
+
+def fuse(rankings, limit, k=RRF_K):
+    """Reciprocal rank fusion: returns the `limit` ids with the highest sum
+    of 1 / (k + rank) over the `rankings` (lists of ids, best first) they
+    appear in. Ties keep the order in which ids first appear."""
+    scores = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking, 1):
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+
+def merge(results, k):
+    """Merges the (scores, ids) results of searches over disjoint sets of
+    poems, with the statistics of one collection, into the `k` best."""
+    scores = np.concatenate([np.zeros(0, dtype=np.float32)] + [r[0] for r in results])
+    ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [r[1] for r in results])
+    order = np.argsort(-scores, kind="stable")[:k]
+    return scores[order], ids[order]
+
+
+class LexicalIndex:
+    """BM25 search over the memory-mapped postings."""
+
+    def __init__(self, path=LEXICAL_INDEX_DIR):
+        with open(os.path.join(path, "terms.txt"), encoding="utf-8") as f:
+            self.codes = {term: code for code, term in enumerate(f.read().split("\n"))}
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), "r"))
+        self.total_length = float(np.sum(self.lengths))
+        self.average_length = self.total_length / max(len(self), 1) or 1.0
+        self.doc_frequencies = np.diff(self.offsets)
+        self.idf = self.inverse_document_frequencies(self.doc_frequencies, len(self))
+
+    @staticmethod
+    def inverse_document_frequencies(doc_frequencies, num_docs):
+        return np.log(
+            1 + (num_docs - doc_frequencies + 0.5) / (doc_frequencies + 0.5)
+        ).astype(np.float32)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def doc_frequency(self, word):
+        code = self.codes.get(word)
+        return 0 if code is None else int(self.doc_frequencies[code])
+
+    def scores(self, query, collection=None):
+        """Returns the BM25 score of every poem for `query`.
+
+        If `collection` (a list of LexicalIndexes that includes this one) is
+        given, the IDF and average length are those of all its poems, so
+        that scores from each of its indexes can be compared."""
+        scores = np.zeros(len(self), dtype=np.float32)
+        words = [w for w in tokenize(query) if w not in QUERY_STOP_WORDS]
+        average_length = self.average_length
+        if collection is not None:
+            num_docs = sum(len(index) for index in collection)
+            average_length = (
+                sum(index.total_length for index in collection) / max(num_docs, 1)
+                or 1.0
+            )
+        for word, count in collections.Counter(words).items():
+            code = self.codes.get(word)
+            if code is None:
+                continue
+            idf = self.idf[code]
+            if collection is not None:
+                idf = self.inverse_document_frequencies(
+                    sum(index.doc_frequency(word) for index in collection), num_docs
+                )
+            start, end = self.offsets[code], self.offsets[code + 1]
+            ids = self.ids[start:end]
+            frequencies = self.frequencies[start:end].astype(np.float32)
+            norms = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[ids] / average_length)
+            scores[ids] += (
+                count * idf * frequencies * (BM25_K1 + 1) / (frequencies + norms)
+            )
+        return scores
+
+    def top(self, query, k, mask=None, collection=None):
+        """Returns the scores and ids of the (at most) `k` best matching
+        poems for `query`, best first, among those where `mask` is True if
+        given. Poems sharing no word with the query are not returned."""
+        scores = self.scores(query, collection)
+        if mask is not None:
+            scores[~mask] = 0
+        matches = np.flatnonzero(scores)
+        if len(matches) > k:
+            matches = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+        matches = matches[np.argsort(-scores[matches], kind="stable")]
+        return scores[matches], matches
+
+    def search(self, query, k, mask=None, collection=None):
+        """Like top, but returns only the ids."""
+        return self.top(query, k, mask, collection)[1]
@@ -1,17 +1,27 @@
 """Module for running the poem recommender through the CLI.
 
 To run it, run `python3 src/recommender/main.py` from the root directory.
+
+The prompt is shown right away, while the recommender is built and warmed
+in the background (see startup.py). If the first request is entered
+before it is ready, it is answered once it is.
 """
-import vector_searcher
-import chatgpt
-import recommender
+import startup
+
+
+def build_recommender():
+    # pylint: disable=import-outside-toplevel
+    import chatgpt
+    import recommender
+    import vector_searcher
+
+    # pylint: enable=import-outside-toplevel
+    return recommender.Recommender(vector_searcher.VectorSearch(), chatgpt.ChatGPT())
 
 
 def main():
     """Initialize the recommender and ask the user for requests in a loop."""
-    vectorsearcher = vector_searcher.VectorSearch()
-    chat = chatgpt.ChatGPT()
-    recs = recommender.Recommender(vectorsearcher, chat)
+    starter = startup.BackgroundRecommender(build_recommender)
 
     print(
         "Welcome to the poem recommender.\n You can ask the poem recommender"
@@ -22,6 +32,9 @@ def main():
         query_text = input("User: ")
         if query_text == "quit":
             break
+        if not starter.ready:
+            print("(Loading the poems, this takes a few seconds the first time.)")
+        recs = starter.wait()
         explanation, poem_text = recs.ask(query_text)
         print(f"Recommender: {explanation}\n\n{poem_text}\n")
 
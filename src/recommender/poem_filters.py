@@ -0,0 +1,163 @@
+"""Module for filtering vector search results by poem metadata.
+
+Requests like "a short poem by Dickinson" constrain the metadata of the
+poem as well as its content. Filtering the top results of an unfiltered
+search often leaves no poem that matches, so the filter is applied inside
+the search instead (see embedding_index.EmbeddingIndex.search).
+
+The attributes that can be filtered on are precomputed once per dataset,
+aligned to poem id: the number of lines and tokens of each poem, its views,
+and the birth and death years parsed from "Birth and Death Dates", along
+with an inverted index from author to poem ids. Turning a PoemFilter into
+the bitmap of matching poems then costs a few vectorized comparisons."""
+import collections
+import os
+import re
+import numpy as np
+
+import tokenizer
+
+POEM_ATTRIBUTES_PATH = "data/poem_attributes.npz"
+BUILD_BATCH_SIZE = 1000
+UNKNOWN_YEAR = -1
+
+# Bounds are inclusive, and None leaves an attribute unconstrained. `author`
+# matches any author whose name contains it, ignoring case.
+PoemFilter = collections.namedtuple(
+    "PoemFilter",
+    [
+        "author",
+        "min_lines",
+        "max_lines",
+        "min_tokens",
+        "max_tokens",
+        "min_views",
+        "max_views",
+        "min_birth_year",
+        "max_birth_year",
+        "min_death_year",
+        "max_death_year",
+    ],
+    defaults=(None,) * 11,
+)
+
+# PoemFilter bounds for each precomputed attribute array.
+RANGE_FILTERS = {
+    "num_lines": ("min_lines", "max_lines"),
+    "num_tokens": ("min_tokens", "max_tokens"),
+    "views": ("min_views", "max_views"),
+    "birth_year": ("min_birth_year", "max_birth_year"),
+    "death_year": ("min_death_year", "max_death_year"),
+}
+
+
+def exists(path=POEM_ATTRIBUTES_PATH):
+    return os.path.exists(path)
+
+
+def parse_years(dates):
+    """Returns the (birth, death) years in a "Birth and Death Dates" value,
+    such as "1830 - 1886", with UNKNOWN_YEAR for years that are missing."""
+    years = [int(year) for year in re.findall(r"\d{3,4}", str(dates or ""))]
+    if not years:
+        return UNKNOWN_YEAR, UNKNOWN_YEAR
+    if len(years) == 1:
+        if re.search(r"\b(d\.|died)", str(dates), re.IGNORECASE):
+            return UNKNOWN_YEAR, years[0]
+        return years[0], UNKNOWN_YEAR
+    return years[0], years[1]
+
+
+def count_lines(text):
+    return sum(1 for line in str(text or "").splitlines() if line.strip())
+
+
+def build(data, path=POEM_ATTRIBUTES_PATH):
+    """Computes the filterable attributes of every poem in `data`."""
+    num_poems = len(data)
+    authors = np.empty(num_poems, dtype=object)
+    attributes = {
+        name: np.full(num_poems, UNKNOWN_YEAR, dtype=np.int64) for name in RANGE_FILTERS
+    }
+    data = data.select_columns(
+        ["id", "Author", "Poem Text", "Views", "Birth and Death Dates"]
+    )
+    for start in range(0, num_poems, BUILD_BATCH_SIZE):
+        rows = data[start : start + BUILD_BATCH_SIZE]
+        for id_, author, text, views, dates in zip(
+            rows["id"],
+            rows["Author"],
+            rows["Poem Text"],
+            rows["Views"],
+            rows["Birth and Death Dates"],
+        ):
+            authors[id_] = str(author or "").strip()
+            attributes["num_lines"][id_] = count_lines(text)
+            attributes["num_tokens"][id_] = tokenizer.num_tokens(str(text or ""))
+            attributes["views"][id_] = int(views or 0)
+            (
+                attributes["birth_year"][id_],
+                attributes["death_year"][id_],
+            ) = parse_years(dates)
+
+    author_names, author_codes = np.unique(authors.astype(str), return_inverse=True)
+    author_ids = np.argsort(author_codes, kind="stable")
+    author_offsets = np.searchsorted(
+        author_codes[author_ids], np.arange(len(author_names) + 1)
+    )
+    with open(path + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            author_names=author_names,
+            author_ids=author_ids,
+            author_offsets=author_offsets,
+            **attributes,
+        )
+    os.replace(path + ".tmp", path)
+
+
+class PoemAttributes:
+    """The precomputed attributes, for turning PoemFilters into bitmaps."""
+
+    def __init__(self, path=POEM_ATTRIBUTES_PATH):
+        with np.load(path) as arrays:
+            self.arrays = {name: arrays[name] for name in arrays.files}
+        self.author_names = [
+            name.casefold() for name in self.arrays["author_names"].tolist()
+        ]
+
+    def __len__(self):
+        return len(self.arrays["views"])
+
+    def author_mask(self, author):
+        needle = author.casefold().strip()
+        mask = np.zeros(len(self), dtype=bool)
+        ids, offsets = self.arrays["author_ids"], self.arrays["author_offsets"]
+        for code, name in enumerate(self.author_names):
+            if needle in name:
+                mask[ids[offsets[code] : offsets[code + 1]]] = True
+        return mask
+
+    def mask(self, poem_filter):
+        """Returns a boolean array of the poems matching `poem_filter`, or
+        None if it does not constrain anything."""
+        if poem_filter is None:
+            return None
+        mask = None
+        if poem_filter.author:
+            mask = self.author_mask(poem_filter.author)
+        for name, (low_field, high_field) in RANGE_FILTERS.items():
+            low = getattr(poem_filter, low_field)
+            high = getattr(poem_filter, high_field)
+            if low is None and high is None:
+                continue
+            values = self.arrays[name]
+            matches = np.ones(len(self), dtype=bool)
+            if name.endswith("_year"):
+                matches &= values != UNKNOWN_YEAR
+            if low is not None:
+                matches &= values >= low
+            if high is not None:
+                matches &= values <= high
+            mask = matches if mask is None else mask & matches
+        return mask
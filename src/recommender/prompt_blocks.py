@@ -0,0 +1,78 @@
+"""Module for the precomputed <poem> blocks included in the response prompt.
+
+Poem content never changes at serve time, so the data preparation stage
+renders and truncates every poem's <poem> block once (see
+prompts.render_poem_block) and counts its tokens. The blocks are stored as
+one UTF-8 blob with an offsets array aligned to poem id, next to an array
+of token counts, so that building a prompt at request time only slices and
+concatenates strings, and token budgets can be enforced without running
+the tokenizer."""
+import os
+import numpy as np
+
+import prompts
+import tokenizer
+import vector_searcher
+
+PROMPT_BLOCKS_PATH = "data/prompt_blocks.bin"
+PROMPT_BLOCK_OFFSETS_PATH = "data/prompt_block_offsets.npy"
+PROMPT_BLOCK_TOKENS_PATH = "data/prompt_block_tokens.npy"
+BUILD_BATCH_SIZE = 1000
+
+
+def exists(
+    blocks_path=PROMPT_BLOCKS_PATH,
+    offsets_path=PROMPT_BLOCK_OFFSETS_PATH,
+    tokens_path=PROMPT_BLOCK_TOKENS_PATH,
+):
+    return all(os.path.exists(p) for p in [blocks_path, offsets_path, tokens_path])
+
+
+def build(
+    data,
+    blocks_path=PROMPT_BLOCKS_PATH,
+    offsets_path=PROMPT_BLOCK_OFFSETS_PATH,
+    tokens_path=PROMPT_BLOCK_TOKENS_PATH,
+):
+    """Renders the prompt block of every poem in `data`, in poem id order."""
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    num_tokens = np.zeros(len(data), dtype=np.int32)
+    data = data.select_columns(list(vector_searcher.POEM_COLUMNS.values()))
+    with open(blocks_path + ".tmp", "wb") as f:
+        for start in range(0, len(data), BUILD_BATCH_SIZE):
+            rows = data[start : start + BUILD_BATCH_SIZE]
+            for poem in vector_searcher.rows_to_poems(rows):
+                block = prompts.render_poem_block(poem)
+                encoded = block.encode("utf-8")
+                f.write(encoded)
+                offsets[poem.id + 1] = len(encoded)
+                num_tokens[poem.id] = tokenizer.num_tokens(block)
+    np.cumsum(offsets, out=offsets)
+    np.save(offsets_path, offsets)
+    np.save(tokens_path, num_tokens)
+    os.replace(blocks_path + ".tmp", blocks_path)
+
+
+class PromptBlocks:
+    """Read-only, memory-mapped access to the precomputed prompt blocks."""
+
+    def __init__(
+        self,
+        blocks_path=PROMPT_BLOCKS_PATH,
+        offsets_path=PROMPT_BLOCK_OFFSETS_PATH,
+        tokens_path=PROMPT_BLOCK_TOKENS_PATH,
+    ):
+        self.blocks = np.memmap(blocks_path, dtype=np.uint8, mode="r")
+        self.offsets = np.load(offsets_path)
+        self.tokens = np.load(tokens_path)
+
+    def get(self, id_):
+        id_ = int(id_)
+        start, end = self.offsets[id_], self.offsets[id_ + 1]
+        return self.blocks[start:end].tobytes().decode("utf-8")
+
+    def num_tokens(self, id_):
+        return int(self.tokens[int(id_)])
+
+    def __len__(self):
+        return len(self.tokens)
@@ -9,9 +9,8 @@ poem candidate, and to provide an explanation for its choice.
 The LLM is given examples of how it should answer based on the user query 
 and the poem candidates (a technique known as In-Context Learning)."""
 import re
-import tiktoken
+import tokenizer
 
-TOKENIZER = "cl100k_base"
 POEM_TOKEN_LIMIT = 1000
 
 INITIAL_PROMPT = """
@@ -323,43 +322,116 @@ Remember, you must respond with an explanation of why you chose that poem using
 Only the explanation will be shown to the user. The id of the poem is internal information and should be removed from the explanation.
 """
 
+# The part of INITIAL_PROMPT before its examples. When examples are selected
+# per request (see few_shot.py), this stays the same for every request.
+INSTRUCTIONS = INITIAL_PROMPT[: INITIAL_PROMPT.index("Here are some examples:")]
+EXAMPLES_HEADER = "Here are some examples:\n"
 
-def num_tokens_from_string(string: str, encoding_name: str) -> int:
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+EXAMPLE_PROMPT = """<example>
+user:
+<query>
+    {}
+</query>
+<options>
+{}</options>
+assistant: 
+<explanation>{}</explanation>
+<id>{}</id>
+</example>
+"""
 
 
-def reduce_to_token_limit(text, limit):
-    tokens = num_tokens_from_string(text, TOKENIZER)
-    if tokens <= limit:
-        return text
-    start = 0
-    end = len(text)
-    while start <= end:
-        mid = (start + end) // 2
-        if num_tokens_from_string(text[:mid], TOKENIZER) <= limit:
-            start = mid + 1
+def render_poem_block(poem):
+    poem_text = (
+        f"id: {poem.id}\n"
+        + f"Title: {poem.title}\n"
+        + f"Author: {poem.author}\n"
+        + f"Birth and Death Dates: {poem.birth_and_death_dates}\n"
+        + f"Views: {poem.views}\n"
+        + f"Text: {poem.text}\n"
+        + f"About: {poem.about}"
+    )
+    poem_text = tokenizer.reduce_to_token_limit(poem_text, POEM_TOKEN_LIMIT)
+    return f"<poem>\n{poem_text}\n</poem>\n"
+
+
+def build_response_prompt(
+    user_query, poem_options, poem_blocks=None, token_budget=None
+):
+    """Builds the response prompt for the user query and candidate poems.
+
+    If `poem_blocks` (see prompt_blocks.py) is given, the precomputed block of
+    each poem is looked up instead of being rendered and truncated here. If
+    `token_budget` is given, candidates are packed by pack_candidates."""
+    _, blocks, _ = pack_candidates(poem_options, poem_blocks, token_budget)
+    return RESPONSE_PROMPT.format(user_query, "".join(blocks))
+
+
+def pack_candidates(poem_options, poem_blocks=None, token_budget=None):
+    """Returns the poems to include, their <poem> blocks and their tokens.
+
+    Candidates are taken in order, skipping any whose block would take the
+    total over `token_budget`, so that a long poem does not keep shorter,
+    lower ranked ones out of the prompt. Each block starts with a tag after
+    a newline, so block token counts add up exactly. Tokens are only counted
+    if there is a budget or precomputed blocks. Poems added after the blocks
+    were built (see corpus_segments.py) are rendered here."""
+    poems = []
+    blocks = []
+    total_tokens = 0
+    for poem in poem_options:
+        if poem_blocks is not None and poem.id < len(poem_blocks):
+            block = poem_blocks.get(poem.id)
+            num_tokens = poem_blocks.num_tokens(poem.id)
         else:
-            end = mid - 1
-    return text[:end]
+            block = render_poem_block(poem)
+            num_tokens = (
+                0
+                if token_budget is None and poem_blocks is None
+                else tokenizer.num_tokens(block)
+            )
+        if token_budget is not None and total_tokens + num_tokens > token_budget:
+            continue
+        poems.append(poem)
+        blocks.append(block)
+        total_tokens += num_tokens
+    return poems, blocks, total_tokens
+
+
+def render_example(example):
+    """Renders a few_shot.Example in the format of INITIAL_PROMPT's examples."""
+    options = "".join(f"<poem>\n{option}\n</poem>\n" for option in example.options)
+    return EXAMPLE_PROMPT.format(
+        example.query, options, example.explanation, example.poem_id
+    )
+
+
+def parse_examples(prompt):
+    """Returns the few_shot.Examples written out in `prompt`, such as
+    INITIAL_PROMPT, with each option's text inside its <poem> tags."""
+    examples = []
+    for text in re.findall(r"<example>(.*?)</example>", prompt, re.DOTALL):
+        examples.append(
+            (
+                re.search(r"<query>(.*?)</query>", text, re.DOTALL).group(1).strip(),
+                [
+                    option.strip("\n")
+                    for option in re.findall(r"<poem>(.*?)</poem>", text, re.DOTALL)
+                ],
+                re.search(r"<explanation>(.*?)</explanation>", text, re.DOTALL).group(
+                    1
+                ),
+                int(re.search(r"<id>(.*?)</id>", text).group(1)),
+            )
+        )
+    return examples
 
 
-def build_response_prompt(user_query, poem_options):
-    poems_text = ""
-    for poem in poem_options:
-        poem_text = (
-            f"id: {poem.id}\n"
-            + f"Title: {poem.title}\n"
-            + f"Author: {poem.author}\n"
-            + f"Birth and Death Dates: {poem.birth_and_death_dates}\n"
-            + f"Views: {poem.views}\n"
-            + f"Text: {poem.text}\n"
-            + f"About: {poem.about}"
-        )
-        poem_text = reduce_to_token_limit(poem_text, POEM_TOKEN_LIMIT)
-        poems_text += f"<poem>\n{poem_text}\n</poem>\n"
-    return RESPONSE_PROMPT.format(user_query, poems_text)
+def build_system_prompt(examples):
+    """Returns INSTRUCTIONS followed by `examples`, already rendered."""
+    if not examples:
+        return INSTRUCTIONS
+    return INSTRUCTIONS + EXAMPLES_HEADER + "".join(examples)
 
 
 def extract_response(response):
@@ -373,3 +445,57 @@ def extract_response(response):
         raise ValueError("Response does not contain an id.")
     id_ = id_match.group(1)
     return explanation, id_
+
+
+class ResponseParser:
+    """Parses a response incrementally as it is streamed.
+
+    feed returns the explanation text that can be shown so far. Text that
+    could be the start of the closing </explanation> tag is held back until
+    the next chunk shows whether it is. `id` is set as soon as the </id> tag
+    closes, and finish returns the same (explanation, id) as
+    extract_response, except that the explanation may span several lines."""
+
+    def __init__(self):
+        self.text = ""
+        self.explanation_start = None
+        self.explanation_end = None
+        self.shown = 0
+        self.id = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        if self.id is None:
+            id_match = re.search(r"<id>(.*?)</id>", self.text)
+            if id_match is not None:
+                self.id = id_match.group(1)
+        if self.explanation_start is None:
+            start = self.text.find("<explanation>")
+            if start < 0:
+                return ""
+            self.explanation_start = self.shown = start + len("<explanation>")
+        if self.explanation_end is not None:
+            return ""
+        end = self.text.find("</explanation>", self.shown)
+        if end >= 0:
+            self.explanation_end = end
+        else:
+            end = len(self.text) - _partial_tag_length(self.text, "</explanation>")
+        new_text = self.text[self.shown : end]
+        self.shown = max(self.shown, end)
+        return new_text
+
+    def finish(self):
+        if self.explanation_end is None:
+            raise ValueError("Response does not contain an explanation.")
+        if self.id is None:
+            raise ValueError("Response does not contain an id.")
+        return self.text[self.explanation_start : self.explanation_end], self.id
+
+
+def _partial_tag_length(text, tag):
+    """Returns the length of the longest proper prefix of `tag` ending `text`."""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
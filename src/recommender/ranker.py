@@ -0,0 +1,70 @@
+"""Module for re-ranking candidate poems before they are passed to the LLM.
+
+Every candidate in the response prompt costs up to POEM_TOKEN_LIMIT prompt
+tokens, and the prompt length dominates the latency of the chat completion.
+The Ranker over-fetches candidates from the vector search and orders them
+by maximal marginal relevance (MMR): a candidate's relevance (its cosine
+similarity to the query plus a popularity prior from its view count) minus
+its similarity to the candidates ranked before it. Near-duplicates of a
+higher ranked poem fall down the list, so when the token budget in
+prompts.build_response_prompt only fits a few candidates, they cover
+different readings of the request."""
+import numpy as np
+
+DEFAULT_FETCH_LIMIT = 30
+DEFAULT_MAX_CANDIDATES = 10
+DEFAULT_DIVERSITY = 0.3
+DEFAULT_VIEWS_WEIGHT = 0.02
+
+
+def normalize_rows(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class Ranker:
+    """MMR re-ranker for candidate poems.
+
+    `fetch_limit` candidates are fetched from the vector search and at most
+    `max_candidates` are returned. `diversity` (between 0 and 1) trades
+    relevance for dissimilarity to higher ranked candidates, and
+    `views_weight` is the weight of the popularity prior, the log view count
+    scaled to [0, 1] over the fetched candidates."""
+
+    def __init__(
+        self,
+        fetch_limit=DEFAULT_FETCH_LIMIT,
+        max_candidates=DEFAULT_MAX_CANDIDATES,
+        diversity=DEFAULT_DIVERSITY,
+        views_weight=DEFAULT_VIEWS_WEIGHT,
+    ):
+        self.fetch_limit = fetch_limit
+        self.max_candidates = max_candidates
+        self.diversity = diversity
+        self.views_weight = views_weight
+
+    def relevance(self, query_embedding, poems, embeddings):
+        similarity = normalize_rows(embeddings) @ normalize_rows(query_embedding)
+        views = np.log1p(np.maximum([float(poem.views or 0) for poem in poems], 0.0))
+        prior = views / views.max() if views.max() > 0 else views
+        return similarity + self.views_weight * prior
+
+    def rank(self, query_embedding, poems, embeddings):
+        """Returns up to max_candidates of `poems`, best first. `embeddings`
+        holds the embedding of each poem, in the same order."""
+        if not poems:
+            return []
+        embeddings = normalize_rows(embeddings)
+        relevance = self.relevance(query_embedding, poems, embeddings)
+        pairwise = embeddings @ embeddings.T
+        redundancy = np.zeros(len(poems), dtype=np.float32)
+        remaining = np.ones(len(poems), dtype=bool)
+        ranked = []
+        for _ in range(min(self.max_candidates, len(poems))):
+            scores = (1 - self.diversity) * relevance - self.diversity * redundancy
+            best = int(np.argmax(np.where(remaining, scores, -np.inf)))
+            ranked.append(poems[best])
+            remaining[best] = False
+            redundancy = np.maximum(redundancy, pairwise[:, best])
+        return ranked
@@ -1,5 +1,87 @@
 """Module for recommending poetry based on user queries."""
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+import chatgpt
+import few_shot
+import prompt_blocks
 import prompts
+import telemetry
+import tokenizer
+
+CANDIDATE_LIMIT = 10
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_PENDING = 64
+EMPTY_QUERY_RESULT = ("Please enter a query.", "")
+FAILED_RESULT = ("Sorry, please try again with a different query.", "")
+
+RecommendationUpdate = collections.namedtuple(
+    "RecommendationUpdate",
+    ["explanation", "poem_text", "first_token_seconds", "total_seconds"],
+)
+
+# A request ready for the LLM, or answered already if `result` is set.
+PreparedRequest = collections.namedtuple(
+    "PreparedRequest", ["query_embedding", "poem_results", "result", "messages"]
+)
+
+
+class StreamedResponse:
+    """Parses a streamed LLM response into RecommendationUpdates.
+
+    Updates hold the explanation so far and, once the </id> tag has closed,
+    the selected poem's text. Times are measured from `start`."""
+
+    def __init__(self, recommender, poem_results, start):
+        self.recommender = recommender
+        self.poem_results = poem_results
+        self.start = start
+        self.parser = prompts.ResponseParser()
+        self.explanation = ""
+        self.poem_text = None
+        self.first_token_seconds = None
+        self.llm_start = time.perf_counter()
+
+    def feed(self, chunk):
+        """Returns an update if `chunk` changed what can be shown, else None."""
+        new_text = self.parser.feed(chunk)
+        changed = bool(new_text)
+        if new_text and self.first_token_seconds is None:
+            self.first_token_seconds = time.perf_counter() - self.start
+        self.explanation += new_text
+        if self.poem_text is None and self.parser.id is not None:
+            try:
+                _, self.poem_text = self.recommender.build_recommendation_result(
+                    self.parser.id, "", self.poem_results
+                )
+                changed = True
+            except (ValueError, IndexError):
+                pass
+        if not changed:
+            return None
+        return RecommendationUpdate(
+            self.explanation, self.poem_text, self.first_token_seconds, None
+        )
+
+    def finish(self):
+        return self.parser.finish()
+
+    def record(self, trace):
+        """Records the LLM stage and time to first token in `trace`."""
+        trace.record("llm", self.llm_start)
+        trace.set(first_token_seconds=self.first_token_seconds)
+
+    def final_update(self, result):
+        return final_update(result, self.start, self.first_token_seconds)
+
+
+def final_update(result, start, first_token_seconds=None):
+    total_seconds = time.perf_counter() - start
+    if first_token_seconds is None:
+        first_token_seconds = total_seconds
+    return RecommendationUpdate(*result, first_token_seconds, total_seconds)
 
 
 class Recommender:
@@ -13,29 +95,399 @@ class Recommender:
     known as Retrieval-Augmented Generation, or RAG). The prompt asks the LLM
     to select the poem most suitable for the user along with an explanation.
     Examples of desired query-candidate/selection-explanation pairs are
-    included in the prompt (see prompts.py)."""
+    included in the prompt (see prompts.py).
+
+    ask keeps no per-request state on the instance, so it can be called from
+    several threads at once. submit and ask_many run requests on a pool of
+    `max_workers` threads, and submit blocks once `max_pending` requests are
+    queued or running, so a burst cannot grow the queue without bound.
+
+    If the precomputed prompt blocks exist (see prompt_blocks.py), candidate
+    poems are included in the prompt from them instead of being rendered and
+    tokenized per request, and `prompt_token_budget` caps their tokens.
+
+    If a `response_cache` (see response_cache.py) is given, the selection of
+    an earlier, similar request is returned without calling the LLM when
+    its candidates overlap enough with the new request's candidates.
+
+    If a `ranker` (see ranker.py) is given, more candidates are fetched from
+    the vector search and re-ranked by it before the prompt is built. Pair
+    it with `prompt_token_budget` to trade candidates for prompt tokens.
 
-    def __init__(self, vector_searcher, chat):
+    If a `tracer` (a telemetry.Telemetry) is given, each request is recorded
+    as a trace of its stages, token counts and outcome.
+
+    If the few-shot example bank exists (see few_shot.py), the system message
+    holds only the `example_limit` examples most relevant to each request
+    that fit in `example_token_budget`, instead of all of INITIAL_PROMPT's.
+
+    If the lexical index exists (see lexical_index.py), candidates are found
+    by fusing keyword and vector search, and a request whose query cannot
+    be embedded in time is answered from keyword search alone."""
+
+    def __init__(
+        self,
+        vector_searcher,
+        chat,
+        max_workers=DEFAULT_MAX_WORKERS,
+        max_pending=DEFAULT_MAX_PENDING,
+        poem_blocks=None,
+        prompt_token_budget=None,
+        response_cache=None,
+        ranker=None,
+        tracer=None,
+        example_bank=None,
+        example_limit=few_shot.DEFAULT_LIMIT,
+        example_token_budget=few_shot.DEFAULT_TOKEN_BUDGET,
+    ):
         self.vector_searcher = vector_searcher
         self.chat = chat
+        if poem_blocks is None and prompt_blocks.exists():
+            poem_blocks = prompt_blocks.PromptBlocks()
+        self.poem_blocks = poem_blocks
+        self.prompt_token_budget = prompt_token_budget
+        self.response_cache = response_cache
+        self.ranker = ranker
+        self.tracer = tracer
+        if example_bank is None and few_shot.exists():
+            example_bank = few_shot.ExampleBank()
+        self.example_bank = example_bank
+        self.example_limit = example_limit
+        self.example_token_budget = example_token_budget
         self.chat.set_system_message(prompts.INITIAL_PROMPT)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = threading.BoundedSemaphore(max(max_pending, max_workers))
 
-    def build_recommendation_result(self, poem_id, explanation):
-        poem = self.vector_searcher.convert_to_poem(poem_id)
+    def warm(self):
+        """Loads everything the first request would otherwise wait for: the
+        index and dataset pages, the tokenizer and the API connections."""
+        self.vector_searcher.warm()
+        tokenizer.get_encoding()
+        if self.poem_blocks is not None and len(self.poem_blocks):
+            self.poem_blocks.get(0)
+        self.chat.warm()
+
+    def build_recommendation_result(self, poem_id, explanation, poem_results=()):
+        """Formats the selected poem, reusing it from `poem_results` if it
+        was one of the candidates instead of reading its row again."""
+        poem_id = int(poem_id)
+        poem = next((p for p in poem_results if p.id == poem_id), None)
+        if poem is None:
+            poem = self.vector_searcher.get_poems([poem_id])[0]
         poem_text = f"{poem.title}\n" + f"By {poem.author}\n\n" + f"{poem.text}"
         return explanation, poem_text
 
-    def ask(self, user_query):
-        if user_query == "":
-            return "Please enter a query.", ""
-        poem_results = self.vector_searcher.search(user_query, limit=10)
-        self.chat.add_assistant_message(
-            prompts.build_response_prompt(user_query, poem_results)
+    def ask(self, user_query, poem_filter=None):
+        with self.start_trace("ask") as trace:
+            if user_query == "":
+                trace.outcome = "empty"
+                return EMPTY_QUERY_RESULT
+            with trace.span("embed"):
+                query_embeddings = self.vector_searcher.try_embed_queries([user_query])
+            request = self.prepare(user_query, query_embeddings, poem_filter, trace)
+            if request.result is not None:
+                return request.result
+            with trace.span("llm"):
+                response = self.chat.complete(request.messages, trace)
+            return self.respond(
+                user_query,
+                request,
+                lambda: prompts.extract_response(response),
+                poem_filter,
+                trace,
+            )
+
+    def ask_stream(self, user_query, poem_filter=None):
+        """Like ask, but yields RecommendationUpdates as the LLM response
+        streams in, so the explanation can be shown as it is written.
+
+        The last update has total_seconds set, and the same explanation and
+        poem text as ask would return."""
+        start = time.perf_counter()
+        with self.start_trace("ask_stream") as trace:
+            if user_query == "":
+                trace.outcome = "empty"
+                yield final_update(EMPTY_QUERY_RESULT, start)
+                return
+            with trace.span("embed"):
+                query_embeddings = self.vector_searcher.try_embed_queries([user_query])
+            request = self.prepare(user_query, query_embeddings, poem_filter, trace)
+            if request.result is not None:
+                yield final_update(request.result, start)
+                return
+            response = StreamedResponse(self, request.poem_results, start)
+            for chunk in self.chat.stream(request.messages):
+                update = response.feed(chunk)
+                if update is not None:
+                    yield update
+            response.record(trace)
+            yield response.final_update(
+                self.respond(user_query, request, response.finish, poem_filter, trace)
+            )
+
+    def prepare(
+        self, user_query, query_embeddings, poem_filter=None, trace=telemetry.NULL_TRACE
+    ):
+        """Runs the steps of a request between embedding the query and
+        calling the LLM, and returns a PreparedRequest: the cached response
+        if there is one (see find_candidates), else the messages to send."""
+        query_embedding = None if query_embeddings is None else query_embeddings[0]
+        poem_results, cached = self.find_candidates(
+            query_embeddings, poem_filter, trace, user_query
+        )
+        if cached is not None:
+            trace.outcome = "cached"
+            with trace.span("render"):
+                result = self.build_recommendation_result(
+                    cached.poem_id, cached.explanation, poem_results
+                )
+            return PreparedRequest(query_embedding, poem_results, result, None)
+        prompt = self.build_prompt(user_query, poem_results, trace)
+        system_message = self.build_system_message(query_embedding, trace)
+        return PreparedRequest(
+            query_embedding,
+            poem_results,
+            None,
+            self.build_messages(user_query, prompt, system_message),
         )
-        response = self.chat.respond(user_query)
-        self.chat.reset_messages()
+
+    def respond(
+        self, user_query, request, parse, poem_filter=None, trace=telemetry.NULL_TRACE
+    ):
+        """Returns the result for the LLM's response, which `parse` returns
+        as (explanation, poem id), and caches it. Returns FAILED_RESULT if
+        the response cannot be parsed or names no poem in the corpus."""
         try:
-            explanation, id_ = prompts.extract_response(response)
-            return self.build_recommendation_result(id_, explanation)
-        except ValueError:
-            return "Sorry, please try again with a different query.", ""
+            with trace.span("parse"):
+                explanation, id_ = parse()
+            with trace.span("render"):
+                result = self.build_recommendation_result(
+                    id_, explanation, request.poem_results
+                )
+        except (ValueError, IndexError):
+            trace.outcome = "failed"
+            return FAILED_RESULT
+        self.cache_response(
+            user_query,
+            request.query_embedding,
+            request.poem_results,
+            explanation,
+            id_,
+            poem_filter,
+        )
+        return result
+
+    def start_trace(self, name):
+        """Returns a telemetry.Trace for a request, or NULL_TRACE if there is
+        no tracer."""
+        if self.tracer is None:
+            return telemetry.NULL_TRACE
+        return self.tracer.trace(name)
+
+    def find_candidates(
+        self,
+        query_embeddings,
+        poem_filter=None,
+        trace=telemetry.NULL_TRACE,
+        user_query=None,
+    ):
+        """Returns the candidate poems for a query embedding, and the cached
+        response to a similar request with similar candidates, if any.
+
+        Requests with a `poem_filter` (see poem_filters.py) only consider
+        matching poems, and bypass the response cache. If `user_query` is
+        given, it is also searched in the lexical index, if there is one
+        (see VectorSearch.search_embeddings). If `query_embeddings` is None,
+        because the embeddings API was unavailable, the candidates are the
+        lexical index's results alone, without re-ranking or the cache."""
+        if query_embeddings is None:
+            trace.set(retrieval="lexical")
+            poem_results = self.vector_searcher.search_lexical(
+                [user_query], CANDIDATE_LIMIT, poem_filter, trace
+            )[0]
+            return poem_results, None
+        query_texts = None if user_query is None else [user_query]
+        if self.ranker is None:
+            poem_results = self.vector_searcher.search_embeddings(
+                query_embeddings, CANDIDATE_LIMIT, poem_filter, trace, query_texts
+            )[0]
+        else:
+            poem_results = self.vector_searcher.search_embeddings(
+                query_embeddings,
+                self.ranker.fetch_limit,
+                poem_filter,
+                trace,
+                query_texts,
+            )[0]
+            with trace.span("rank"):
+                poem_results = self.ranker.rank(
+                    query_embeddings[0],
+                    poem_results,
+                    self.vector_searcher.get_embeddings([p.id for p in poem_results]),
+                )
+        cached = None
+        if self.response_cache is not None and poem_filter is None:
+            with trace.span("cache"):
+                cached = self.response_cache.get(
+                    query_embeddings[0], [poem.id for poem in poem_results]
+                )
+        return poem_results, cached
+
+    def cache_response(
+        self,
+        user_query,
+        query_embedding,
+        poem_results,
+        explanation,
+        poem_id,
+        poem_filter=None,
+    ):
+        if (
+            self.response_cache is not None
+            and poem_filter is None
+            and query_embedding is not None
+        ):
+            self.response_cache.put(
+                user_query,
+                query_embedding,
+                [poem.id for poem in poem_results],
+                explanation,
+                poem_id,
+            )
+
+    def build_prompt(self, user_query, poem_results, trace=telemetry.NULL_TRACE):
+        """Builds the response prompt (see prompts.build_response_prompt),
+        recording the number of candidates and their tokens in `trace`.
+        Candidate tokens are only known with prompt blocks or a budget."""
+        with trace.span("prompt"):
+            poems, blocks, tokens = prompts.pack_candidates(
+                poem_results, self.poem_blocks, self.prompt_token_budget
+            )
+            prompt = prompts.RESPONSE_PROMPT.format(user_query, "".join(blocks))
+        trace.set(candidates=len(poems), candidate_tokens=tokens)
+        return prompt
+
+    def build_system_message(self, query_embedding, trace=telemetry.NULL_TRACE):
+        """Returns the system message with the few-shot examples selected for
+        the query, or None to use the chat's, if there is no example bank.
+        The number of examples and their tokens are recorded in `trace`."""
+        if self.example_bank is None:
+            return None
+        with trace.span("examples"):
+            selected, tokens = self.example_bank.select(
+                query_embedding, self.example_limit, self.example_token_budget
+            )
+            content = self.example_bank.system_prompt(selected)
+        trace.set(examples=len(selected), example_tokens=tokens)
+        return chatgpt.Message("system", content)
+
+    def build_messages(self, user_query, prompt, system_message=None):
+        return self.chat.build_messages(
+            user_query,
+            history=(chatgpt.Message("assistant", prompt),),
+            system_message=system_message,
+        )
+
+    def submit(self, user_query, poem_filter=None):
+        """Schedules ask(user_query) on the worker pool and returns a Future."""
+        self.pending.acquire()  # pylint: disable=consider-using-with
+        future = self.executor.submit(self.ask, user_query, poem_filter)
+        future.add_done_callback(lambda _: self.pending.release())
+        return future
+
+    def ask_many(self, user_queries):
+        """Answers `user_queries` in parallel, returning results in order."""
+        futures = [self.submit(user_query) for user_query in user_queries]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class AsyncRecommender(Recommender):
+    """Recommender whose pipeline can be awaited without blocking the loop.
+
+    The embeddings and chat requests are made with OpenAI's async client, and
+    the CPU-bound FAISS search, row fetches and prompt tokenization run on
+    the worker pool. Each request builds its own message list, so many
+    recommendations can be in flight at once."""
+
+    async def awarm(self):
+        """Opens the async clients' API connections. These are bound to the
+        running event loop, so this must run on the loop that serves
+        requests, unlike warm."""
+        await asyncio.gather(self.vector_searcher.awarm(), self.chat.awarm())
+
+    async def aask(self, user_query, poem_filter=None):
+        with self.start_trace("aask") as trace:
+            if user_query == "":
+                trace.outcome = "empty"
+                return EMPTY_QUERY_RESULT
+            loop = asyncio.get_running_loop()
+            with trace.span("embed"):
+                query_embeddings = await self.vector_searcher.atry_embed_queries(
+                    [user_query]
+                )
+            request = await loop.run_in_executor(
+                self.executor,
+                self.prepare,
+                user_query,
+                query_embeddings,
+                poem_filter,
+                trace,
+            )
+            if request.result is not None:
+                return request.result
+            with trace.span("llm"):
+                response = await self.chat.acomplete(request.messages, trace)
+            return await loop.run_in_executor(
+                self.executor,
+                self.respond,
+                user_query,
+                request,
+                lambda: prompts.extract_response(response),
+                poem_filter,
+                trace,
+            )
+
+    async def aask_stream(self, user_query, poem_filter=None):
+        """Async variant of ask_stream."""
+        start = time.perf_counter()
+        with self.start_trace("aask_stream") as trace:
+            if user_query == "":
+                trace.outcome = "empty"
+                yield final_update(EMPTY_QUERY_RESULT, start)
+                return
+            loop = asyncio.get_running_loop()
+            with trace.span("embed"):
+                query_embeddings = await self.vector_searcher.atry_embed_queries(
+                    [user_query]
+                )
+            request = await loop.run_in_executor(
+                self.executor,
+                self.prepare,
+                user_query,
+                query_embeddings,
+                poem_filter,
+                trace,
+            )
+            if request.result is not None:
+                yield final_update(request.result, start)
+                return
+            response = StreamedResponse(self, request.poem_results, start)
+            async for chunk in self.chat.astream(request.messages):
+                update = response.feed(chunk)
+                if update is not None:
+                    yield update
+            response.record(trace)
+            yield response.final_update(
+                await loop.run_in_executor(
+                    self.executor,
+                    self.respond,
+                    user_query,
+                    request,
+                    response.finish,
+                    poem_filter,
+                    trace,
+                )
+            )
@@ -0,0 +1,211 @@
+"""Module for caching recommendations of semantically similar requests.
+
+Most of the latency and cost of a recommendation is the chat completion
+that selects a poem from the candidates. Requests are often paraphrases of
+each other, so the ResponseCache stores each selection (explanation and
+poem id) with the embedding of its query and its candidate poem ids. A new
+request is answered from the cache if its query embedding is within a
+cosine similarity threshold of a cached query and enough of its candidates
+are shared with that query's candidates, so that the cached poem is one the
+LLM could have selected for it. The cached query embeddings are searched
+with a small exact FAISS index, and entries are persisted to a SQLite file
+so that they survive restarts."""
+import collections
+import os
+import sqlite3
+import threading
+import time
+import faiss
+import numpy as np
+
+CACHE_PATH = "data/responses.sqlite"
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_MIN_OVERLAP = 0.6
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+NUM_NEIGHBORS = 4
+
+CachedResponse = collections.namedtuple(
+    "CachedResponse",
+    ["query", "embedding", "candidate_ids", "explanation", "poem_id", "created"],
+)
+
+
+def normalize(embedding):
+    embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    return embedding / max(np.linalg.norm(embedding), 1e-12)
+
+
+def candidate_overlap(candidate_ids, cached_candidate_ids):
+    """Returns the fraction of the cached candidates that are candidates."""
+    if not cached_candidate_ids:
+        return 0.0
+    shared = set(candidate_ids) & set(cached_candidate_ids)
+    return len(shared) / len(cached_candidate_ids)
+
+
+class ResponseCache:
+    """Semantic cache of recommendations, keyed by query embedding.
+
+    A lookup is a hit if a cached query has cosine similarity of at least
+    `threshold` with the new query, `min_overlap` of its candidates are
+    among the new query's candidates, and so is its cached poem. The cache
+    evicts the least recently used entry once it holds `max_size` entries.
+    Entries older than `ttl` seconds are misses, and are evicted when a
+    lookup finds them. Pass `path=None` for a memory-only cache."""
+
+    def __init__(
+        self,
+        path=CACHE_PATH,
+        threshold=DEFAULT_THRESHOLD,
+        min_overlap=DEFAULT_MIN_OVERLAP,
+        max_size=DEFAULT_MAX_SIZE,
+        ttl=DEFAULT_TTL_SECONDS,
+    ):
+        self.threshold = threshold
+        self.min_overlap = min_overlap
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.index = None
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.low_overlap = 0
+        self.db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (id INTEGER PRIMARY KEY, "
+                + "query TEXT, embedding BLOB, candidate_ids BLOB, "
+                + "explanation TEXT, poem_id INTEGER, created REAL)"
+            )
+            self.db.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - ttl,)
+            )
+            self.db.commit()
+            rows = self.db.execute(
+                "SELECT * FROM (SELECT * FROM responses ORDER BY created DESC "
+                + "LIMIT ?) ORDER BY created",
+                (max_size,),
+            ).fetchall()
+            for id_, query, embedding, candidate_ids, *rest in rows:
+                self._remember(
+                    id_,
+                    CachedResponse(
+                        query,
+                        np.frombuffer(embedding, dtype=np.float32),
+                        tuple(np.frombuffer(candidate_ids, dtype=np.int64).tolist()),
+                        *rest,
+                    ),
+                )
+
+    def get(self, query_embedding, candidate_ids):
+        """Returns the CachedResponse for a similar request, or None."""
+        query_embedding = normalize(query_embedding)
+        now = time.time()
+        with self.lock:
+            if self.index is None or self.index.ntotal == 0:
+                self.misses += 1
+                return None
+            # pylint: disable-next=no-value-for-parameter
+            similarities, ids = self.index.search(
+                query_embedding[np.newaxis], NUM_NEIGHBORS
+            )
+            similar = False
+            expired = []
+            hit = None
+            for similarity, id_ in zip(similarities[0], ids[0]):
+                if id_ < 0 or similarity < self.threshold:
+                    break
+                entry = self.entries[int(id_)]
+                if now - entry.created > self.ttl:
+                    expired.append(int(id_))
+                    continue
+                similar = True
+                if (
+                    entry.poem_id in candidate_ids
+                    and candidate_overlap(candidate_ids, entry.candidate_ids)
+                    >= self.min_overlap
+                ):
+                    self.entries.move_to_end(int(id_))
+                    hit = entry
+                    break
+            if expired:
+                for id_ in expired:
+                    del self.entries[id_]
+                self._forget(expired)
+            if hit is not None:
+                self.hits += 1
+                return hit
+            if similar:
+                self.low_overlap += 1
+            self.misses += 1
+            return None
+
+    def put(self, query, query_embedding, candidate_ids, explanation, poem_id):
+        entry = CachedResponse(
+            query,
+            normalize(query_embedding),
+            tuple(int(id_) for id_ in candidate_ids),
+            explanation,
+            int(poem_id),
+            time.time(),
+        )
+        with self.lock:
+            id_ = self.next_id
+            if self.db is not None:
+                id_ = self.db.execute(
+                    "INSERT INTO responses (query, embedding, candidate_ids, "
+                    + "explanation, poem_id, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        entry.query,
+                        entry.embedding.tobytes(),
+                        np.array(entry.candidate_ids, dtype=np.int64).tobytes(),
+                        entry.explanation,
+                        entry.poem_id,
+                        entry.created,
+                    ),
+                ).lastrowid
+            if self.db is not None:
+                self.db.commit()
+            self._remember(id_, entry)
+
+    def _remember(self, id_, entry):
+        """Adds an entry to the index, evicting the least recently used
+        entries beyond `max_size`."""
+        if self.index is None:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(len(entry.embedding)))
+        self.entries[id_] = entry
+        self.next_id = max(self.next_id, id_ + 1)
+        self.index.add_with_ids(  # pylint: disable=no-value-for-parameter
+            entry.embedding[np.newaxis], np.array([id_], dtype=np.int64)
+        )
+        evicted = []
+        while len(self.entries) > self.max_size:
+            evicted.append(self.entries.popitem(last=False)[0])
+        if evicted:
+            self._forget(evicted)
+
+    def _forget(self, ids):
+        """Removes entries already dropped from `entries` from the index and
+        the SQLite file."""
+        self.index.remove_ids(np.array(ids, dtype=np.int64))
+        if self.db is not None:
+            self.db.executemany(
+                "DELETE FROM responses WHERE id = ?", [(int(id_),) for id_ in ids]
+            )
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "low_overlap": self.low_overlap,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries),
+            }
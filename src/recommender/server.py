@@ -0,0 +1,336 @@
+"""Module for serving recommendations over HTTP/JSON from several processes.
+
+A single recommender process is limited by the GIL for the CPU-bound parts
+of a request (search, row fetch, prompt building), so throughput comes
+from running several processes. Rather than each loading its own copy of
+the dataset and index, the server loads them once and then forks its
+workers (the pre-fork model). The embedding matrix, FAISS index, Arrow
+dataset and prompt blocks are all memory-mapped read-only, so the workers
+share their pages with the parent through the page cache, and the Python
+objects created before the fork are frozen out of the garbage collector
+so that they stay shared copy-on-write. Each worker only creates its own
+API clients, caches and threads.
+
+All workers accept connections from one listening socket. Each runs at
+most `concurrency` requests at a time, queues up to `queue_size` more and
+answers 503 beyond that. Endpoints:
+
+- POST /recommend with {"query": "...", "filter": {...}} returns
+  {"explanation": "...", "poem": "..."}. "filter" is optional and holds
+  poem_filters.PoemFilter fields. A request that raises is answered with
+  500 and counted in server_errors_total by exception type.
+- GET /health returns the status of the worker that answered.
+- GET /metrics returns the metrics of all workers in the Prometheus text
+  format (see telemetry.py). Each worker publishes a snapshot of its
+  metrics every METRICS_INTERVAL_SECONDS, so other workers' numbers can be
+  that old.
+
+Each worker checks for new corpus segments (see corpus_segments.py) every
+vector_searcher.SEGMENT_POLL_SECONDS and serves them from then on, so poems
+can be added and segments compacted without restarting the server.
+
+Requires os.fork, so it runs on Linux and macOS. Run it from the root
+directory: `python3 src/recommender/server.py [--workers 4] [--port 8000]`
+"""
+import argparse
+import gc
+import glob
+import http.server
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import telemetry
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+DEFAULT_WORKERS = 2
+DEFAULT_CONCURRENCY = 8
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_TIMEOUT_SECONDS = 60
+METRICS_INTERVAL_SECONDS = 5
+LISTEN_BACKLOG = 1024
+MAX_BODY_BYTES = 64 * 1024
+
+
+class SharedState:
+    """The read-only state loaded before the workers are forked."""
+
+    def __init__(self, index_type="flat"):
+        # pylint: disable=import-outside-toplevel
+        import chatgpt
+        import embedding_cache
+        import poem_filters
+        import prompt_blocks
+        import recommender
+        import vector_searcher
+
+        # pylint: enable=import-outside-toplevel
+        # The query cache opens a SQLite file, which must not be inherited,
+        # so the parent's is memory-only and each worker opens its own.
+        self.searcher = vector_searcher.VectorSearch(
+            index_type, query_cache=embedding_cache.EmbeddingCache(None)
+        )
+        self.poem_blocks = None
+        if prompt_blocks.exists():
+            self.poem_blocks = prompt_blocks.PromptBlocks()
+        if poem_filters.exists():
+            self.searcher.get_attributes()
+        self.chatgpt = chatgpt
+        self.recommender = recommender
+        self.poem_filters = poem_filters
+
+
+class Worker:
+    """A forked worker process's recommender and request accounting."""
+
+    def __init__(self, shared, concurrency, queue_size, timeout, metrics_dir):
+        shared.searcher.reconnect()
+        shared.searcher.refresh()
+        shared.searcher.watch_segments()
+        self.shared = shared
+        self.tracer = telemetry.Telemetry()
+        self.recommender = shared.recommender.Recommender(
+            shared.searcher,
+            shared.chatgpt.ChatGPT(),
+            max_workers=concurrency,
+            max_pending=concurrency + queue_size,
+            poem_blocks=shared.poem_blocks,
+            tracer=self.tracer,
+        )
+        self.recommender.warm()
+        # One slot per running or queued request; requests beyond that are
+        # rejected rather than left to wait on an unbounded queue.
+        self.slots = threading.BoundedSemaphore(concurrency + queue_size)
+        self.timeout = timeout
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+        self.metrics_dir = metrics_dir
+        self.metrics_path = os.path.join(metrics_dir, f"{os.getpid()}.json")
+        self.publish_metrics()
+        threading.Thread(target=self._publish_periodically, daemon=True).start()
+
+    def recommend(self, query, poem_filter):
+        """Returns the recommendation, or None if the queue is full."""
+        # pylint: disable-next=consider-using-with
+        if not self.slots.acquire(blocking=False):
+            self.tracer.metrics.inc("server_rejected_total")
+            return None
+        with self.in_flight_lock:
+            self.in_flight += 1
+        try:
+            future = self.recommender.submit(query, poem_filter)
+            try:
+                return future.result(self.timeout)
+            except TimeoutError:
+                future.cancel()
+                raise
+        finally:
+            with self.in_flight_lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def publish_metrics(self):
+        tmp_path = self.metrics_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.tracer.metrics.snapshot(), f)
+        os.replace(tmp_path, self.metrics_path)
+
+    def _publish_periodically(self):
+        while True:
+            time.sleep(METRICS_INTERVAL_SECONDS)
+            self.publish_metrics()
+
+    def render_metrics(self):
+        """Returns the merged metrics of every worker, this one's current."""
+        self.publish_metrics()
+        merged = telemetry.Metrics()
+        for path in glob.glob(os.path.join(self.metrics_dir, "*.json")):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    merged.merge(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return merged.render()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Routes requests to the server's Worker."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        worker = self.server.worker
+        if self.path == "/health":
+            self.send_json(
+                {
+                    "status": "ok",
+                    "pid": os.getpid(),
+                    "in_flight": worker.in_flight,
+                    "poems": worker.shared.searcher.num_poems(),
+                    "segments_version": worker.shared.searcher.segments.version,
+                }
+            )
+        elif self.path == "/metrics":
+            self.send_text(worker.render_metrics())
+        else:
+            self.send_json({"error": "Not found."}, 404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        if self.path != "/recommend":
+            self.send_json({"error": "Not found."}, 404)
+            return
+        worker = self.server.worker
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > MAX_BODY_BYTES:
+                raise ValueError("The request body is too large.")
+            body = json.loads(self.rfile.read(length))
+            query = body["query"]
+            if not isinstance(query, str) or not query.strip():
+                raise ValueError("query must be a non-empty string.")
+            poem_filter = None
+            if body.get("filter"):
+                poem_filter = worker.shared.poem_filters.PoemFilter(**body["filter"])
+        except (KeyError, TypeError, ValueError) as e:
+            # The body may not have been read, so the connection is not reused.
+            # pylint: disable-next=attribute-defined-outside-init
+            self.close_connection = True
+            self.send_json({"error": f"Bad request: {e}"}, 400)
+            return
+        try:
+            result = worker.recommend(query, poem_filter)
+        except TimeoutError:
+            self.send_json({"error": "The recommendation timed out."}, 504)
+            return
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            worker.tracer.metrics.inc("server_errors_total", type=type(e).__name__)
+            self.send_json({"error": "The recommendation failed."}, 500)
+            return
+        if result is None:
+            self.send_json({"error": "The server is busy, try again later."}, 503)
+            return
+        explanation, poem_text = result
+        self.send_json({"explanation": explanation, "poem": poem_text})
+
+    def send_json(self, payload, status=200):
+        self.send_content(json.dumps(payload), "application/json", status)
+        worker = getattr(self.server, "worker", None)
+        if worker is not None:
+            worker.tracer.metrics.inc("server_responses_total", status=status)
+
+    def send_text(self, text):
+        self.send_content(text, "text/plain; version=0.0.4")
+
+    def send_content(self, text, content_type, status=200):
+        content = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def run_worker(listener, shared, args, metrics_dir):
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    server = http.server.ThreadingHTTPServer(
+        listener.getsockname()[:2], Handler, bind_and_activate=False
+    )
+    server.socket.close()
+    server.socket = listener
+    server.daemon_threads = True
+    server.worker = Worker(
+        shared, args.concurrency, args.queue_size, args.timeout, metrics_dir
+    )
+    print(f"Worker {os.getpid()} ready")
+    server.serve_forever()
+
+
+def fork_worker(listener, shared, args, metrics_dir):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            run_worker(listener, shared, args, metrics_dir)
+        except SystemExit as e:
+            status = e.code or 0
+        except BaseException:  # pylint: disable=broad-exception-caught
+            status = 1
+            import traceback  # pylint: disable=import-outside-toplevel
+
+            traceback.print_exc()
+        finally:
+            os._exit(status)  # pylint: disable=protected-access
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="requests each worker runs at once",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help="requests each worker queues before answering 503",
+    )
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT_SECONDS)
+    parser.add_argument(
+        "--index-type", default="flat", help="see embedding_index.INDEX_FACTORIES"
+    )
+    args = parser.parse_args()
+
+    listener = socket.create_server((args.host, args.port), backlog=LISTEN_BACKLOG)
+    start = time.perf_counter()
+    shared = SharedState(args.index_type)
+    print(f"Loaded shared state in {time.perf_counter() - start:.2f}s")
+    # Objects that exist now are never freed, so keeping the collector from
+    # touching them keeps their pages shared with the workers.
+    gc.freeze()
+    metrics_dir = tempfile.mkdtemp(prefix="poem-server-metrics-")
+
+    workers = set()
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(args.workers):
+        workers.add(fork_worker(listener, shared, args, metrics_dir))
+    print(f"Serving on http://{args.host}:{args.port} with {args.workers} workers")
+    try:
+        while workers:
+            pid, status = os.wait()
+            workers.discard(pid)
+            if not stopping:
+                print(f"Worker {pid} exited with status {status}, restarting it")
+                workers.add(fork_worker(listener, shared, args, metrics_dir))
+    finally:
+        listener.close()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Module for starting the recommender in the background.
+
+Building a Recommender imports datasets, openai, tiktoken and FAISS, loads
+the dataset and maps the index, which takes seconds, while none of it is
+needed to show a prompt, render a page or connect to Discord. Entry points
+therefore import only this module up front and pass a function that
+imports and builds their Recommender to BackgroundRecommender, which runs
+it on a thread, warms the result (see Recommender.warm) and then sets its
+readiness flag. Requests that arrive before then wait for it. Warming is
+best effort: if it fails, the Recommender is still made ready, and its
+first requests pay for what warming would have loaded."""
+import threading
+import time
+
+
+class BackgroundRecommender:
+    """Builds the Recommender returned by `build` on a background thread.
+
+    `ready` is set once it has been built and warmed, and `wait` blocks
+    until then and returns it, re-raising anything the build raised.
+    Anything warming raised is kept in `warm_error` instead. `timings`
+    holds the seconds taken to build it, to warm it, and from construction
+    until it was ready."""
+
+    def __init__(self, build, warm=True):
+        self.build = build
+        self.warm = warm
+        self.start = time.perf_counter()
+        self.timings = {}
+        self.recommender = None
+        self.error = None
+        self.warm_error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def ready(self):
+        return self.done.is_set() and self.error is None
+
+    def _run(self):
+        try:
+            recs = self.build()
+            self.timings["build"] = time.perf_counter() - self.start
+            if self.warm:
+                try:
+                    recs.warm()
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    self.warm_error = e
+                self.timings["warm"] = (
+                    time.perf_counter() - self.start - self.timings["build"]
+                )
+            self.recommender = recs
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.error = e
+        finally:
+            self.timings["ready"] = time.perf_counter() - self.start
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """Returns the Recommender once it is ready. Raises TimeoutError if
+        it is not ready within `timeout` seconds."""
+        if not self.done.wait(timeout):
+            raise TimeoutError("The recommender is still starting.")
+        if self.error is not None:
+            raise RuntimeError("The recommender failed to start.") from self.error
+        return self.recommender
@@ -1,8 +1,25 @@
-"""Module for running the recommender with a GUI using the streamlit library."""
+"""Module for running the recommender with a GUI using the streamlit library.
+
+The page renders right away, while the recommender is built and warmed in
+the background (see startup.py), once per server process rather than once
+per session."""
 import streamlit as st
-import vector_searcher as vs
-import chatgpt
-import recommender
+import startup
+
+
+def build_recommender():
+    # pylint: disable=import-outside-toplevel
+    import chatgpt
+    import recommender
+    import vector_searcher
+
+    # pylint: enable=import-outside-toplevel
+    return recommender.Recommender(vector_searcher.VectorSearch(), chatgpt.ChatGPT())
+
+
+@st.cache_resource
+def start_recommender():
+    return startup.BackgroundRecommender(build_recommender)
 
 
 def main():
@@ -21,10 +38,7 @@ def main():
         unsafe_allow_html=True,
     )
 
-    if "recs" not in st.session_state:
-        chat = chatgpt.ChatGPT()
-        vectorsearcher = vs.VectorSearch()
-        st.session_state.recs = recommender.Recommender(vectorsearcher, chat)
+    starter = start_recommender()
 
     st.title("Public Domain Poetry Recommender")
 
@@ -33,9 +47,22 @@ def main():
     )
 
     if user_input:
-        explanation, poem_text = st.session_state.recs.ask(user_input)
-        st.write(explanation)
-        st.text(poem_text)
+        if starter.ready:
+            recs = starter.recommender
+        else:
+            with st.spinner("Loading the poems..."):
+                recs = starter.wait()
+        explanation_placeholder = st.empty()
+        poem_placeholder = st.empty()
+        update = None  # ask_stream always yields a final update
+        for update in recs.ask_stream(user_input):
+            explanation_placeholder.write(update.explanation)
+            if update.poem_text is not None:
+                poem_placeholder.text(update.poem_text)
+        st.caption(
+            f"First token after {update.first_token_seconds:.2f}s, "
+            + f"full response after {update.total_seconds:.2f}s"
+        )
 
 
 if __name__ == "__main__":
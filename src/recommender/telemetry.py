@@ -0,0 +1,379 @@
+"""Module for tracing requests and exporting metrics from the recommender.
+
+Each recommendation is recorded as a Trace: the time spent in each stage
+of the pipeline (query embedding, filtering, FAISS search, lexical search,
+row fetch, re-ranking, cache lookup, few-shot example selection, prompt
+building, LLM call, response parsing and rendering), along with attributes
+such as the number of candidates and examples and their prompt tokens.
+When a trace finishes, Telemetry folds it into counters and histograms,
+which can be rendered in the Prometheus text format or served over HTTP,
+and hands it to an optional JSONL sink.
+
+Exporting must not slow down the request it measures, so metric updates
+are a few additions under a lock, and traces are serialized and written to
+disk by a background thread (see AsyncWriter). Recommender and VectorSearch
+take NULL_TRACE when telemetry is off, whose spans do nothing."""
+import atexit
+import bisect
+import collections
+import contextlib
+import http.server
+import json
+import os
+import queue
+import threading
+import time
+
+TRACES_PATH = "logs/traces.jsonl"
+DEFAULT_MAX_PENDING = 10000
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+# Trace attributes that are counted as tokens in recommender_tokens_total.
+TOKEN_ATTRIBUTES = (
+    "candidate_tokens",
+    "example_tokens",
+    "prompt_tokens",
+    "completion_tokens",
+)
+
+Span = collections.namedtuple("Span", ["name", "start", "seconds"])
+
+
+class AsyncWriter:
+    """Appends records to a file from a background thread.
+
+    write only enqueues the record, and `formatter` turns it into text on
+    the writer thread, which keeps the file open and flushes whenever the
+    queue runs empty. Once `max_pending` records are queued, further records
+    are dropped (and counted in `dropped`) rather than blocking the caller.
+    Records still queued at exit are written."""
+
+    def __init__(self, path, formatter=str, max_pending=DEFAULT_MAX_PENDING):
+        self.path = path
+        self.formatter = formatter
+        self.records = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, record):
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                record = self.records.get()
+                if record is None:
+                    break
+                f.write(self.formatter(record))
+                if self.records.empty():
+                    f.flush()
+
+    def close(self):
+        """Writes the queued records and stops the writer thread."""
+        if self.thread.is_alive():
+            self.records.put(None)
+            self.thread.join()
+
+
+class _TimedSpan:
+    """Appends a Span for the time spent in its `with` block to a trace."""
+
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.spans.append(
+            Span(self.name, self.start, time.perf_counter() - self.start)
+        )
+
+
+class Trace:
+    """The spans and attributes of one request. Use it as a context manager
+    around the request, so that it is exported when the request finishes;
+    `outcome` is "error" if the request raised."""
+
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+        self.wall_time = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.outcome = "ok"
+        self.spans = []
+        self.attributes = {}
+
+    def span(self, name):
+        """Returns a context manager that records the time spent in it."""
+        return _TimedSpan(self, name)
+
+    def record(self, name, start):
+        """Records a span from `start` (a time.perf_counter value) to now,
+        for stages that cannot be wrapped in a with block."""
+        self.spans.append(Span(name, start, time.perf_counter() - start))
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is GeneratorExit:
+            self.outcome = "cancelled"
+        elif exc_type is not None:
+            self.outcome = "error"
+        self.seconds = time.perf_counter() - self.start
+        self.telemetry.export(self)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "time": self.wall_time,
+            "outcome": self.outcome,
+            "seconds": self.seconds,
+            "spans": [
+                {
+                    "name": span.name,
+                    "offset": span.start - self.start,
+                    "seconds": span.seconds,
+                }
+                for span in self.spans
+            ],
+            **self.attributes,
+        }
+
+
+class NullTrace:
+    """A trace that records nothing, used when telemetry is off."""
+
+    outcome = "ok"
+    _span = contextlib.nullcontext()
+
+    def span(self, _):
+        return self._span
+
+    def record(self, name, start):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as in the Prometheus exposition format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """Thread-safe counters and histograms, keyed by name and labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (key, labels), value in sorted(self.counters.items()):
+                    if key == name:
+                        lines.append(f"{name}{_labels(labels)} {value:g}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (key, labels), histogram in sorted(
+                    self.histograms.items(), key=lambda item: item[0]
+                ):
+                    if key != name:
+                        continue
+                    cumulative = 0
+                    bounds = [f"{bound:g}" for bound in histogram.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram.counts):
+                        cumulative += count
+                        lines.append(
+                            f"{name}_bucket{_labels(labels, le=bound)} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Returns the metrics as JSON-serializable data, for merging the
+        metrics of several processes (see merge)."""
+        with self.lock:
+            return {
+                "counters": [
+                    [name, labels, value]
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    [name, labels, histogram.counts, histogram.sum]
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+    def merge(self, snapshot):
+        """Adds the metrics in `snapshot` to these ones. Histograms must use
+        the same buckets."""
+        with self.lock:
+            for name, labels, value in snapshot["counters"]:
+                self.counters[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, counts, total in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram()
+                histogram = self.histograms[key]
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += sum(counts)
+
+
+class Telemetry:
+    """Collects finished traces into metrics and, if `traces_path` is
+    given, appends them to that file as JSON lines."""
+
+    def __init__(self, traces_path=None, max_pending=DEFAULT_MAX_PENDING):
+        self.metrics = Metrics()
+        self.sink = None
+        if traces_path is not None:
+            self.sink = AsyncWriter(
+                traces_path,
+                lambda trace: json.dumps(trace.to_dict()) + "\n",
+                max_pending,
+            )
+        self.server = None
+
+    def trace(self, name):
+        return Trace(self, name)
+
+    def export(self, trace):
+        metrics = self.metrics
+        metrics.inc(
+            "recommender_requests_total", kind=trace.name, outcome=trace.outcome
+        )
+        metrics.observe("recommender_request_seconds", trace.seconds, kind=trace.name)
+        for span in trace.spans:
+            metrics.observe("recommender_stage_seconds", span.seconds, stage=span.name)
+        for attribute in TOKEN_ATTRIBUTES:
+            if trace.attributes.get(attribute):
+                metrics.inc(
+                    "recommender_tokens_total",
+                    trace.attributes[attribute],
+                    kind=attribute[: -len("_tokens")],
+                )
+        if trace.attributes.get("retrieval") is not None:
+            metrics.inc(
+                "recommender_fallbacks_total", retrieval=trace.attributes["retrieval"]
+            )
+        if trace.attributes.get("first_token_seconds") is not None:
+            metrics.observe(
+                "recommender_first_token_seconds",
+                trace.attributes["first_token_seconds"],
+                kind=trace.name,
+            )
+        if self.sink is not None:
+            self.sink.write(trace)
+
+    def render(self):
+        return self.metrics.render()
+
+    def serve(self, port, host="0.0.0.0"):
+        """Serves render() at /metrics from a daemon thread."""
+        telemetry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Answers GET /metrics with the rendered metrics."""
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                content = telemetry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.sink is not None:
+            self.sink.close()
@@ -0,0 +1,38 @@
+"""Module for counting and truncating text by tokens with tiktoken.
+
+The encoding object is loaded once per process and reused. Truncation
+encodes the text once and cuts it at a token boundary, instead of binary
+searching over character offsets and re-encoding the prefix at every step."""
+import functools
+import tiktoken
+
+TOKENIZER = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name=TOKENIZER):
+    return tiktoken.get_encoding(encoding_name)
+
+
+def num_tokens(text, encoding_name=TOKENIZER):
+    return len(get_encoding(encoding_name).encode(text))
+
+
+def reduce_to_token_limit(text, limit, encoding_name=TOKENIZER):
+    """Returns a prefix of `text` that encodes to at most `limit` tokens.
+
+    The prefix is the text of the first `limit` tokens of `text`, less any
+    character split across the last of them. It ends at a token boundary,
+    so it can be a few characters shorter than the longest prefix that
+    fits, which may end inside a word. Re-encoding a prefix can merge its
+    tokens differently than in the full text, so the prefix is encoded
+    once more and cut a token shorter in the rare case it no longer fits."""
+    encoding = get_encoding(encoding_name)
+    tokens = encoding.encode(text)
+    if len(tokens) <= limit:
+        return text
+    for end in range(limit, 0, -1):
+        prefix = encoding.decode_bytes(tokens[:end]).decode("utf-8", errors="ignore")
+        if len(encoding.encode(prefix)) <= limit:
+            return prefix
+    return ""
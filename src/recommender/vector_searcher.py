@@ -1,20 +1,96 @@
 """Module for querying a vector search index containing poem embeddings."""
-import collections
+import asyncio
+import functools
 import openai
 import numpy as np
-from datasets import load_dataset
+from datasets import config, load_dataset, load_from_disk
 import dotenv
 import os
+import threading
+import time
+
+import corpus_segments
+import embedding_cache
+import embedding_index
+import embedding_store
+import lexical_index
+import poem_filters
+import telemetry
 
 EMBEDDING_DATA_SET = "pvd-dot/public-domain-poetry-with-embeddings"
+# Environment variable overriding the dataset, e.g. with a local corpus.
+DATA_SET_ENV = "POEM_DATA_SET"
 MODEL = "text-embedding-ada-002"
+# Seconds to wait for the embeddings API before falling back to the lexical
+# index (see try_embed_queries).
+EMBEDDING_TIMEOUT_SECONDS = 2.0
+# Seconds to wait for the API when opening connections (see warm), without
+# retries, so that an unreachable API cannot hold up startup.
+WARM_TIMEOUT_SECONDS = 3.0
+# Results taken from each of the vector and lexical searches to be fused.
+FUSION_DEPTH = 50
+# Seconds between checks for new corpus segments (see watch_segments).
+SEGMENT_POLL_SECONDS = 5
 
 dotenv.load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-Poem = collections.namedtuple(
-    "Poem", ["id", "title", "author", "text", "views", "about", "birth_and_death_dates"]
-)
+# Dataset column for each Poem field, in field order.
+POEM_COLUMNS = {
+    "id": "id",
+    "title": "Title",
+    "author": "Author",
+    "text": "Poem Text",
+    "views": "Views",
+    "about": "About",
+    "birth_and_death_dates": "Birth and Death Dates",
+}
+
+
+class Poem:
+    """A poem's metadata. Uses __slots__ rather than a per-instance dict,
+    since a Poem is created for every search result."""
+
+    __slots__ = tuple(POEM_COLUMNS)
+
+    def __init__(self, id_, title, author, text, views, about, birth_and_death_dates):
+        self.id = id_
+        self.title = title
+        self.author = author
+        self.text = text
+        self.views = views
+        self.about = about
+        self.birth_and_death_dates = birth_and_death_dates
+
+    def __eq__(self, other):
+        return isinstance(other, Poem) and all(
+            getattr(self, field) == getattr(other, field) for field in self.__slots__
+        )
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        fields = ", ".join(f"{f}={getattr(self, f)!r}" for f in self.__slots__)
+        return f"Poem({fields})"
+
+
+def rows_to_poems(rows):
+    """Converts a batch of dataset rows (a dict of columns) to poems."""
+    return [Poem(*values) for values in zip(*[rows[c] for c in POEM_COLUMNS.values()])]
+
+
+def load_poems(data_set=None):
+    """Loads the poem dataset from the Hugging Face Hub, or from a local
+    directory written by Dataset.save_to_disk (e.g. a benchmark corpus) or
+    holding Parquet shards like a Hub repository (see generate_dataset.py).
+    Defaults to $POEM_DATA_SET, then EMBEDDING_DATA_SET."""
+    data_set = data_set or os.getenv(DATA_SET_ENV, EMBEDDING_DATA_SET)
+    if os.path.isdir(data_set) and os.path.exists(
+        os.path.join(data_set, config.DATASET_STATE_JSON_FILENAME)
+    ):
+        return load_from_disk(data_set)
+    return load_dataset(data_set, split="train")
 
 
 class VectorSearch:
@@ -28,30 +104,380 @@ class VectorSearch:
     The class leverages the FAISS (Facebook AI Similarity Search) library for
     efficient similarity searching in high-dimensional spaces, making it
     suitablefor quick and relevant retrieval from a large collection of
-    38k poems in the public domain."""
+    38k poems in the public domain. The index type defaults to exact search,
+    and can be switched to an approximate index (see embedding_index.py) with
+    `nprobe`/`ef_search` controlling its recall/latency tradeoff, or to a
+    compressed index whose top `rerank` results are re-ranked exactly, with
+    `pca_dim` dimensions for the PCA types. Query
+    embeddings are cached (see embedding_cache.py), so repeated queries skip
+    the embeddings API call.
 
-    def __init__(self):
+    If the lexical index has been built (see lexical_index.py), searches
+    with query text fuse its BM25 ranking with the vector ranking, and
+    requests can be served from it alone when the embeddings API fails or
+    takes longer than `embedding_timeout` seconds. An index with a different
+    number of poems than the dataset is rebuilt.
+
+    Poems added after the dataset was built are read from the corpus
+    segments (see corpus_segments.py), which are searched along with the
+    dataset and their results merged. `refresh` switches to segments added
+    or compacted since they were loaded."""
+
+    def __init__(
+        self,
+        index_type="flat",
+        nprobe=embedding_index.DEFAULT_NPROBE,
+        ef_search=embedding_index.DEFAULT_EF_SEARCH,
+        query_cache=None,
+        data_set=None,
+        rerank=None,
+        pca_dim=embedding_index.DEFAULT_PCA_DIM,
+        embedding_timeout=EMBEDDING_TIMEOUT_SECONDS,
+    ):
         self.client = openai.OpenAI()
-        self.data = load_dataset(EMBEDDING_DATA_SET, split="train")
-        self.data.add_faiss_index(column="embedding")
+        self.async_client = openai.AsyncOpenAI()
+        self.query_cache = query_cache or embedding_cache.EmbeddingCache()
+        self.data = load_poems(data_set)
+        self.metadata = self.data.select_columns(list(POEM_COLUMNS.values()))
+        if not embedding_index.exists():
+            if embedding_store.exists():
+                embedding_index.build_from_store(
+                    embedding_store.EmbeddingStore(), len(self.data)
+                )
+            else:
+                embedding_index.build(self.data)
+        self.index = embedding_index.EmbeddingIndex(
+            index_type,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            rerank=rerank,
+            pca_dim=pca_dim,
+        )
+        self.attributes = None
+        self.attributes_lock = threading.Lock()
+        self.lexical_index = None
+        if lexical_index.exists():
+            self.lexical_index = lexical_index.LexicalIndex()
+            if len(self.lexical_index) != len(self.data):
+                # Built for another version of the dataset.
+                lexical_index.build(self.data)
+                self.lexical_index = lexical_index.LexicalIndex()
+        self.embedding_timeout = embedding_timeout
+        self.segments = corpus_segments.SegmentSet(len(self.data))
+
+    def reconnect(self, query_cache=None):
+        """Replaces the API clients and the query cache. A process forked
+        from the one that created this VectorSearch must call this before
+        its first request, since connections and SQLite handles cannot be
+        shared across a fork. The dataset and index are memory-mapped, so
+        they are shared with the parent instead of copied."""
+        self.client = openai.OpenAI()
+        self.async_client = openai.AsyncOpenAI()
+        self.query_cache = query_cache or embedding_cache.EmbeddingCache()
+
+    def warm(self):
+        """Runs one search and row fetch, so that the index and dataset pages
+        are read in before the first request, and opens the connection to the
+        embeddings API. Warming the connection is best effort."""
+        self.search_embeddings(np.asarray(self.index.embeddings[:1]), 1)
+        try:
+            self.client.with_options(
+                timeout=WARM_TIMEOUT_SECONDS, max_retries=0
+            ).models.retrieve(MODEL)
+        except openai.OpenAIError:
+            pass
+
+    async def awarm(self):
+        """Opens the async client's connection to the embeddings API."""
+        try:
+            await self.async_client.with_options(
+                timeout=WARM_TIMEOUT_SECONDS, max_retries=0
+            ).models.retrieve(MODEL)
+        except openai.OpenAIError:
+            pass
+
+    def refresh(self):
+        """Switches to the current corpus segments if they have changed, and
+        returns whether they had. Searches that are running finish with the
+        segments they started with."""
+        segments = self.segments.refresh()
+        changed = segments is not self.segments
+        self.segments = segments
+        return changed
+
+    def watch_segments(self, interval=SEGMENT_POLL_SECONDS):
+        """Calls refresh every `interval` seconds on a daemon thread, so that
+        new segments are served without a restart. Segments that cannot be
+        read are reported and retried at the next check."""
+
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.refresh():
+                        print(f"Loaded corpus segments v{self.segments.version}")
+                except (OSError, ValueError) as e:
+                    print(f"Could not load corpus segments: {e}")
+
+        threading.Thread(target=poll, daemon=True).start()
+
+    def num_poems(self):
+        return len(self.metadata) + self.segments.num_poems()
+
+    def get_poems(self, ids):
+        """Returns the poems for `ids`, in order.
+
+        Only the metadata columns are read, with one columnar take for all
+        ids, so the embedding column is never decoded. Poems in segments are
+        read with one take per segment."""
+        ids = [int(id_) for id_ in ids]
+        base_rows = len(self.metadata)
+        segment_ids = [id_ for id_ in ids if id_ >= base_rows]
+        if not segment_ids:
+            return rows_to_poems(self.metadata[ids])
+        poems = {
+            poem.id: poem
+            for poem in rows_to_poems(self.metadata[[i for i in ids if i < base_rows]])
+        }
+        for poem in rows_to_poems(self.segments.get_rows(segment_ids)):
+            poems[poem.id] = poem
+        return [poems[id_] for id_ in ids]
 
     def convert_to_poem(self, id_):
-        row = self.data[int(id_)]
-        return Poem(
-            id=row["id"],
-            title=row["Title"],
-            author=row["Author"],
-            text=row["Poem Text"],
-            views=row["Views"],
-            about=row["About"],
-            birth_and_death_dates=row["Birth and Death Dates"],
+        return self.get_poems([id_])[0]
+
+    def convert_to_poems(self, ids):
+        """Fetches the poems for `ids` in one read and returns them by id."""
+        return {poem.id: poem for poem in self.get_poems(ids)}
+
+    def get_embeddings(self, ids):
+        """Returns the embeddings of the poems with `ids`, in order."""
+        ids = np.asarray(ids, dtype=np.int64)
+        in_base = ids < len(self.index.embeddings)
+        if in_base.all():
+            return np.asarray(self.index.embeddings[ids], dtype=np.float32)
+        embeddings = np.empty(
+            (len(ids), self.index.embeddings.shape[1]), dtype=np.float32
         )
+        embeddings[in_base] = self.index.embeddings[ids[in_base]]
+        embeddings[~in_base] = self.segments.get_embeddings(ids[~in_base])
+        return embeddings
+
+    def embed_query(self, query_text):
+        return self.embed_queries([query_text])[0]
+
+    def embed_queries(self, query_texts):
+        """Embeds `query_texts`, sending every uncached text in one request."""
+        query_embeddings, missing = self._get_cached_embeddings(query_texts)
+        if missing:
+            response = self.client.embeddings.create(input=missing, model=MODEL)
+            query_embeddings = self._add_embeddings(
+                query_texts, query_embeddings, missing, response
+            )
+        return np.stack(query_embeddings)
+
+    async def aembed_queries(self, query_texts):
+        query_embeddings, missing = self._get_cached_embeddings(query_texts)
+        if missing:
+            response = await self.async_client.embeddings.create(
+                input=missing, model=MODEL
+            )
+            query_embeddings = self._add_embeddings(
+                query_texts, query_embeddings, missing, response
+            )
+        return np.stack(query_embeddings)
+
+    def try_embed_queries(self, query_texts):
+        """Like embed_queries, but if the lexical index can serve the queries
+        instead, returns None when the embeddings API fails or does not
+        answer within `embedding_timeout` seconds, without retrying."""
+        if self.lexical_index is None:
+            return self.embed_queries(query_texts)
+        query_embeddings, missing = self._get_cached_embeddings(query_texts)
+        if missing:
+            try:
+                response = self.client.with_options(
+                    timeout=self.embedding_timeout, max_retries=0
+                ).embeddings.create(input=missing, model=MODEL)
+            except openai.OpenAIError:
+                return None
+            query_embeddings = self._add_embeddings(
+                query_texts, query_embeddings, missing, response
+            )
+        return np.stack(query_embeddings)
+
+    async def atry_embed_queries(self, query_texts):
+        if self.lexical_index is None:
+            return await self.aembed_queries(query_texts)
+        query_embeddings, missing = self._get_cached_embeddings(query_texts)
+        if missing:
+            try:
+                response = await self.async_client.with_options(
+                    timeout=self.embedding_timeout, max_retries=0
+                ).embeddings.create(input=missing, model=MODEL)
+            except openai.OpenAIError:
+                return None
+            query_embeddings = self._add_embeddings(
+                query_texts, query_embeddings, missing, response
+            )
+        return np.stack(query_embeddings)
+
+    def _get_cached_embeddings(self, query_texts):
+        query_embeddings = [self.query_cache.get(MODEL, text) for text in query_texts]
+        missing = list(
+            dict.fromkeys(
+                text
+                for text, embedding in zip(query_texts, query_embeddings)
+                if embedding is None
+            )
+        )
+        return query_embeddings, missing
+
+    def _add_embeddings(self, query_texts, query_embeddings, missing, response):
+        fetched = {}
+        for text, item in zip(missing, sorted(response.data, key=lambda d: d.index)):
+            fetched[text] = np.array(item.embedding, dtype=np.float32)
+            self.query_cache.put(MODEL, text, fetched[text])
+        return [
+            fetched[text] if embedding is None else embedding
+            for text, embedding in zip(query_texts, query_embeddings)
+        ]
+
+    def get_attributes(self):
+        """Returns the poem_filters.PoemAttributes of the dataset, computing
+        them on the first filtered search if they have not been built."""
+        with self.attributes_lock:
+            if self.attributes is None:
+                if not poem_filters.exists():
+                    poem_filters.build(self.data)
+                self.attributes = poem_filters.PoemAttributes()
+            return self.attributes
+
+    def search(self, query_text, limit=1, poem_filter=None):
+        return self.search_many([query_text], limit, poem_filter)[0]
+
+    def search_many(self, query_texts, limit=1, poem_filter=None):
+        """Searches for several queries with one embeddings request, one
+        FAISS search over the stacked query vectors and one row fetch.
+
+        Returns a list of poem lists, in the same order as `query_texts`."""
+        if not query_texts:
+            return []
+        return self.search_embeddings(
+            self.embed_queries(query_texts), limit, poem_filter, query_texts=query_texts
+        )
+
+    def search_embeddings(
+        self,
+        query_embeddings,
+        limit=1,
+        poem_filter=None,
+        trace=telemetry.NULL_TRACE,
+        query_texts=None,
+    ):
+        """Searches for the nearest poems to each query embedding, among the
+        poems matching `poem_filter` (a poem_filters.PoemFilter) if given.
+
+        If `query_texts` are given and the lexical index exists, the top
+        FUSION_DEPTH results of the vector and lexical searches are fused
+        (see lexical_index.fuse). The filter, search, lexical and row fetch
+        stages are recorded in `trace`."""
+        segments = self.segments
+        masks = self._masks(poem_filter, segments, trace)
+        if query_texts is None or self.lexical_index is None:
+            with trace.span("search"):
+                results = self._search(query_embeddings, limit, segments, masks)
+            return self.fetch_results(results, trace)
+        depth = max(limit, FUSION_DEPTH)
+        with trace.span("search"):
+            results = self._search(query_embeddings, depth, segments, masks)
+        with trace.span("lexical"):
+            results = [
+                lexical_index.fuse(
+                    [
+                        row[row >= 0],
+                        self._search_lexical(text, depth, segments, masks),
+                    ],
+                    limit,
+                )
+                for row, text in zip(results, query_texts)
+            ]
+        return self.fetch_results(results, trace)
+
+    def search_lexical(
+        self, query_texts, limit=1, poem_filter=None, trace=telemetry.NULL_TRACE
+    ):
+        """Searches the lexical index alone, for when the query embeddings
+        are not available. Requires the lexical index."""
+        segments = self.segments
+        masks = self._masks(poem_filter, segments, trace)
+        with trace.span("lexical"):
+            results = [
+                self._search_lexical(text, limit, segments, masks)
+                for text in query_texts
+            ]
+        return self.fetch_results(results, trace)
+
+    def _masks(self, poem_filter, segments, trace):
+        """Returns the masks of the dataset and of each segment for
+        `poem_filter`, or None if there is no filter."""
+        if poem_filter is None:
+            return None
+        with trace.span("filter"):
+            return self.get_attributes().mask(poem_filter), segments.masks(poem_filter)
+
+    def _search(self, query_embeddings, k, segments, masks):
+        """Returns the ids of the `k` nearest poems in the dataset and
+        `segments`, where -1 is no result."""
+        mask, segment_masks = masks or (None, None)
+        results = self.index.search(query_embeddings, k, mask)
+        if segments:
+            results = embedding_index.merge(
+                [results, segments.search(query_embeddings, k, segment_masks)], k
+            )
+        return results[1]
+
+    def _search_lexical(self, query_text, k, segments, masks):
+        """Returns the ids of the `k` best keyword matches in the dataset and
+        `segments`, scored as one collection."""
+        mask, segment_masks = masks or (None, None)
+        if not segments:
+            return self.lexical_index.search(query_text, k, mask)
+        collection = [self.lexical_index, *segments.lexical_indexes()]
+        return lexical_index.merge(
+            [
+                self.lexical_index.top(query_text, k, mask, collection),
+                segments.lexical_search(query_text, k, segment_masks, collection),
+            ],
+            k,
+        )[1]
+
+    def fetch_results(self, results, trace=telemetry.NULL_TRACE):
+        """Returns the poems for rows of result ids, where -1 is no result."""
+        with trace.span("fetch"):
+            ids = [id_ for row in results for id_ in row if id_ >= 0]
+            poems = self.convert_to_poems(np.unique(np.asarray(ids, dtype=np.int64)))
+        return [[poems[id_] for id_ in row if id_ >= 0] for row in results]
+
+    async def asearch(self, query_text, limit=1, executor=None, poem_filter=None):
+        return (await self.asearch_many([query_text], limit, executor, poem_filter))[0]
+
+    async def asearch_many(self, query_texts, limit=1, executor=None, poem_filter=None):
+        """Async variant of search_many.
 
-    def search(self, query_text, limit=1):
-        query_embedding = np.array(
-            self.client.embeddings.create(input=[query_text], model=MODEL)
-            .data[0]
-            .embedding
+        The embeddings request is awaited on the event loop, while the FAISS
+        search and row fetch run in `executor` (the loop's default executor
+        if None), so that other coroutines keep running in the meantime."""
+        if not query_texts:
+            return []
+        query_embeddings = await self.aembed_queries(query_texts)
+        return await asyncio.get_running_loop().run_in_executor(
+            executor,
+            functools.partial(
+                self.search_embeddings,
+                query_embeddings,
+                limit,
+                poem_filter,
+                query_texts=query_texts,
+            ),
         )
-        _, results = self.data.search("embedding", query_embedding, k=limit)
-        return [self.convert_to_poem(id) for id in results]